@@ -1,26 +1,42 @@
+import asyncio
+import dataclasses
+import hashlib
 import itertools as it
 import json
 import os
 import tempfile
-from concurrent.futures import Future, ThreadPoolExecutor, wait
-from typing import Any, Generator, NamedTuple
+import time
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from functools import partial, wraps
+from typing import Any, Callable, Coroutine, NamedTuple
 
+import util.aio as aio
 import util.containerutils as containerutils
 import util.iputils as iputils
 import util.kindutils as kindutils
+import util.kubectlutils as kubectlutils
+import util.nsagent as nsagent
+import util.perf as perf
+import util.reconcile as reconcile
 from core.constants import KIND_CIDR, POD_CIDR, TUN_CIDR
 from core.InternetAccessManager import InternetAccessManager
 from core.K8sNode import ControlNode, K8sNode, WorkerNode
 from core.NodeInitializer import NodeInitializer
-from util.iputils import NetIface
+from util.ipam import Ipam
+from util.iputils import Cidr, IpBackend, NetIface, TunnelEncapsulation
 from util.logger import logger
 from util.p4 import P4Params
+from util.supervisor import TaskSupervisor, TasksFailedError
+
+
+# container id or a callable returning it, the latter allows connecting with containers that are still being deployed
+ContainerRef = str | Callable[[], str]
 
 
 class ConnectionTask(NamedTuple):
     node_name: str
     node_iface: NetIface
-    container_id: str
+    container_id: ContainerRef
     container_iface: NetIface
     add_default_route_via_container: bool
     as_bridge_in_container: bool
@@ -31,12 +47,40 @@ class BridgeInfo(NamedTuple):
     br_name: str
 
 
+def _using_ip_backend(method: Callable[..., Any]) -> Callable[..., Any]:
+    '''Runs builder operation with ip backend of the builder'''
+    @wraps(method)
+    def wrapper(self: 'ClusterBuilder', *args, **kwargs) -> Any:
+        with iputils.using_backend(self.netlink_backend):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class ClusterBuilder:
     _KINDA_CONFIG_PATH = os.path.join(os.environ['HOME'], '.kinda')
+    _PERF_REPORT_JSON_PATH = os.path.join(os.environ['HOME'], '.kinda-perf.json')
+    _PERF_REPORT_CSV_PATH = os.path.join(os.environ['HOME'], '.kinda-perf.csv')
+    _PERF_TRACE_PATH = os.path.join(os.environ['HOME'], '.kinda-trace.json')
+    _CLUSTER_SHAPE_PATH = os.path.join(os.environ['HOME'], '.kinda-cluster.json')
+    _SNAPSHOT_METADATA_FILENAME = 'snapshot.json'
+    _SNAPSHOT_IMAGE_REPOSITORY = 'kinda/snapshot'
     _KIND_TIMEOUT_SECONDS = 300
     _NODE_INIT_TIMEOUT_SECONDS = 300
+    # node tasks are retried alone, e.g. after a flaky apt mirror, instead of failing the whole build
+    _NODE_TASK_RETRIES = 2
+    _NODE_TASK_BACKOFF_SECONDS = 2
+    _BRING_UP_POLL_INTERVAL_SECONDS = 1
     _MAX_NODES = 127
+    # limited only by /24 node pod cidrs carved from POD_CIDR
+    _MAX_FLOW_BASED_TUNNELING_NODES = 256
     _MAX_POOL_SIZE = 32
+    _TUNNEL_IFACE_PREFIX = 'tgre_'
+    _DEFAULT_MTU = 1500
+    _FOU_PORT = 5555
+    _VXLAN_PORT = 4789
+    # addresses that docker and kubernetes usually assign, dry run plans with them in node order
+    _DRY_RUN_KIND_NETWORK = Cidr('172.18.0.0', 16)
+    _DRY_RUN_NODE_POD_CIDR_SIZE = 24
     # 10.0-100.0.0 networks are recommended
     _FORBIDDEN_NETWORKS = set([
         POD_CIDR,
@@ -44,21 +88,54 @@ class ClusterBuilder:
         TUN_CIDR
     ])
 
-    def __init__(self, name: str, node_initializer: NodeInitializer, internet_access_mgr: InternetAccessManager) -> None:
+    def __init__(self, name: str, node_initializer: NodeInitializer, internet_access_mgr: InternetAccessManager,
+                 ip_backend: IpBackend = IpBackend.SUBPROCESS) -> None:
         self.name = name
         self.node_initializer = node_initializer
         self.internet_access_mgr = internet_access_mgr
         self.control_nodes: dict[str, ControlNode] = {}
         self.worker_nodes: dict[str, WorkerNode] = {}
         self.internet_access_requested = False
+        self.internet_gateway_container_id: ContainerRef = None
         self.built = False
+        self.pipelined_bring_up = False
+        # loop of build_async caller, networking runs on it instead of pool threads
+        self.event_loop: asyncio.AbstractEventLoop = None
+        self.use_prebaked_node_image = True
+        # kind's default node image if None
+        self.base_node_image: str = None
+        self.keep_alive = False
+        self.snapshot_to_restore: tuple[str, dict[str, Any]] = None
+        # executed network plans, replayed by reapply_network
+        self.network_plans: list[iputils.NetworkPlan] = []
+        # tasks running alongside the build (e.g. network deployment) that must finish before networking is set up
+        self.build_dependencies: list[Future[Any]] = []
+        self.teardown_tasks: list[Callable[[], Any]] = []
         self.route_kubectl_traffic_through_virtual_network = False
+        self.network_plan_path: str = None
+        self.network_plan_dry_run = False
+        self.dry_run_finished = False
+        self.dry_run_container_netns: dict[ContainerRef, str] = {}
+        self.reconcile_network_state = False
+        self.flow_based_tunneling = False
+        self.tunnel_encapsulation = TunnelEncapsulation.GRE
         # iface with routes through it
         self.simple_host_connections: list[tuple[NetIface, list[str]]] = []
 
         self.container_netns: set[str] = set()
         self.connect_tasks: list[ConnectionTask] = []
-        self.tunnel_subnet_generator = self._create_tunnel_subnet_generator()
+        self.connections: dict[str, ConnectionTask] = {}
+        self.bridge_to_slaves: dict[BridgeInfo, list[NetIface]] = {}
+        # node name -> bridge in container and its slave connected to the node
+        self.bridge_slaves: dict[str, tuple[BridgeInfo, NetIface]] = {}
+        # stable numbers used in tunnel names, nodes can be added and removed after build
+        self.node_numbers: dict[str, int] = {}
+        self.node_number_counter = it.count()
+        # (node1 name, node2 name) -> (tunnel iface in node1, tunnel iface in node2)
+        self.tunnels: dict[tuple[str, str], tuple[NetIface, NetIface]] = {}
+        self.ipam = Ipam(self._FORBIDDEN_NETWORKS)
+        # selected for the duration of each operation, other builders may use other backends
+        self.netlink_backend = iputils.create_backend(ip_backend)
 
     @property
     def workers(self) -> list[WorkerNode]:
@@ -68,6 +145,10 @@ class ClusterBuilder:
     def controls(self) -> list[ControlNode]:
         return list(self.control_nodes.values())
 
+    @property
+    def max_nodes(self) -> int:
+        return self._MAX_FLOW_BASED_TUNNELING_NODES if self.flow_based_tunneling else self._MAX_NODES
+
     def add_control(self, name: str, with_p4_nic: bool = False, p4_params: P4Params = None) -> ControlNode:
         # Kind creates haproxy container when multiple control plane nodes are requested, which is problematic
         assert len(
@@ -76,69 +157,329 @@ class ClusterBuilder:
         if with_p4_nic and p4_params is None:
             p4_params = P4Params()
 
-        assert len(self.worker_nodes) + len(self.control_nodes) <= self._MAX_NODES, \
-            f'Max nodes count exceeded, ({self._MAX_NODES})'
+        # flow-based tunneling may still be enabled, final count is checked by build and scale_out
+        assert len(self.worker_nodes) + len(self.control_nodes) < self._MAX_FLOW_BASED_TUNNELING_NODES, \
+            f'Max nodes count exceeded, ({self._MAX_FLOW_BASED_TUNNELING_NODES})'
         self.control_nodes[name] = ControlNode(name, with_p4_nic, p4_params)
+        self.node_numbers[name] = next(self.node_number_counter)
         return self.control_nodes[name]
 
     def add_worker(self, name: str, with_p4_nic: bool = False, p4_params: P4Params = None) -> WorkerNode:
+        '''Workers added after build join the cluster with scale_out'''
+        assert name not in self.worker_nodes and name not in self.control_nodes, f'Node {name} already exists'
         if with_p4_nic and p4_params is None:
             p4_params = P4Params()
 
-        assert len(self.worker_nodes) + len(self.control_nodes) <= self._MAX_NODES, \
-            f'Max nodes count exceeded, ({self._MAX_NODES})'
+        # flow-based tunneling may still be enabled, final count is checked by build and scale_out
+        assert len(self.worker_nodes) + len(self.control_nodes) < self._MAX_FLOW_BASED_TUNNELING_NODES, \
+            f'Max nodes count exceeded, ({self._MAX_FLOW_BASED_TUNNELING_NODES})'
         self.worker_nodes[name] = WorkerNode(name, with_p4_nic, p4_params)
+        self.node_numbers[name] = next(self.node_number_counter)
         return self.worker_nodes[name]
 
     def enable_kubectl_routing_through_virtual_network(self):
         '''Kubectl traffic is routed through host bridge by default for debugging convenience'''
         self.route_kubectl_traffic_through_virtual_network = True
 
+    def enable_network_plan_dump(self, path: str, dry_run: bool = False):
+        '''
+        Build writes planned networking operations to path as JSON. With dry_run build only compiles the plan
+        from declared topology, no cluster is created and host isn't touched, so it doesn't require root.
+        Addresses that kind and kubernetes would assign are replaced with the usual ones, container namespaces
+        with placeholders and the plan isn't reconciled with live state. Connections established with
+        establish_simple_host_connection are applied right away and aren't part of the plan.
+        Planning consumes connection tasks, tunnels and addresses, builder can only be destroyed after a dry run.
+        '''
+        self.network_plan_path = path
+        self.network_plan_dry_run = dry_run
+
+    def enable_flow_based_tunneling(self):
+        '''
+        Pod traffic is tunneled through single collect-metadata GRE device per node with per-peer encap routes,
+        instead of a GRE device for every pair of nodes. Required to build clusters of more than _MAX_NODES nodes.
+        '''
+        self.flow_based_tunneling = True
+
+    def set_tunnel_encapsulation(self, encapsulation: TunnelEncapsulation):
+        '''GRE-over-FOU and VXLAN spread flows between nodes over ECMP paths by varying UDP source port'''
+        self.tunnel_encapsulation = encapsulation
+
+    def enable_pipelined_bring_up(self):
+        '''Initializes nodes while kind is still creating the cluster, instead of after it'''
+        self.pipelined_bring_up = True
+
+    def disable_prebaked_node_image(self):
+        '''Node requirements are installed on every node instead of being baked into node image once'''
+        self.use_prebaked_node_image = False
+
+    def set_base_node_image(self, image: str):
+        '''Nodes run this kind node image (or prebaked image built from it) instead of kind's default one'''
+        self.base_node_image = image
+
+    def enable_keep_alive(self):
+        '''
+        Kind cluster is left running on destroy and reused by the next build with the same number of nodes,
+        only kinda's network configuration is stripped and applied again.
+        '''
+        self.keep_alive = True
+
+    def add_build_dependency(self, task: Future[Any]):
+        '''Build awaits the task before connecting nodes with containers'''
+        self.build_dependencies.append(task)
+
+    def add_teardown_task(self, task: Callable[[], Any]):
+        '''Destroy runs the task concurrently with removal of the cluster, e.g. undeployment of connected containers'''
+        self.teardown_tasks.append(task)
+
+    def enable_network_reconciliation(self):
+        '''Skips planned networking operations whose effects are already present and removes stale tunnels'''
+        self.reconcile_network_state = True
+
+    @_using_ip_backend
     def build(self):
         if self.built:
             logger.warn("Cluster is already built")
             return
+        assert not self.dry_run_finished, 'Network plan was dumped with dry run, builder can only be destroyed'
+        self._assert_node_count()
+        if self.network_plan_dry_run:
+            self._dump_network_plan_dry_run()
+            return
 
         logger.info('Building cluster...')
-        self._try_requesting_more_OS_resources_if_needed()
-        self._run_cluster()
-
-        logger.info("Updating kubectl...")
-        self._update_kubectl_cfg()
-
-        logger.info("Initializing nodes...")
-        self._init_nodes()
+        perf.reset()
+        # nodes of reused or restored cluster may still hold parts of the network state
+        reconcile_plan = True
+        if self.snapshot_to_restore is not None:
+            logger.info("Restoring cluster from snapshot...")
+            with perf.phase('restore_cluster'):
+                self._restore_cluster(*self.snapshot_to_restore)
+                self.snapshot_to_restore = None
+        elif self.keep_alive and (shape := self._get_reusable_cluster_shape()) is not None:
+            logger.info("Reusing running cluster...")
+            with perf.phase('reuse_cluster'):
+                self._reuse_cluster(shape)
+        elif self.pipelined_bring_up:
+            logger.info("Running cluster and initializing nodes...")
+            reconcile_plan = False
+            with perf.phase('bring_up_cluster'):
+                self._try_requesting_more_OS_resources_if_needed()
+                self._bring_up_cluster_pipelined()
+        else:
+            reconcile_plan = False
+            with perf.phase('run_cluster'):
+                self._try_requesting_more_OS_resources_if_needed()
+                self._run_cluster()
+
+            logger.info("Updating kubectl...")
+            with perf.phase('update_kubectl_cfg'):
+                self._update_kubectl_cfg()
+
+            logger.info("Initializing nodes...")
+            with perf.phase('init_nodes'):
+                self._init_nodes()
+
+        if self.build_dependencies:
+            logger.info("Waiting for build dependencies...")
+            with perf.phase('await_build_dependencies'):
+                self._await_tasks(self.build_dependencies)
+                self.build_dependencies.clear()
 
         logger.info("Setting up cluster networking...")
-        self._setup_connections()
-        self._update_cluster_address_translations()
-        self._setup_pod_traffic_tunneling()
-        self._setup_p4_nics()
+        self._setup_networking(reconcile_plan=reconcile_plan)
+        with perf.phase('setup_p4_nics'):
+            self._setup_p4_nics()
 
         if self.internet_access_requested:
             logger.info("Provisioning internet access...")
-            self.internet_access_mgr.provision_internet_access(
-                self.controls + self.workers)
+            with perf.phase('provision_internet_access'):
+                self.internet_access_mgr.internet_gateway_container_netns = self._attach_container_namespace_to_host(
+                    self.internet_gateway_container_id)
+                self.internet_access_mgr.provision_internet_access(
+                    self.controls + self.workers)
 
         logger.info("Writing config for kinda CLI")
         self._write_kinda_config()
+        self._write_cluster_shape()
+        self._write_performance_report()
 
         self.built = True
         logger.info("Cluster ready")
 
-    def destroy(self):
+    async def build_async(self):
+        '''
+        Same as build, but network plan and per-node commands are executed on the calling event loop,
+        so that operations of many namespaces are in flight without a thread per operation.
+        Cluster creation, kubectl and container inspection aren't async, they run in a worker thread
+        through kind, DockerClient and the container registry like in build.
+        '''
+        self.event_loop = asyncio.get_running_loop()
+        try:
+            await asyncio.to_thread(self.build)
+        finally:
+            self.event_loop = None
+
+    @_using_ip_backend
+    def reapply_network(self):
+        '''
+        Applies networking of the built cluster again, skipping operations whose effects are present in the live state
+        and removing stale tunnels, e.g. after an interrupted operation or manual changes. Namespaces of nodes
+        and containers must still be attached, recreated containers require a new build.
+        '''
+        assert self.built, 'Cluster must be built before reapplying its network'
+        logger.info('Reapplying cluster networking...')
+        plan = iputils.NetworkPlan.combine(self.network_plans)
+        with perf.phase('reapply_network'):
+            reconcile.reconcile_plan(plan, (self._TUNNEL_IFACE_PREFIX,), self._MAX_POOL_SIZE)
+            plan.execute(self._MAX_POOL_SIZE)
+            self._turn_off_tcp_checksum_offloading()
+
+    def snapshot(self, path: str):
+        '''
+        Saves node containers of the built cluster in path directory, restore recreates the cluster from it
+        without creating it with kind and bootstrapping kubernetes. Networking isn't saved, it's set up again
+        from connections declared on the restoring builder, devices of the virtual network aren't saved either.
+        '''
+        assert self.built, 'Cluster must be built before taking a snapshot'
+        assert not self.dry_run_finished, 'Network plan was dumped with dry run, builder can only be destroyed'
+        os.makedirs(path, exist_ok=True)
+        nodes = self.controls + self.workers
+        snapshot = {
+            'topology_hash': self._get_topology_hash(),
+            'api_server_address': kindutils.get_api_server_address(self.name),
+            'nodes': {node.name: {
+                'container_name': node.internal_node_name,
+                'role': 'control-plane' if node.name in self.control_nodes else 'worker',
+                'image': f'{self._SNAPSHOT_IMAGE_REPOSITORY}:{self.name}-{node.internal_node_name}',
+                'ipv4': node.internal_cluster_iface.ipv4,
+                'var_archive': f'{node.name}.tar'
+            } for node in nodes}
+        }
+
+        logger.info(f'Taking snapshot of {len(nodes)} nodes...')
+        with ThreadPoolExecutor(max_workers=min(self._MAX_POOL_SIZE, len(nodes))) as executor:
+            self._await_tasks([executor.submit(
+                kindutils.snapshot_node, meta['container_name'], meta['image'],
+                os.path.join(path, meta['var_archive'])) for meta in snapshot['nodes'].values()])
+
+        with open(os.path.join(path, self._SNAPSHOT_METADATA_FILENAME), 'w') as f:
+            json.dump(snapshot, f, indent=2)
+        logger.info(f'Snapshot written to {path}')
+
+    def restore(self, path: str):
+        '''Builds cluster from snapshot taken of a cluster with the same topology'''
+        with open(os.path.join(path, self._SNAPSHOT_METADATA_FILENAME)) as f:
+            snapshot = json.load(f)
+        assert snapshot['topology_hash'] == self._get_topology_hash(), \
+            'Snapshot was taken of a cluster with different topology'
+        assert set(snapshot['nodes']) == set(self.control_nodes) | set(self.worker_nodes), \
+            'Snapshot was taken of a cluster with different nodes'
+
+        self.snapshot_to_restore = (path, snapshot)
+        self.build()
+
+    @_using_ip_backend
+    def scale_out(self):
+        '''
+        Joins workers added after build to the cluster, only the new nodes are initialized and
+        only connections between new and existing nodes are set up.
+        '''
+        assert self.built, 'Cluster must be built before scaling out'
+        assert not self.dry_run_finished, 'Network plan was dumped with dry run, builder can only be destroyed'
+        new_workers = [node for node in self.workers if node.container_id is None]
+        if not new_workers:
+            logger.warn('No new workers to add')
+            return
+        self._assert_node_count()
+
+        logger.info(f'Scaling out cluster by {len(new_workers)} workers...')
+        perf.reset()
+        with perf.phase('join_nodes'):
+            self._try_requesting_more_OS_resources_if_needed()
+            self._join_workers(new_workers)
+
+        with perf.phase('init_nodes'):
+            self._init_nodes(new_workers)
+
+        self._setup_networking(new_workers)
+        with perf.phase('setup_p4_nics'):
+            self._setup_p4_nics(new_workers)
+
         if self.internet_access_requested:
-            self.internet_access_mgr.teardown_internet_access()
+            with perf.phase('provision_internet_access'):
+                self.internet_access_mgr.add_cluster_nodes(new_workers)
 
-        for iface, routes in self.simple_host_connections:
-            for route in routes:
-                iputils.del_route(iputils.HOST_NS, route, iface.ipv4)
-            iputils.delete_iface(iputils.HOST_NS, iface)
+        self._write_kinda_config()
+        self._write_cluster_shape()
+        self._write_performance_report()
+        logger.info("Cluster scaled out")
+
+    @_using_ip_backend
+    def scale_in(self, *worker_names: str):
+        '''Removes workers from built cluster together with their tunnels and address translations on remaining nodes'''
+        assert self.built, 'Cluster must be built before scaling in'
+        assert not self.dry_run_finished, 'Network plan was dumped with dry run, builder can only be destroyed'
+        for name in worker_names:
+            assert name in self.worker_nodes, f'{name} is not a worker of this cluster'
+
+        removed = [self.worker_nodes[name] for name in worker_names]
+        remaining = [node for node in self.controls + self.workers if node not in removed]
+        logger.info(f'Scaling in cluster by {len(removed)} workers...')
+
+        with iputils.batched():
+            self._remove_pod_traffic_tunneling(removed, remaining)
+            self._remove_cluster_address_translations(removed, remaining)
+            self._remove_bridge_slaves(removed)
+        if self.internet_access_requested:
+            self.internet_access_mgr.remove_cluster_nodes(removed)
+        self._discard_network_operations(removed)
 
-        kindutils.delete_cluster(self.name)
-        self._clear_attached_namespaces()
+        for node in removed:
+            kubectlutils.delete_node(node.internal_node_name)
+            iputils.delete_namespace(iputils.HOST_NS, node.netns_name)
+            containerutils.remove_container(node.container_id)
+
+            if (task := self.connections.pop(node.name, None)) is not None:
+                self.ipam.release(task.container_iface.cidr, task.container_iface.name)
+            self.bridge_slaves.pop(node.name, None)
+            del self.worker_nodes[node.name]
+            del self.node_numbers[node.name]
 
-    def connect_with_container(self, node_name: str, node_iface: NetIface, container_id: str, container_iface: NetIface,
+        self._write_kinda_config()
+        self._write_cluster_shape()
+        logger.info("Cluster scaled in")
+
+    @_using_ip_backend
+    def destroy(self):
+        '''Kind cluster and registered teardown tasks are removed concurrently with host side networking'''
+        if self.dry_run_finished:
+            # dry run didn't create anything, cluster of the same name may belong to someone else
+            with ThreadPoolExecutor(max_workers=len(self.teardown_tasks) + 1) as executor:
+                self._await_tasks([executor.submit(task) for task in self.teardown_tasks])
+            return
+        with ThreadPoolExecutor(max_workers=len(self.teardown_tasks) + 1) as executor:
+            tasks = [executor.submit(task) for task in self.teardown_tasks]
+            if self.keep_alive:
+                logger.info(f'Keeping cluster {self.name} alive for the next build')
+            else:
+                tasks.append(executor.submit(kindutils.delete_cluster, self.name))
+
+            if self.internet_access_requested:
+                self.internet_access_mgr.teardown_internet_access()
+
+            with iputils.batched():
+                for iface, routes in self.simple_host_connections:
+                    for route in routes:
+                        iputils.del_route(iputils.HOST_NS, route, iface.ipv4)
+                    iputils.delete_iface(iputils.HOST_NS, iface)
+
+            # netlink sockets would keep deleted namespaces alive
+            iputils.close_backend()
+            nsagent.stop_all_agents()
+            self._clear_attached_namespaces()
+            self._await_tasks(tasks)
+
+    def connect_with_container(self, node_name: str, node_iface: NetIface, container_id: ContainerRef, container_iface: NetIface,
                                add_default_route_via_container: bool = True, as_bridge_in_container: bool = False):
         assert node_name not in [x.node_name for x in self.connect_tasks], \
             f'Node {node_name} can have at most one connection with virtualized network'
@@ -147,16 +488,16 @@ class ClusterBuilder:
         self._assert_valid(node_iface)
         self._assert_valid(container_iface)
         self._assert_valid_container_iface_name(container_iface)
+        self.ipam.reserve(container_iface.cidr, container_iface.name)
 
         self.connect_tasks.append(ConnectionTask(
             node_name, node_iface, container_id, container_iface, add_default_route_via_container, as_bridge_in_container))
 
-    def enable_internet_access_via(self, container_id: str):
-        self.internet_access_mgr.internet_gateway_container_netns = self._attach_container_namespace_to_host(
-            container_id)
+    def enable_internet_access_via(self, container_id: ContainerRef):
+        self.internet_gateway_container_id = container_id
         self.internet_access_requested = True
 
-    def establish_simple_host_connection(self, container_id: str, host_iface: NetIface, container_iface: NetIface,
+    def establish_simple_host_connection(self, container_id: ContainerRef, host_iface: NetIface, container_iface: NetIface,
                                          routes: list[str] = None, set_ip_in_container: bool = False):
         container_ns = self._attach_container_namespace_to_host(container_id)
         iputils.create_veth_pair(iputils.HOST_NS, host_iface, container_iface)
@@ -182,85 +523,235 @@ class ClusterBuilder:
         os.system("sudo sysctl fs.inotify.max_user_watches=524288")
         os.system("sudo sysctl fs.inotify.max_user_instances=512")
 
-    def _setup_connections(self):
-        bridge_to_slaves: dict[BridgeInfo, list[NetIface]] = {}
-
-        for node_name, node_iface, container_id, container_iface, \
-                add_default_route_via_container, as_bridge_in_container in self.connect_tasks:
-            node = self._get_node(node_name)
-            node.net_iface = node_iface
-
-            container_ns = self._attach_container_namespace_to_host(
-                container_id)
-            if as_bridge_in_container:
-                bridge_slave_iface = self._create_bridge_and_get_slave_meta(
-                    container_ns, container_iface, bridge_to_slaves)
-
-            if node.has_p4_nic:
-                iputils.connect_namespaces(
-                    node.netns_name, container_ns, node.p4_net_iface, bridge_slave_iface, set_up=True)
-                iputils.create_veth_pair(
-                    node.netns_name, node.p4_internal_iface, node_iface, set_up=True)
+    def _assert_node_count(self):
+        assert len(self.worker_nodes) + len(self.control_nodes) <= self.max_nodes, \
+            f'Max nodes count exceeded, ({self.max_nodes})' + \
+            ('' if self.flow_based_tunneling else ', enable flow-based tunneling to build larger clusters')
+
+    def _setup_networking(self, new_nodes: list[K8sNode] = None, reconcile_plan: bool = False):
+        with perf.phase('compile_network_plan'):
+            plan = self._compile_network_plan(new_nodes)
+            # whole plan is kept, so that it can be reapplied even if some operations were skipped now
+            recorded_plan = plan.copy()
+            if self.reconcile_network_state or reconcile_plan:
+                reconcile.reconcile_plan(
+                    plan, (self._TUNNEL_IFACE_PREFIX,), self._MAX_POOL_SIZE, self.network_plans)
+        if self.network_plan_path is not None:
+            plan.dump(self.network_plan_path)
+            logger.info(f'Network plan written to {self.network_plan_path}')
+        with perf.phase('execute_network_plan'):
+            if self.event_loop is not None:
+                self._run_on_event_loop(self._execute_network_plan_async(plan, new_nodes))
             else:
-                iface = bridge_slave_iface if as_bridge_in_container else container_iface
-                iputils.connect_namespaces(
-                    node.netns_name, container_ns, node_iface, iface, set_up=True)
-
-            if as_bridge_in_container:
-                iputils.assign_bridge_master(
-                    container_ns, bridge_slave_iface, container_iface)
-            iputils.assign_ipv4(node.netns_name, node_iface)
-
-            for iface, netns in zip((node_iface, container_iface), (node.netns_name, container_ns)):
-                if iface.mac is not None:
-                    iputils.assign_mac(netns, iface)
-
-            if container_iface.egress_traffic_control is not None:
-                iface = bridge_slave_iface if as_bridge_in_container else container_iface
-                iputils.apply_egress_traffic_control(container_ns, iface)
-            if node.net_iface.egress_traffic_control is not None:
-                external_iface = node.net_iface
-                if node.has_p4_nic:
-                    external_iface = node.p4_net_iface
-                    node.p4_net_iface.egress_traffic_control = node.net_iface.egress_traffic_control
-                iputils.apply_egress_traffic_control(
-                    node.netns_name, external_iface)
-
-            # checksum offloading leads to invalid TCP checksums which prevent iptables from
-            # NATing such packets, making TCP broken in the cluster
-            containerutils.turn_off_tcp_checksum_offloading(
-                node.container_id, node.net_iface.name)
-
-            if add_default_route_via_container:
-                node.default_route_ipv4 = container_iface.ipv4
-                iputils.add_default_route(
-                    node.netns_name, container_iface.ipv4)
+                plan.execute(self._MAX_POOL_SIZE)
+                self._turn_off_tcp_checksum_offloading(new_nodes)
+            self.network_plans.append(recorded_plan)
+
+    def _dump_network_plan_dry_run(self):
+        logger.info('Compiling network plan without creating the cluster...')
+        for idx, node in enumerate(self.controls + self.workers):
+            # gateway takes the first address of kind network
+            internal_address = Cidr.from_int(self._DRY_RUN_KIND_NETWORK.first + 2 + idx,
+                                             self._DRY_RUN_KIND_NETWORK.netmask)
+            pod_cidr = Cidr.from_int(POD_CIDR.first + (idx << (32 - self._DRY_RUN_NODE_POD_CIDR_SIZE)),
+                                     self._DRY_RUN_NODE_POD_CIDR_SIZE)
+            self.node_initializer.assume_node_state(node, internal_address, [pod_cidr])
+
+        self._compile_network_plan().dump(self.network_plan_path)
+        self.dry_run_finished = True
+        logger.info(f'Network plan written to {self.network_plan_path}')
+
+    async def _execute_network_plan_async(self, plan: iputils.NetworkPlan, new_nodes: list[K8sNode] = None):
+        await plan.execute_async()
+        nodes = new_nodes if new_nodes is not None else self.controls + self.workers
+        await aio.gather(containerutils.turn_off_tcp_checksum_offloading_async(node.container_id, node.net_iface.name)
+                         for node in nodes if node.net_iface is not None)
+
+    def _run_on_event_loop(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        return asyncio.run_coroutine_threadsafe(coro, self.event_loop).result()
+
+    def _compile_network_plan(self, new_nodes: list[K8sNode] = None) -> iputils.NetworkPlan:
+        # container namespaces are attached while compiling, everything else is only recorded
+        with iputils.planned() as plan:
+            self._setup_connections()
+            self._update_cluster_address_translations(new_nodes)
+            self._setup_pod_traffic_tunneling(new_nodes)
+        return plan
+
+    def _get_node_pairs(self, new_nodes: list[K8sNode] = None) -> list[tuple[K8sNode, K8sNode]]:
+        '''Unordered pairs of nodes with at least one new node, all pairs if new_nodes is None'''
+        nodes = self.workers + self.controls
+        if new_nodes is None:
+            return list(it.combinations(nodes, 2))
+        existing_nodes = [node for node in nodes if node not in new_nodes]
+        return [*it.combinations(new_nodes, 2), *it.product(new_nodes, existing_nodes)]
+
+    def _setup_connections(self):
+        if not self.network_plan_dry_run:
+            # containers targeted by connections are inspected at once, many tasks usually share a container
+            containerutils.containers.prefetch(
+                [self._resolve_container_ref(task.container_id) for task in self.connect_tasks])
+        with iputils.batched():
+            for task in self.connect_tasks:
+                self._setup_connection(task, self.bridge_to_slaves)
+                self.connections[task.node_name] = task
 
         self.connect_tasks.clear()
 
-    def _setup_pod_traffic_tunneling(self):
-        node_nums = {node.name: idx for idx,
-                     node in enumerate(self.controls + self.workers)}
+    def _turn_off_tcp_checksum_offloading(self, nodes: list[K8sNode] = None):
+        for node in nodes if nodes is not None else self.controls + self.workers:
+            if node.net_iface is not None:
+                # checksum offloading leads to invalid TCP checksums which prevent iptables from
+                # NATing such packets, making TCP broken in the cluster
+                containerutils.turn_off_tcp_checksum_offloading(
+                    node.container_id, node.net_iface.name)
+
+    def _setup_connection(self, task: ConnectionTask, bridge_to_slaves: dict[BridgeInfo, list[NetIface]]):
+        node_name, node_iface, container_id, container_iface, \
+            add_default_route_via_container, as_bridge_in_container = task
+        node = self._get_node(node_name)
+        node.net_iface = node_iface
+
+        container_ns = self._attach_container_namespace_to_host(
+            container_id)
+        if as_bridge_in_container:
+            bridge_slave_iface = self._create_bridge_and_get_slave_meta(
+                container_ns, container_iface, bridge_to_slaves)
+            self.bridge_slaves[node_name] = (BridgeInfo(container_ns, container_iface.name), bridge_slave_iface)
+
+        if node.has_p4_nic:
+            iputils.connect_namespaces(
+                node.netns_name, container_ns, node.p4_net_iface, bridge_slave_iface, set_up=True)
+            iputils.create_veth_pair(
+                node.netns_name, node.p4_internal_iface, node_iface, set_up=True)
+        else:
+            iface = bridge_slave_iface if as_bridge_in_container else container_iface
+            iputils.connect_namespaces(
+                node.netns_name, container_ns, node_iface, iface, set_up=True)
+
+        if as_bridge_in_container:
+            iputils.assign_bridge_master(
+                container_ns, bridge_slave_iface, container_iface)
+        iputils.assign_ipv4(node.netns_name, node_iface)
+
+        for iface, netns in zip((node_iface, container_iface), (node.netns_name, container_ns)):
+            if iface.mac is not None:
+                iputils.assign_mac(netns, iface)
+
+        if container_iface.egress_traffic_control is not None:
+            iface = bridge_slave_iface if as_bridge_in_container else container_iface
+            iputils.apply_egress_traffic_control(container_ns, iface)
+        if node.net_iface.egress_traffic_control is not None:
+            external_iface = node.net_iface
+            if node.has_p4_nic:
+                external_iface = node.p4_net_iface
+                node.p4_net_iface.egress_traffic_control = node.net_iface.egress_traffic_control
+            iputils.apply_egress_traffic_control(
+                node.netns_name, external_iface)
+
+        if add_default_route_via_container:
+            node.default_route_ipv4 = container_iface.ipv4
+            iputils.add_default_route(
+                node.netns_name, container_iface.ipv4)
+
+    def _setup_pod_traffic_tunneling(self, new_nodes: list[K8sNode] = None):
+        for node in new_nodes if new_nodes is not None else self.workers + self.controls:
+            node.pod_mtu = self._get_attachment_mtu(node) - self.tunnel_encapsulation.overhead
+
+        if self.flow_based_tunneling:
+            self._setup_flow_based_pod_traffic_tunneling(new_nodes)
+            return
 
-        for node1, node2 in it.combinations(self.workers + self.controls, 2):
-            tun1, tun2 = self._create_tunnel_meta(node1, node2, node_nums)
-            for src, dst, tun in [(node1, node2, tun1), (node2, node1, tun2)]:
+        with iputils.batched():
+            if self.tunnel_encapsulation == TunnelEncapsulation.GRE_FOU:
+                for node in new_nodes if new_nodes is not None else self.workers + self.controls:
+                    iputils.add_fou_receive_port(node.netns_name, self._FOU_PORT)
+
+            for node1, node2 in self._get_node_pairs(new_nodes):
+                tun1, tun2 = self._create_tunnel_meta(node1, node2)
+                self.tunnels[(node1.name, node2.name)] = (tun1, tun2)
+                for src, dst, tun, peer_tun in [(node1, node2, tun1, tun2), (node2, node1, tun2, tun1)]:
+                    self._create_tunnel(src, dst, tun, vni=self._get_tunnel_vni(tun1))
+
+                    # vxlan devices resolve next hop with ARP, so it has to be the other end of the tunnel
+                    next_hop = peer_tun.ipv4 if self.tunnel_encapsulation == TunnelEncapsulation.VXLAN else tun.ipv4
+                    for subnet in self._get_tunnel_target_routes(dst):
+                        iputils.add_route(src.netns_name, subnet, next_hop)
+
+    def _create_tunnel(self, src: K8sNode, dst: K8sNode, tun: NetIface, vni: int):
+        src_ipv4, dst_ipv4 = src.net_iface.ipv4, dst.net_iface.ipv4
+        match self.tunnel_encapsulation:
+            case TunnelEncapsulation.GRE:
                 iputils.create_gre_tunnel(
-                    src.netns_name, tun, src.net_iface.ipv4, dst.net_iface.ipv4, set_up=True)
-
-                for pod_cidr in dst.pod_cidrs:
-                    # TODO drop that requirement, although it shouldn't be a problem in practice
-                    assert pod_cidr.netmask == 24, f'Only /24 pod cidrs are supported, got {pod_cidr.netmask}'
-
-                    # Kind quite successfully manages to assure that route to pod cidr via node.internal_cluster_interface
-                    # exists, so we can't simply delete it and put a different route, what we can do instead is add
-                    # two equivalent, but more specific routes that will be preferred in the routing process
-                    subnet1, subnet2 = self._get_tunnel_target_routes(
-                        pod_cidr.ipv4)
-                    iputils.add_route(
-                        src.netns_name, f'{subnet1}/25', tun.ipv4)
-                    iputils.add_route(
-                        src.netns_name, f'{subnet2}/25', tun.ipv4)
+                    src.netns_name, tun, src_ipv4, dst_ipv4, set_up=True)
+            case TunnelEncapsulation.GRE_FOU:
+                iputils.create_fou_gre_tunnel(
+                    src.netns_name, tun, src_ipv4, dst_ipv4, self._FOU_PORT, set_up=True)
+            case TunnelEncapsulation.VXLAN:
+                iputils.create_vxlan_tunnel(
+                    src.netns_name, tun, src_ipv4, dst_ipv4, vni, self._VXLAN_PORT, set_up=True)
+
+    def _setup_flow_based_pod_traffic_tunneling(self, new_nodes: list[K8sNode] = None):
+        assert self.tunnel_encapsulation == TunnelEncapsulation.GRE, \
+            'Flow-based tunneling supports only GRE encapsulation'
+
+        with iputils.batched():
+            for node in new_nodes if new_nodes is not None else self.workers + self.controls:
+                iputils.create_external_gre_tunnel(
+                    node.netns_name, self._get_flow_based_tunnel_iface(node), set_up=True)
+
+            for node1, node2 in self._get_node_pairs(new_nodes):
+                for src, dst in [(node1, node2), (node2, node1)]:
+                    for subnet in self._get_tunnel_target_routes(dst):
+                        iputils.add_encap_route(src.netns_name, subnet, self._get_flow_based_tunnel_iface(src),
+                                                dst.net_iface.ipv4, min(src.pod_mtu, dst.pod_mtu))
+
+    def _remove_pod_traffic_tunneling(self, removed: list[K8sNode], remaining: list[K8sNode]):
+        if self.flow_based_tunneling:
+            for src in remaining:
+                for dst in removed:
+                    for subnet in self._get_tunnel_target_routes(dst):
+                        iputils.del_encap_route(
+                            src.netns_name, subnet, self._get_flow_based_tunnel_iface(src))
+            return
+
+        removed_names = {node.name for node in removed}
+        for (name1, name2), (tun1, tun2) in list(self.tunnels.items()):
+            if name1 not in removed_names and name2 not in removed_names:
+                continue
+            # routes through the tunnel are removed together with it
+            if name1 not in removed_names:
+                iputils.delete_iface(self._get_node(name1).netns_name, tun1)
+            if name2 not in removed_names:
+                iputils.delete_iface(self._get_node(name2).netns_name, tun2)
+            self.ipam.release(iputils.get_subnet(tun1.cidr), (name1, name2))
+            del self.tunnels[(name1, name2)]
+
+    def _remove_bridge_slaves(self, removed: list[K8sNode]):
+        '''Deleting slave in container namespace removes its veth peer in node namespace as well'''
+        for node in removed:
+            if node.name not in self.bridge_slaves:
+                continue
+            bridge_info, slave_iface = self.bridge_slaves[node.name]
+            iputils.delete_iface(bridge_info.container_ns, slave_iface)
+            self.bridge_to_slaves[bridge_info].remove(slave_iface)
+
+    def _discard_network_operations(self, removed: list[K8sNode]):
+        '''Operations of removed nodes and their peers' operations targeting them won't be reapplied'''
+        removed_netns = {node.netns_name for node in removed}
+        tokens = set()
+        for node in removed:
+            tokens.update([f'{self._TUNNEL_IFACE_PREFIX}{self.node_numbers[node.name]}',
+                           node.internal_cluster_iface.ipv4, *self._get_tunnel_target_routes(node)])
+            if node.net_iface is not None:
+                tokens.add(node.net_iface.ipv4)
+            if node.name in self.bridge_slaves:
+                tokens.add(self.bridge_slaves[node.name][1].name)
+        for plan in self.network_plans:
+            plan.discard(lambda netns, args: netns in removed_netns or any(arg in tokens for arg in args))
+
+    def _get_flow_based_tunnel_iface(self, node: K8sNode) -> NetIface:
+        return NetIface(f'{self._TUNNEL_IFACE_PREFIX}ext', None, None, mtu=node.pod_mtu)
 
     def _run_cluster(self):
         assert len(
@@ -268,42 +759,277 @@ class ClusterBuilder:
 
         with tempfile.NamedTemporaryFile() as kind_cfg_file:
             kindutils.prepare_kind_cfg_file(kind_cfg_file, len(
-                self.control_nodes), len(self.worker_nodes))
+                self.control_nodes), len(self.worker_nodes), self._prepare_node_image())
             kindutils.run_cluster(
                 self.name, kind_cfg_file.name, self._KIND_TIMEOUT_SECONDS)
 
-    def _update_cluster_address_translations(self):
-        # TODO there is still some IPv6 traffic routed via host, consider adding ipv6in4 tunneling
-        if self.route_kubectl_traffic_through_virtual_network:
-            for node1, node2 in it.permutations(self.workers + self.controls, 2):
-                iputils.add_dnat_rule(
-                    node1.netns_name, node1.internal_cluster_iface.ipv4,
-                    node2.internal_cluster_iface.ipv4, node2.net_iface.ipv4)
+    def _bring_up_cluster_pipelined(self):
+        '''
+        Kind creates all node containers before running kubeadm, so container part of node initialization
+        starts as soon as they exist and kubernetes part as soon as each node registers with pod cidrs.
+        '''
+        assert len(
+            self.control_nodes) > 0, 'At least 1 control plane node is required'
+        nodes = self.controls + self.workers
+        deadline = time.monotonic() + self._KIND_TIMEOUT_SECONDS + self._NODE_INIT_TIMEOUT_SECONDS
 
-                if node1.default_route_ipv4 is not None:
-                    iputils.add_route(
-                        node1.netns_name, node2.internal_cluster_iface.ipv4, node1.default_route_ipv4)
+        with tempfile.NamedTemporaryFile() as kind_cfg_file, \
+                ThreadPoolExecutor(max_workers=min(self._MAX_POOL_SIZE, len(nodes) + 1)) as executor:
+            kindutils.prepare_kind_cfg_file(kind_cfg_file, len(
+                self.control_nodes), len(self.worker_nodes), self._prepare_node_image())
+            kind_task = executor.submit(
+                kindutils.run_cluster, self.name, kind_cfg_file.name, self._KIND_TIMEOUT_SECONDS)
+
+            while not self.node_initializer.node_containers_created(self.name, len(nodes)):
+                self._assert_bring_up_progress([kind_task], deadline)
+                time.sleep(self._BRING_UP_POLL_INTERVAL_SECONDS)
+
+            self.node_initializer.assing_container_ids(
+                self.name, self.workers, self.controls)
+            container_tasks = {node.name: executor.submit(
+                self.node_initializer.init_node_container, node) for node in nodes}
+            internals_tasks: list[Future[Any]] = []
+
+            pending = list(nodes)
+            kubeconfig_ready = False
+            while pending:
+                self._assert_bring_up_progress(
+                    [kind_task, *container_tasks.values(), *internals_tasks], deadline)
+                if not kubeconfig_ready:
+                    kubeconfig_ready = kindutils.update_kubectl_cfg(
+                        self.name, kindutils.KUBECONFIG_PATH)
+                if kubeconfig_ready and self._try_refreshing_node_info():
+                    for node in [node for node in pending if container_tasks[node.name].done()
+                                 and self.node_initializer.is_node_registered(node)]:
+                        pending.remove(node)
+                        internals_tasks.append(executor.submit(
+                            self.node_initializer.init_node_kubernetes_internals, node))
+                if pending:
+                    time.sleep(self._BRING_UP_POLL_INTERVAL_SECONDS)
+
+            self._await_tasks([kind_task, *container_tasks.values(), *internals_tasks],
+                              max(0, deadline - time.monotonic()))
+
+        # kind rewrites kubeconfig when it finishes
+        self._update_kubectl_cfg()
 
-            for node in self.workers + self.controls:
-                # DNAT isn't applied for previously established connections
-                iputils.flush_established_connections(node.netns_name)
+    def _prepare_node_image(self) -> str | None:
+        if not self.use_prebaked_node_image:
+            return self.base_node_image
+        with perf.phase('prepare_node_image'):
+            return self.node_initializer.prepare_node_image(self.base_node_image) or self.base_node_image
 
-    def _init_nodes(self):
-        self.node_initializer.setup_node_info()
-        self.node_initializer.assing_container_ids(
-            self.name, self.workers, self.controls)
+    def _get_reusable_cluster_shape(self) -> dict[str, Any] | None:
+        if self.name not in kindutils.get_clusters():
+            return None
+        try:
+            with open(self._CLUSTER_SHAPE_PATH) as f:
+                shape = json.load(f)
+        except (OSError, ValueError):
+            shape = None
 
-        pool_size = min(self._MAX_POOL_SIZE, len(self.controls + self.workers))
+        if shape is not None and self._has_same_shape(shape):
+            return shape
 
-        with ThreadPoolExecutor(max_workers=pool_size) as executor:
-            control_tasks = [executor.submit(
-                self.node_initializer.init_control, control) for control in self.controls]
+        logger.info(f'Running cluster {self.name} has different shape, recreating it')
+        kindutils.delete_cluster(self.name)
+        return None
+
+    def _has_same_shape(self, shape: dict[str, Any]) -> bool:
+        '''
+        Nodes must run in the same containers with the same roles and P4 NICs (bmv2 is installed only on nodes
+        with them) and have the same pod cidrs as kubernetes assigns to them now, tunneling must be the same as well.
+        '''
+        nodes = self.controls + self.workers
+        if shape.get('name') != self.name or \
+                shape.get('tunnel_encapsulation') != self.tunnel_encapsulation.value or \
+                shape.get('flow_based_tunneling') != self.flow_based_tunneling or \
+                set(shape.get('nodes', {})) != {node.name for node in nodes}:
+            return False
+        container_ids = containerutils.list_container_ids(f'{kindutils.KIND_CLUSTER_LABEL}={self.name}')
+        if {container_id[:12] for container_id in container_ids} != \
+                {node_shape['container_id'] for node_shape in shape['nodes'].values()}:
+            return False
 
-            worker_tasks = [executor.submit(
-                self.node_initializer.init_worker, worker) for worker in self.workers]
+        self._update_kubectl_cfg()
+        node_catalog = kubectlutils.get_node_catalog()
+        for node in nodes:
+            node_shape = shape['nodes'][node.name]
+            node_meta = node_catalog.by_name(node_shape['internal_node_name'])
+            pod_cidrs = [] if node_meta is None else [f'{ipv4}/{netmask}' for ipv4, netmask in node_meta.pod_cidrs]
+            if node_shape['role'] != self._get_node_role(node) or node_shape['has_p4_nic'] != node.has_p4_nic or \
+                    node_meta is None or pod_cidrs != node_shape['pod_cidrs']:
+                return False
+        return True
+
+    def _get_node_role(self, node: K8sNode) -> str:
+        return 'control-plane' if node.name in self.control_nodes else 'worker'
+
+    def _reuse_cluster(self, shape: dict[str, Any]):
+        nodes = self.controls + self.workers
+        for node in nodes:
+            node.container_id = shape['nodes'][node.name]['container_id']
+        containerutils.containers.prefetch([node.container_id for node in nodes])
+        gateway_ipv4 = kindutils.get_kind_network_gateway()
+        fou_port = self._FOU_PORT if shape['tunnel_encapsulation'] == TunnelEncapsulation.GRE_FOU.value else None
+
+        with ThreadPoolExecutor(max_workers=min(self._MAX_POOL_SIZE, len(nodes))) as executor:
+            self._await_tasks([executor.submit(
+                self.node_initializer.strip_network_configuration, node,
+                shape['nodes'][node.name]['managed_ifaces'], gateway_ipv4, fou_port) for node in nodes],
+                self._NODE_INIT_TIMEOUT_SECONDS)
+
+        # previous build installed requirements in the same containers, bmv2 on the same nodes as shape matched
+        self.node_initializer.requirements_installed = True
+        self._init_nodes(assign_container_ids=False)
+
+    def _get_managed_ifaces(self, node: K8sNode) -> list[str]:
+        '''Interfaces created by kinda in node namespace'''
+        ifaces = [node.net_iface, node.p4_net_iface, node.p4_internal_iface]
+        for (name1, name2), (tun1, tun2) in self.tunnels.items():
+            if node.name == name1:
+                ifaces.append(tun1)
+            elif node.name == name2:
+                ifaces.append(tun2)
+        if self.flow_based_tunneling:
+            ifaces.append(self._get_flow_based_tunnel_iface(node))
+        return [iface.name for iface in ifaces if iface is not None]
+
+    def _restore_cluster(self, path: str, snapshot: dict[str, Any]):
+        # node containers of a previous cluster would conflict with restored ones
+        kindutils.delete_cluster(self.name)
+        nodes = self.controls + self.workers
+        deadline = time.monotonic() + self._KIND_TIMEOUT_SECONDS + self._NODE_INIT_TIMEOUT_SECONDS
+        # node requirements were installed before the snapshot
+        self.node_initializer.requirements_installed = True
+
+        def restore_node(node: K8sNode):
+            meta = snapshot['nodes'][node.name]
+            node.container_id = kindutils.restore_node(
+                self.name, meta['container_name'], meta['role'], meta['image'], meta['ipv4'],
+                os.path.join(path, meta['var_archive']),
+                snapshot['api_server_address'] if meta['role'] == 'control-plane' else None)
+            self.node_initializer.init_node_container(node)
+
+        with ThreadPoolExecutor(max_workers=min(self._MAX_POOL_SIZE, len(nodes))) as executor:
+            self._await_tasks([executor.submit(restore_node, node) for node in nodes],
+                              max(0, deadline - time.monotonic()))
+
+        # kubelets register with state restored from snapshot, pod cidrs are kept in etcd
+        while not (kindutils.update_kubectl_cfg(self.name, kindutils.KUBECONFIG_PATH)
+                   and self._try_refreshing_node_info()
+                   and all(self.node_initializer.is_node_registered(node) for node in nodes)):
+            self._assert_bring_up_progress([], deadline)
+            time.sleep(self._BRING_UP_POLL_INTERVAL_SECONDS)
+
+        for node in nodes:
+            self.node_initializer.init_node_kubernetes_internals(node)
+
+    def _get_topology_hash(self) -> str:
+        '''
+        Hash of everything that determines the network plan, container ids excluded. Connections count
+        whether already set up or still pending, so built cluster and a builder about to restore it match.
+        '''
+        connection_tasks = [*self.connections.values(), *self.connect_tasks]
+        topology = {
+            'name': self.name,
+            'nodes': sorted([name, name in self.control_nodes, node.has_p4_nic, self.node_numbers[name]]
+                            for name, node in {**self.control_nodes, **self.worker_nodes}.items()),
+            'connections': sorted([task.node_name, dataclasses.astuple(task.node_iface),
+                                   dataclasses.astuple(task.container_iface),
+                                   task.add_default_route_via_container, task.as_bridge_in_container]
+                                  for task in connection_tasks),
+            'flow_based_tunneling': self.flow_based_tunneling,
+            'tunnel_encapsulation': self.tunnel_encapsulation.value,
+            'route_kubectl_traffic_through_virtual_network': self.route_kubectl_traffic_through_virtual_network,
+            'internet_access_requested': self.internet_access_requested
+        }
+        return hashlib.sha256(json.dumps(topology, default=str).encode()).hexdigest()
 
-            self._await_tasks(worker_tasks + control_tasks,
-                              self._NODE_INIT_TIMEOUT_SECONDS)
+    def _try_refreshing_node_info(self) -> bool:
+        try:
+            self.node_initializer.setup_node_info()
+            return True
+        except Exception:
+            # API server isn't reachable yet
+            return False
+
+    def _assert_bring_up_progress(self, tasks: list[Future[Any]], deadline: float):
+        if failed_tasks := [task for task in tasks if task.done() and task.exception() is not None]:
+            ex = failed_tasks[0].exception()
+            logger.error("cluster bring-up failed", exc_info=ex)
+            raise ex
+        if time.monotonic() > deadline:
+            raise Exception("cluster bring-up didn't finish in time")
+
+    def _update_cluster_address_translations(self, new_nodes: list[K8sNode] = None):
+        # TODO there is still some IPv6 traffic routed via host, consider adding ipv6in4 tunneling
+        if self.route_kubectl_traffic_through_virtual_network:
+            node_peers: dict[str, list[K8sNode]] = {}
+            for node1, node2 in self._get_node_pairs(new_nodes):
+                node_peers.setdefault(node1.name, []).append(node2)
+                node_peers.setdefault(node2.name, []).append(node1)
+
+            nodes = [node for node in self.workers + self.controls if node.name in node_peers]
+            # rules of each node are grouped so that they are loaded with a single iptables-restore
+            with iputils.batched():
+                for node1 in nodes:
+                    peers = node_peers[node1.name]
+                    for node2 in peers:
+                        iputils.add_dnat_rule(
+                            node1.netns_name, node1.internal_cluster_iface.ipv4,
+                            node2.internal_cluster_iface.ipv4, node2.net_iface.ipv4)
+
+                    if node1.default_route_ipv4 is not None:
+                        for node2 in peers:
+                            iputils.add_route(
+                                node1.netns_name, node2.internal_cluster_iface.ipv4, node1.default_route_ipv4)
+
+            for node in nodes:
+                # DNAT isn't applied for previously established connections
+                iputils.flush_established_connections(node.netns_name)
+
+    def _remove_cluster_address_translations(self, removed: list[K8sNode], remaining: list[K8sNode]):
+        if self.route_kubectl_traffic_through_virtual_network:
+            for node1 in remaining:
+                for node2 in removed:
+                    iputils.del_dnat_rule(
+                        node1.netns_name, node1.internal_cluster_iface.ipv4,
+                        node2.internal_cluster_iface.ipv4, node2.net_iface.ipv4)
+                    if node1.default_route_ipv4 is not None:
+                        iputils.del_route(
+                            node1.netns_name, node2.internal_cluster_iface.ipv4, node1.default_route_ipv4)
+
+    def _init_nodes(self, new_workers: list[WorkerNode] = None, assign_container_ids: bool = True):
+        self.node_initializer.setup_node_info()
+        if new_workers is None:
+            if assign_container_ids:
+                self.node_initializer.assing_container_ids(
+                    self.name, self.workers, self.controls)
+            controls, workers = self.controls, self.workers
+        else:
+            controls, workers = [], new_workers
+
+        supervisor = TaskSupervisor(self._MAX_POOL_SIZE, self._NODE_TASK_RETRIES, self._NODE_TASK_BACKOFF_SECONDS,
+                                    on_retry=lambda name: self.node_initializer.reset_node(self._get_node(name)))
+        supervisor.run({
+            **{worker.name: partial(self.node_initializer.init_worker, worker) for worker in workers},
+            **{control.name: partial(self.node_initializer.init_control, control) for control in controls},
+        }, self._NODE_INIT_TIMEOUT_SECONDS)
+
+    def _join_workers(self, workers: list[WorkerNode]):
+        container_names = {node.name: kindutils.get_worker_container_name(self.name, node.name) for node in workers}
+
+        def join(node: WorkerNode):
+            node.container_id = kindutils.join_worker_node(
+                self.name, container_names[node.name], self._KIND_TIMEOUT_SECONDS)
+
+        with ThreadPoolExecutor(max_workers=min(self._MAX_POOL_SIZE, len(workers))) as executor:
+            self._await_tasks([executor.submit(join, node) for node in workers],
+                              self._KIND_TIMEOUT_SECONDS)
+
+        kubectlutils.wait_for_pod_cidrs(
+            list(container_names.values()), self._KIND_TIMEOUT_SECONDS)
 
     def _update_kubectl_cfg(self):
         kindutils.update_kubectl_cfg(self.name, kindutils.KUBECONFIG_PATH)
@@ -318,16 +1044,24 @@ class ClusterBuilder:
             if node.netns_name is not None:
                 nss_to_remove.append(node.netns_name)
 
-        for ns in nss_to_remove:
-            iputils.delete_namespace(iputils.HOST_NS, ns)
+        iputils.delete_namespaces(iputils.HOST_NS, nss_to_remove)
+
+    def _resolve_container_ref(self, container_ref: ContainerRef) -> str:
+        return container_ref() if callable(container_ref) else container_ref
 
-    def _attach_container_namespace_to_host(self, container_id: str) -> str:
-        pid = containerutils.get_container_pid(container_id)
+    def _attach_container_namespace_to_host(self, container_ref: ContainerRef) -> str:
+        if self.network_plan_dry_run:
+            # container may not even exist yet, its namespace is named after the reference instead of its pid
+            return self.dry_run_container_netns.setdefault(
+                container_ref, f'ns_container{len(self.dry_run_container_netns)}')
+        pid = containerutils.containers.get_pid(
+            self._resolve_container_ref(container_ref))
         container_ns = containerutils.create_namespace_name(pid)
 
         if container_ns not in self.container_netns:
             self.container_netns.add(container_ns)
             containerutils.attach_netns_to_host(pid, container_ns)
+            nsagent.start_agent(container_ns)
 
         return container_ns
 
@@ -339,62 +1073,80 @@ class ClusterBuilder:
             bridge_to_slaves[bridge_info] = []
             iputils.create_bridge(container_ns, bridge)
 
-        bridge_slave_iface = NetIface(
-            f'{bridge.name}_slave{len(bridge_to_slaves[bridge_info])}', None, None, bridge.egress_traffic_control)
+        # slaves of removed nodes leave gaps, their names can be taken again
+        taken_names = {slave.name for slave in bridge_to_slaves[bridge_info]}
+        slave_name = next(name for n in it.count() if (name := f'{bridge.name}_slave{n}') not in taken_names)
+        bridge_slave_iface = NetIface(slave_name, None, None, bridge.egress_traffic_control)
         bridge_to_slaves[bridge_info].append(bridge_slave_iface)
 
         return bridge_slave_iface
 
-    def _create_tunnel_meta(self, n1: K8sNode, n2: K8sNode, node_enumerations: dict[str, int]) -> tuple[NetIface, NetIface]:
-        d_num = node_enumerations[n2.name]
-        s_num = node_enumerations[n1.name]
-        byte3, byte4 = next(self.tunnel_subnet_generator)
+    def _create_tunnel_meta(self, n1: K8sNode, n2: K8sNode) -> tuple[NetIface, NetIface]:
+        d_num = self.node_numbers[n2.name]
+        s_num = self.node_numbers[n1.name]
+        subnet = self.ipam.allocate(TUN_CIDR, 31, (n1.name, n2.name))
+        mtu = min(n1.pod_mtu, n2.pod_mtu)
 
-        tun1 = NetIface(f'tgre_{d_num}',
-                        f'{TUN_CIDR.first_octet}.{TUN_CIDR.second_octet}.{byte3}.{byte4}', 31)
-        tun2 = NetIface(f'tgre_{s_num}',
-                        f'{TUN_CIDR.first_octet}.{TUN_CIDR.second_octet}.{byte3}.{byte4 + 1}', 31)
+        tun1 = NetIface(f'{self._TUNNEL_IFACE_PREFIX}{d_num}',
+                        iputils.decimal_to_dot_notation(subnet.first), 31, mtu=mtu)
+        tun2 = NetIface(f'{self._TUNNEL_IFACE_PREFIX}{s_num}',
+                        iputils.decimal_to_dot_notation(subnet.first + 1), 31, mtu=mtu)
         return tun1, tun2
 
-    def _get_tunnel_target_routes(self, ipv4: str) -> tuple[str, str]:
-        route_parts = ipv4.split('.')
-        return '.'.join([*route_parts[:3], '0']), '.'.join([*route_parts[:3], '128'])
-
-    def _setup_p4_nics(self):
-        p4_nodes = [node for node in self.controls +
-                    self.workers if node.has_p4_nic and node.p4_params.run_nic]
-        if p4_nodes:
-            with ThreadPoolExecutor(max_workers=min(self._MAX_POOL_SIZE, len(p4_nodes))) as executor:
-                tasks = [executor.submit(
-                    self.node_initializer.run_p4_nic, node) for node in p4_nodes]
-
-                try:
-                    self._await_tasks(tasks, self._NODE_INIT_TIMEOUT_SECONDS)
-                except Exception as e:
-                    logger.error('Failed to setup p4 NICs', exc_info=e)
+    def _get_tunnel_vni(self, tun: NetIface) -> int:
+        # both ends of a tunnel share the /31, its index identifies the tunnel
+        return (tun.cidr.first - TUN_CIDR.first) // 2 + 1
+
+    def _get_attachment_mtu(self, node: K8sNode) -> int:
+        ifaces = [node.net_iface, node.p4_net_iface, node.p4_internal_iface]
+        return min((iface.mtu for iface in ifaces if iface is not None and iface.mtu is not None),
+                   default=self._DEFAULT_MTU)
+
+    def _get_tunnel_target_routes(self, node: K8sNode) -> list[str]:
+        routes = []
+        # tunnels carry IPv4 traffic only
+        for pod_cidr in (cidr for cidr in node.pod_cidrs if not cidr.is_ipv6):
+            # Kind quite successfully manages to assure that route to pod cidr via node.internal_cluster_interface
+            # exists, so we can't simply delete it and put a different route, what we can do instead is add
+            # equivalent, but more specific routes that will be preferred in the routing process
+            routes.extend(cidr.masked_ip for cidr in iputils.get_route_cover(pod_cidr, [pod_cidr]))
+        return routes
+
+    def _setup_p4_nics(self, nodes: list[K8sNode] = None):
+        nodes = nodes if nodes is not None else self.controls + self.workers
+        p4_nodes = [node for node in nodes if node.has_p4_nic and node.p4_params.run_nic]
+        supervisor = TaskSupervisor(self._MAX_POOL_SIZE, self._NODE_TASK_RETRIES, self._NODE_TASK_BACKOFF_SECONDS,
+                                    on_retry=lambda name: self.node_initializer.stop_p4_nic(self._get_node(name)))
+        try:
+            supervisor.run({node.name: partial(self.node_initializer.run_p4_nic, node) for node in p4_nodes},
+                           self._NODE_INIT_TIMEOUT_SECONDS)
+        except TasksFailedError as e:
+            logger.error(f'Failed to setup p4 NICs\n{e}')
 
     def _await_tasks(self, tasks: list[Future[Any]], timeout: float = None):
-        tasks_result = wait(tasks, timeout=timeout)
+        tasks_result = wait(tasks, timeout=timeout, return_when=FIRST_EXCEPTION)
 
-        if tasks_result.not_done:
-            raise Exception("some tasks didn't finish")
-
-        if failed_tasks := [task for task in tasks if task.exception() is not None]:
+        if failed_tasks := [task for task in tasks_result.done
+                            if not task.cancelled() and task.exception() is not None]:
+            # fail fast, tasks that haven't started yet won't be run
+            for task in tasks_result.not_done:
+                task.cancel()
             ex = failed_tasks[0].exception()
             logger.error("some tasks finished with an exception", exc_info=ex)
             raise ex
 
+        if tasks_result.not_done:
+            raise Exception("some tasks didn't finish")
+
     def _assert_valid(self, iface: NetIface):
-        for net in self._FORBIDDEN_NETWORKS:
-            assert not iputils.is_in_same_subnet(net, iface.cidr), \
-                f'Network {iface.ipv4} is forbidden, pick other one not in {self._FORBIDDEN_NETWORKS}'
+        assert self.ipam.find_forbidden_overlap(iface.cidr) is None, \
+            f'Network {iface.ipv4} is forbidden, pick other one not in {self._FORBIDDEN_NETWORKS}'
 
     def _assert_valid_container_iface_name(self, container_iface: NetIface):
-        for task in self.connect_tasks:
-            if iputils.is_in_same_subnet(task.container_iface.cidr, container_iface.cidr):
-                assert task.container_iface.name == container_iface.name, \
-                    'Container interface name must be the same if 2 nodes connect with it from same network\n' \
-                    f'Got {task.container_iface} and {container_iface}'
+        for cidr, name in self.ipam.find_used_overlaps(container_iface.cidr):
+            assert name == container_iface.name, \
+                'Container interface name must be the same if 2 nodes connect with it from same network\n' \
+                f'Got {name} ({cidr.masked_ip}) and {container_iface}'
 
     def _write_kinda_config(self):
         cfg = {}
@@ -404,6 +1156,13 @@ class ClusterBuilder:
         cfg['naming'] = {
             node.internal_node_name: node.name for node in self.workers + self.controls
         }
+        # lets CLI resolve nodes by InternalIP, hostname or pod cidr as well
+        cfg['addresses'] = {
+            address: node.name for node in self.workers + self.controls if node.internal_node_meta is not None
+            for address in [*node.internal_node_meta.internal_ips, node.internal_node_meta.hostname,
+                            *(f'{ipv4}/{netmask}' for ipv4, netmask in node.internal_node_meta.pod_cidrs)]
+            if address is not None
+        }
 
         try:
             with open(self._KINDA_CONFIG_PATH, 'w') as f:
@@ -412,7 +1171,36 @@ class ClusterBuilder:
             logger.error(
                 'Failed to write kinda config, CLI won\'t work as expected', exc_info=e)
 
-    def _create_tunnel_subnet_generator(self) -> Generator[tuple[int, int], None, None]:
-        for subnet in range(0, 255):
-            for i in range(0, 253, 2):
-                yield subnet, i
+    def _write_cluster_shape(self):
+        if not self.keep_alive:
+            return
+        shape = {
+            'name': self.name,
+            'tunnel_encapsulation': self.tunnel_encapsulation.value,
+            'flow_based_tunneling': self.flow_based_tunneling,
+            'nodes': {node.name: {
+                'container_id': node.container_id,
+                'role': self._get_node_role(node),
+                'has_p4_nic': node.has_p4_nic,
+                'internal_node_name': node.internal_node_name,
+                'pod_cidrs': [f'{ipv4}/{netmask}' for ipv4, netmask in node.pod_cidrs],
+                'managed_ifaces': self._get_managed_ifaces(node)
+            } for node in self.controls + self.workers}
+        }
+
+        try:
+            with open(self._CLUSTER_SHAPE_PATH, 'w') as f:
+                json.dump(shape, f)
+        except Exception as e:
+            logger.error(
+                'Failed to write cluster shape, cluster won\'t be reused', exc_info=e)
+
+    def _write_performance_report(self):
+        try:
+            perf.write_report(self._PERF_REPORT_JSON_PATH,
+                              self._PERF_REPORT_CSV_PATH)
+            perf.write_trace(self._PERF_TRACE_PATH)
+            logger.info(
+                f'Build performance report written to {self._PERF_REPORT_JSON_PATH}, trace to {self._PERF_TRACE_PATH}')
+        except Exception as e:
+            logger.error('Failed to write build performance report', exc_info=e)
@@ -1,7 +1,8 @@
 import util.iputils as iputils
 from core.constants import KIND_CIDR, POD_CIDR, TUN_CIDR
 from core.K8sNode import K8sNode
-from util.iputils import NetIface
+from util.ipam import Ipam
+from util.iputils import Cidr, NetIface
 from util.logger import logger
 
 
@@ -22,12 +23,30 @@ class InternetAccessManager:
         self._add_default_route_on_target()
         self._setup_address_translations()
 
+    def add_cluster_nodes(self, nodes: list[K8sNode]):
+        with iputils.batched():
+            for node in nodes:
+                iputils.masquerade_internet_facing_traffic(
+                    self.internet_gateway_container_netns, node.net_iface.cidr, self.container_veth)
+        self.cluster_nodes.extend(nodes)
+
+    def remove_cluster_nodes(self, nodes: list[K8sNode]):
+        with iputils.batched():
+            for node in nodes:
+                # each node has its own copy of the rule, nodes from the same network keep theirs
+                iputils.masquerade_internet_facing_traffic(
+                    self.internet_gateway_container_netns, node.net_iface.cidr, self.container_veth, False)
+        self.cluster_nodes = [node for node in self.cluster_nodes if node not in nodes]
+
     def teardown_internet_access(self):
         try:
-            iputils.set_bridged_traffic_masquerading(
-                iputils.HOST_NS, self.host_bridge, False)
-            iputils.delete_iface(iputils.HOST_NS, self.host_veth)
-            iputils.delete_iface(iputils.HOST_NS, self.host_bridge)
+            with iputils.batched():
+                iputils.set_forwarding_through(
+                    iputils.HOST_NS, self.host_bridge, False)
+                iputils.set_bridged_traffic_masquerading(
+                    iputils.HOST_NS, self.host_bridge, False)
+                iputils.delete_iface(iputils.HOST_NS, self.host_veth)
+                iputils.delete_iface(iputils.HOST_NS, self.host_bridge)
         except Exception as e:
             logger.error(
                 "Exception while removing internet access", exc_info=e)
@@ -53,27 +72,27 @@ class InternetAccessManager:
             self.internet_gateway_container_netns, self.host_bridge.ipv4)
 
     def _setup_address_translations(self):
-        iputils.set_forwarding_through(iputils.HOST_NS, self.host_bridge, True)
-        iputils.set_bridged_traffic_masquerading(
-            iputils.HOST_NS, self.host_bridge, True)
+        with iputils.batched():
+            iputils.set_forwarding_through(
+                iputils.HOST_NS, self.host_bridge, True)
+            iputils.set_bridged_traffic_masquerading(
+                iputils.HOST_NS, self.host_bridge, True)
 
-        for subnet in (POD_CIDR, TUN_CIDR):
-            iputils.masquerade_internet_facing_traffic(
-                self.internet_gateway_container_netns, subnet, self.container_veth)
+            for subnet in (POD_CIDR, TUN_CIDR):
+                iputils.masquerade_internet_facing_traffic(
+                    self.internet_gateway_container_netns, subnet, self.container_veth)
 
-        for cluster_node in self.cluster_nodes:
-            iputils.masquerade_internet_facing_traffic(
-                self.internet_gateway_container_netns, cluster_node.net_iface.cidr, self.container_veth)
+            for cluster_node in self.cluster_nodes:
+                iputils.masquerade_internet_facing_traffic(
+                    self.internet_gateway_container_netns, cluster_node.net_iface.cidr, self.container_veth)
 
     def _get_host_bridge_meta(self) -> NetIface:
         # TODO make it more deterministic
         name = f'br_{iputils.random_iface_suffix()}'
         base_subnet = 64
-        for subnet in range(base_subnet, 255):
-            try:
-                iputils.get_host_ipv4_in_network_with(
-                    f'{KIND_CIDR.first_octet}.{subnet}.0.0', 16)
-            except:
-                return NetIface(name, f'{KIND_CIDR.first_octet}.{subnet}.0.1', 16)
-
-        raise Exception("Failed to create bridge on host")
+        ipam = Ipam()
+        for address in iputils.host_addresses.addresses():
+            ipam.reserve(Cidr(address, 32))
+        subnet = ipam.allocate(
+            KIND_CIDR, 16, start_at=f'{KIND_CIDR.first_octet}.{base_subnet}.0.0')
+        return NetIface(name, iputils.decimal_to_dot_notation(subnet.first + 1), 16)
@@ -1,7 +1,7 @@
 from abc import ABC
 
 from util.iputils import NetIface
-from util.kubectlutils import Cidr, NodeInfo
+from util.kubectlutils import Cidr, NodeMeta
 from util.p4 import P4Params
 
 
@@ -23,9 +23,11 @@ class K8sNode(ABC):
         # internal interface created by kind
         self.internal_cluster_iface: NetIface = None
 
-        self.internal_node_meta: NodeInfo = None
+        self.internal_node_meta: NodeMeta = None
         self.internal_node_name: str = None
         self.pod_cidrs: list[Cidr] = None
+        # largest packet pods can send to other nodes without fragmentation
+        self.pod_mtu: int = None
 
 
 class ControlNode(K8sNode):
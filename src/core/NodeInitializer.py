@@ -1,13 +1,16 @@
 import itertools as it
 import os
-from time import sleep
 
 import util.containerutils as containerutils
 import util.iputils as iputils
+import util.kindutils as kindutils
 import util.kubectlutils as kubectlutils
+import util.nsagent as nsagent
+import util.perf as perf
+import util.readiness as readiness
 from core.K8sNode import ControlNode, K8sNode, WorkerNode
-from util.iputils import NetIface
-from util.kubectlutils import NodesInfo
+from util.iputils import Cidr, NetIface
+from util.kubectlutils import NodeCatalog
 from util.logger import logger
 from util.p4 import P4Params
 
@@ -22,46 +25,101 @@ class NodeInitializer:
     _NODE_INIT_PATH = os.path.join(_SCRIPTS_DIR, _NODE_INIT_SCRIPT_FILENAME)
     _BMV2_PATH = os.path.join(_SCRIPTS_DIR, _BMV2_FILENAME)
     _BMV2_EXECUTABLE = 'simple_switch'  # use 'simple_switch_grpc' instead?
-    _WAIT_FOR_BMV2_INIT_SECONDS = 1
+    _BMV2_THRIFT_PORT = 9090
+    _BMV2_INIT_TIMEOUT_SECONDS = 30
     _HOSTNAMES_TO_ROUTE_VIA_HOST = [
         'registry-1.docker.io', 'production.cloudflare.docker.com']
 
     def __init__(self) -> None:
         self.ips_to_route_via_host = self._resolve_hostnames()
-        self.nodes_info: NodesInfo = None
+        self.node_catalog: NodeCatalog = None
+        # set if node_init.sh and bmv2_install.sh were already run in node containers
+        self.requirements_installed = False
 
     def assing_container_ids(self, cluster_name: str, workers: list[WorkerNode], controls: list[ControlNode]):
-        docker_ps_output = containerutils.docker_ps()
-        workers_iter = iter(workers)
-        controls_iter = iter(controls)
-
-        for line in docker_ps_output.splitlines():
-            node = None
-            if f'{cluster_name}-control-plane' in line:
-                node = next(controls_iter)
-            elif f'{cluster_name}-worker' in line:
-                node = next(workers_iter)
-
-            if node is not None:
-                node.container_id = line.split()[0]
-
-        assert next(workers_iter, None) is None and next(controls_iter, None) is None, \
-            f'Failed to assign container ids to some nodes, docker output is:\n {docker_ps_output}'
+        # node containers are inspected at once, their pids are cached for the rest of the build
+        containers = sorted(containerutils.containers.discover(
+            f'{kindutils.KIND_CLUSTER_LABEL}={cluster_name}'), key=lambda x: x.name)
+        control_containers = [x for x in containers if x.labels.get(kindutils.KIND_ROLE_LABEL) == 'control-plane']
+        worker_containers = [x for x in containers if x.labels.get(kindutils.KIND_ROLE_LABEL) == 'worker']
+
+        assert len(control_containers) == len(controls) and len(worker_containers) == len(workers), \
+            f'Failed to assign container ids to some nodes, found containers: {[x.name for x in containers]}'
+
+        for node, container in zip(controls + workers, control_containers + worker_containers):
+            node.container_id = container.short_id
+
+    def prepare_node_image(self, base_image: str = None) -> str | None:
+        '''
+        Returns prebaked node image that nodes should be created from, None if it isn't available.
+        It's built from base_image, kind's default node image if not given.
+        '''
+        node_image = kindutils.get_prebaked_node_image(
+            [self._NODE_INIT_PATH, self._BMV2_PATH], base_image)
+        if node_image is None:
+            logger.warning(
+                'Prebaked node image is not available, node requirements will be installed on every node')
+        self.requirements_installed = node_image is not None
+        return node_image
+
+    def strip_network_configuration(self, node: K8sNode, managed_ifaces: list[str], gateway_ipv4: str = None,
+                                    fou_port: int = None):
+        '''
+        Reverts network configuration applied to node container by previous build of a kept alive cluster,
+        Kathara devices are gone by now so default route is set back to kind network if gateway_ipv4 is given.
+        '''
+        commands = self.build_strip_commands(
+            managed_ifaces, self.ips_to_route_via_host, gateway_ipv4, fou_port)
+        containerutils.docker_exec_it(
+            node.container_id, 'sh', '-c', '; '.join(commands))
+
+    @classmethod
+    def build_strip_commands(cls, managed_ifaces: list[str], ips_routed_via_host: list[str],
+                             gateway_ipv4: str = None, fou_port: int = None) -> list[str]:
+        '''Shell commands of strip_network_configuration, each of them is allowed to fail'''
+        return [
+            *[f'ip link del {iface} 2>/dev/null' for iface in managed_ifaces],
+            *([f'ip fou del port {fou_port} 2>/dev/null'] if fou_port is not None else []),
+            # rules are listed as '-A OUTPUT <rule>' and deleted with the same spec as '-D OUTPUT <rule>'
+            'iptables -t nat -S OUTPUT | grep -- "-j DNAT" | sed "s/^-A /-D /" | xargs -r -L1 iptables -t nat',
+            *[f'ip route del {ip} 2>/dev/null' for ip in ips_routed_via_host],
+            *([f'ip route replace default via {gateway_ipv4} dev {cls._KIND_IFACE_NAME}']
+              if gateway_ipv4 is not None else []),
+            f'pkill {cls._BMV2_EXECUTABLE}',
+            'true'
+        ]
+
+    def node_containers_created(self, cluster_name: str, nodes_count: int) -> bool:
+        return len(containerutils.list_container_ids(
+            f'{kindutils.KIND_CLUSTER_LABEL}={cluster_name}')) >= nodes_count
 
     def setup_node_info(self):
-        self.nodes_info = kubectlutils.get_nodes_info()
+        self.node_catalog = kubectlutils.get_node_catalog()
+
+    def is_node_registered(self, node: K8sNode) -> bool:
+        '''Checks if node is registered in the last fetched node info and has pod cidrs assigned'''
+        if self.node_catalog is None or node.internal_cluster_iface is None:
+            return False
+        node_meta = self.node_catalog.by_internal_ip(node.internal_cluster_iface.ipv4)
+        return node_meta is not None and len(node_meta.pod_cidrs) > 0
 
     def init_worker(self, node: WorkerNode):
         logger.debug(f'Initializing worker: {node.name}')
-        self._init_node(node)
+        with perf.span(f'init_worker {node.name}', node=node.name):
+            self._init_node(node)
         logger.debug(f'worker: {node.name} ready')
 
     def init_control(self, node: ControlNode):
         logger.debug(f'Initializing control plane node: {node.name}')
-        self._init_node(node)
+        with perf.span(f'init_control {node.name}', node=node.name):
+            self._init_node(node)
         logger.debug(f'control plane node: {node.name} ready')
 
     def run_p4_nic(self, node: K8sNode):
+        with perf.span(f'run_p4_nic {node.name}', node=node.name):
+            self._run_p4_nic(node)
+
+    def _run_p4_nic(self, node: K8sNode):
         self._assert_p4_can_be_run_on(node)
         logger.debug(f'Starting P4 NIC on {node.name}')
         params = node.p4_params
@@ -74,15 +132,49 @@ class NodeInitializer:
             args.append('--no-p4')
 
         containerutils.docker_exec_detached(node.container_id, *args)
-        sleep(self._WAIT_FOR_BMV2_INIT_SECONDS)
-        if containerutils.is_process_running(node.container_id, self._BMV2_EXECUTABLE):
+        # switch is ready once its thrift server accepts connections, it listens on all node addresses
+        if readiness.wait_for_port(node.internal_cluster_iface.ipv4, self._BMV2_THRIFT_PORT,
+                                   self._BMV2_INIT_TIMEOUT_SECONDS):
             logger.info(f'P4 NIC is running on {node.name}')
-        else:
-            logger.error(f'Failed to run P4 NIC on {node.name}')
+            return
+        if containerutils.is_process_running(node.container_id, self._BMV2_EXECUTABLE):
+            raise TimeoutError(
+                f'P4 NIC on {node.name} is running but didn\'t become ready in {self._BMV2_INIT_TIMEOUT_SECONDS}s')
+        raise Exception(f'Failed to run P4 NIC on {node.name}')
+
+    def stop_p4_nic(self, node: K8sNode):
+        containerutils.docker_exec_it(node.container_id, 'pkill', self._BMV2_EXECUTABLE)
+
+    def reset_node(self, node: K8sNode):
+        '''Undoes partial initialization of the node so that it can be initialized again'''
+        # container may have been restarted, its pid changed then
+        if node.container_id is not None:
+            containerutils.containers.invalidate(node.container_id)
+            # links, DNAT rules and routes via host that the failed attempt may have created
+            managed_ifaces = [iface.name for iface in (node.p4_net_iface, node.p4_internal_iface) if iface is not None]
+            self.strip_network_configuration(node, managed_ifaces)
+        if node.netns_name is not None:
+            iputils.delete_namespace(iputils.HOST_NS, node.netns_name)
+            node.netns_name = None
+
+    def assume_node_state(self, node: K8sNode, internal_cluster_address: Cidr, pod_cidrs: list[Cidr]):
+        '''Sets node state that initialization would discover, without touching the node, e.g. for a dry run'''
+        node.netns_name = self._get_netns_name(node)
+        node.internal_cluster_iface = NetIface(
+            self._KIND_IFACE_NAME, internal_cluster_address.ipv4, internal_cluster_address.netmask)
+        node.pod_cidrs = pod_cidrs
+        if node.has_p4_nic:
+            self._setup_p4_iface_meta(node)
 
-    def _init_node(self, node: K8sNode):
+    def init_node_container(self, node: K8sNode):
+        '''Part of node initialization independent of kubernetes, can run while node is still joining the cluster'''
+        with perf.span(f'init_node_container {node.name}', node=node.name):
+            self._init_node_container(node)
+
+    def _init_node_container(self, node: K8sNode):
         self._init_container_requirements(node)
-        self._init_kubernetes_internals(node)
+        node.internal_cluster_iface = iputils.get_interface_info(
+            node.netns_name, self._KIND_IFACE_NAME)
 
         if node.has_p4_nic:
             self._install_bmv2(node)
@@ -95,25 +187,39 @@ class NodeInitializer:
         for ip in self.ips_to_route_via_host:
             iputils.add_route(node.netns_name, ip, host_ip)
 
+    def init_node_kubernetes_internals(self, node: K8sNode):
+        '''Requires node to be registered, see is_node_registered'''
+        with perf.span(f'init_node_kubernetes_internals {node.name}', node=node.name):
+            self._init_node_kubernetes_internals(node)
+
+    def _init_node_kubernetes_internals(self, node: K8sNode):
+        node.internal_node_meta = self.node_catalog.by_internal_ip(
+            node.internal_cluster_iface.ipv4)
+        assert node.internal_node_meta is not None, \
+            f'Failed to find node with ip: {node.internal_cluster_iface.ipv4}'
+        node.internal_node_name = node.internal_node_meta.name
+        node.pod_cidrs = list(node.internal_node_meta.pod_cidrs)
+
+    def _init_node(self, node: K8sNode):
+        self._init_node_container(node)
+        self._init_node_kubernetes_internals(node)
+
     def _init_container_requirements(self, node: K8sNode):
-        containerutils.copy_and_run_script_in_container(
-            node.container_id, self._NODE_INIT_PATH, f'/home/{self._NODE_INIT_SCRIPT_FILENAME}')
+        if not self.requirements_installed:
+            containerutils.copy_and_run_script_in_container(
+                node.container_id, self._NODE_INIT_PATH, f'/home/{self._NODE_INIT_SCRIPT_FILENAME}')
 
-        node.pid = containerutils.get_container_pid(node.container_id)
-        node.netns_name = f'ns_{node.name}'
+        node.pid = containerutils.containers.get_pid(node.container_id)
+        node.netns_name = self._get_netns_name(node)
         containerutils.attach_netns_to_host(node.pid, node.netns_name)
+        nsagent.start_agent(node.netns_name)
 
-    def _init_kubernetes_internals(self, node: K8sNode):
-        node.internal_cluster_iface = iputils.get_interface_info(
-            node.netns_name, self._KIND_IFACE_NAME)
-        node.internal_node_meta = kubectlutils.get_info_of_node_with_internal_ip(
-            self.nodes_info, node.internal_cluster_iface.ipv4)
-        node.internal_node_name = kubectlutils.get_node_name(
-            node.internal_node_meta)
-        node.pod_cidrs = kubectlutils.get_node_pod_cidrs(
-            node.internal_node_meta)
+    def _get_netns_name(self, node: K8sNode) -> str:
+        return f'ns_{node.name}'
 
     def _install_bmv2(self, node: K8sNode):
+        if self.requirements_installed:
+            return
         containerutils.copy_and_run_script_in_container(
             node.container_id, self._BMV2_PATH, f'/home/{self._BMV2_FILENAME}')
         logger.info(f'Installed bmv2 on: {node.name}')
@@ -1,36 +1,68 @@
 import os
 import signal
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
 
 from Kathara.manager.Kathara import Kathara
 from Kathara.model.Lab import Lab as KatharaLab
 from Kathara.model.Machine import Machine as KatharaMachine
 from Kathara.parser.netkit.LabParser import LabParser
 
+import util.perf as perf
 from core.ClusterBuilder import ClusterBuilder
 from core.InternetAccessManager import InternetAccessManager
 from core.NodeInitializer import NodeInitializer
+from util.iputils import IpBackend
 from util.logger import logger
 
 
 class KatharaBackedCluster:
     LAB_NAME = 'default_lab'
 
-    def __init__(self, cluster_name: str, kathara_lab: KatharaLab) -> None:
+    def __init__(self, cluster_name: str, kathara_lab: KatharaLab, ip_backend: IpBackend = IpBackend.SUBPROCESS,
+                 pipelined: bool = False, keep_alive: bool = False, reconcile: bool = False) -> None:
+        '''
+        With pipelined the lab is deployed in background while the cluster is being created and nodes initialized,
+        containers of the lab are then referenced with container_ref, which the cluster builder resolves once deployed.
+        With keep_alive kind cluster is left running on exit and reused by the next run with the same node counts.
+        With reconcile networking already present in namespaces, e.g. after an interrupted run, isn't applied again.
+        '''
         self.cluster_builder = ClusterBuilder(
-            cluster_name, NodeInitializer(), InternetAccessManager())
+            cluster_name, NodeInitializer(), InternetAccessManager(), ip_backend)
         self.kathara_lab = kathara_lab
+        self.pipelined = pipelined
+        self._pending_deployment: Future[ClusterBuilder] = None
+        self._container_refs: dict[str, Callable[[], str]] = {}
+        if pipelined:
+            self.cluster_builder.enable_pipelined_bring_up()
+        if keep_alive:
+            self.cluster_builder.enable_keep_alive()
+        if reconcile:
+            self.cluster_builder.enable_network_reconciliation()
+        self.cluster_builder.add_teardown_task(self._undeploy_lab)
 
     @classmethod
-    def from_file_system(cls, cluster_name: str, kathara_lab_path: str) -> 'KatharaBackedCluster':
+    def from_file_system(cls, cluster_name: str, kathara_lab_path: str,
+                         ip_backend: IpBackend = IpBackend.SUBPROCESS,
+                         pipelined: bool = False, keep_alive: bool = False,
+                         reconcile: bool = False) -> 'KatharaBackedCluster':
         lab = LabParser().parse(kathara_lab_path)
         lab.name = cls.LAB_NAME
-        return KatharaBackedCluster(cluster_name, lab)
+        return KatharaBackedCluster(cluster_name, lab, ip_backend, pipelined, keep_alive, reconcile)
 
     def __enter__(self) -> ClusterBuilder:
         logger.info('Deploying Kathara lab...')
-        cluster = self._setup(first_try=True)
-        logger.info('Kathara lab ready')
-        return cluster
+        if not self.pipelined:
+            cluster = self._setup(first_try=True)
+            logger.info('Kathara lab ready')
+            return cluster
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_deployment = executor.submit(self._setup, True)
+        self._pending_deployment.add_done_callback(lambda _: logger.info('Kathara lab ready'))
+        executor.shutdown(wait=False)
+        self.cluster_builder.add_build_dependency(self._pending_deployment)
+        return self.cluster_builder
 
     def __exit__(self, *args):
         def handler(sig, frame):
@@ -38,27 +70,53 @@ class KatharaBackedCluster:
         signal.signal(signal.SIGINT, handler)
         print('Press Ctrl+C to exit')
         signal.pause()
+        if self._pending_deployment is not None:
+            # lab can't be undeployed while it's still being deployed
+            self._pending_deployment.exception()
         self._cleanup()
 
+    def container_id(self, machine: KatharaMachine | str) -> str:
+        '''Waits for the lab to be deployed if it's being deployed in background'''
+        if self._pending_deployment is not None:
+            self._pending_deployment.result()
+        return container_id(machine)
+
+    def container_ref(self, machine: KatharaMachine | str) -> Callable[[], str]:
+        '''
+        Reference to the container that the cluster builder resolves after the lab is deployed,
+        machine always gets the same reference, so that the builder can tell its connections share the container
+        '''
+        name = machine if isinstance(machine, str) else machine.name
+        if name not in self._container_refs:
+            self._container_refs[name] = lambda: self.container_id(name)
+        return self._container_refs[name]
+
     def _setup(self, first_try: bool) -> ClusterBuilder:
         try:
-            Kathara.get_instance().deploy_lab(self.kathara_lab)
+            with perf.span('deploy_kathara_lab', 'kathara', first_try=first_try):
+                Kathara.get_instance().deploy_lab(self.kathara_lab)
             return self.cluster_builder
         except:
             if first_try:
-                self._cleanup()
+                # only the lab is redeployed, cluster may already be built or being built concurrently
+                logger.warning('Failed to deploy Kathara lab, retrying')
+                Kathara.get_instance().undeploy_lab(lab_name=self.kathara_lab.name)
             else:
                 raise
 
             return self._setup(first_try=False)
 
     def _cleanup(self):
+        # lab is undeployed by the builder concurrently with kind cluster
         self.cluster_builder.destroy()
-        Kathara.get_instance().undeploy_lab(lab_name=self.kathara_lab.name)
-        Kathara.get_instance().wipe()
+
+    def _undeploy_lab(self):
+        with perf.span('undeploy_kathara_lab', 'kathara'):
+            Kathara.get_instance().undeploy_lab(lab_name=self.kathara_lab.name)
 
 
 def container_id(machine: KatharaMachine | str) -> str:
+    '''Machine has to be deployed, see KatharaBackedCluster.container_ref for labs deployed in background'''
     if isinstance(machine, KatharaMachine):
         return machine.api_object.id
     return Kathara.get_instance().get_machine_api_object(machine, lab_name=KatharaBackedCluster.LAB_NAME).id
@@ -3,6 +3,11 @@ import os
 from Kathara.manager.Kathara import Kathara
 from Kathara.model.Machine import Machine as KatharaMachine
 
+import util.aio as aio
+
+SIMPLE_SWITCH_THRIFT_PORT = 9090
+SIMPLE_SWITCH_INIT_TIMEOUT_SECONDS = 120
+
 
 def container_id(machine: KatharaMachine | str, lab_name: str) -> str:
     if isinstance(machine, KatharaMachine):
@@ -13,8 +18,12 @@ def container_id(machine: KatharaMachine | str, lab_name: str) -> str:
 def simple_switch_CLI(*cmds: list[str]) -> list[str]:
     return [
         "echo '#!/bin/bash' >> s.sh",
-        "echo 'while [[ $(pgrep simple_switch) -eq 0 ]]; do sleep 1; done' >> s.sh",
-        "echo 'until simple_switch_CLI <<< 'help'; do sleep 1; done' >> s.sh",
+        # switch accepts CLI commands as soon as its thrift server listens
+        f"echo 'deadline=$((SECONDS + {SIMPLE_SWITCH_INIT_TIMEOUT_SECONDS}))' >> s.sh",
+        f"echo 'until (echo > /dev/tcp/127.0.0.1/{SIMPLE_SWITCH_THRIFT_PORT}) 2>/dev/null; do' >> s.sh",
+        "echo '  [ $SECONDS -lt $deadline ] || { echo simple_switch is not ready >&2; exit 1; }' >> s.sh",
+        "echo '  sleep 0.05' >> s.sh",
+        "echo 'done' >> s.sh",
         *[f"echo \"echo '{cmd}' | simple_switch_CLI\" >> s.sh" for cmd in cmds],
         "chmod u+x s.sh",
     ]
@@ -40,3 +49,10 @@ def run_in_kathara_machine(machine: KatharaMachine | str, commands: list[str], l
     cid = container_id(machine, lab_name)
     for cmd in commands:
         os.system(f'sudo docker exec -d {cid} {cmd}')
+
+
+async def run_in_kathara_machine_async(machine: KatharaMachine | str, commands: list[str], lab_name: str):
+    cid = container_id(machine, lab_name)
+    for cmd in commands:
+        # same shell semantics as os.system in run_in_kathara_machine
+        await aio.run(['sh', '-c', f'sudo docker exec -d {cid} {cmd}'])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Executes commands inside of the network namespace given as the first argument.
+# Frames exchanged over stdin/stdout are 4 byte big-endian length followed by UTF-8 JSON:
+#   request:  {"argv": [...], "input": str | null}
+#   response: {"returncode": int, "stdout": str, "stderr": str}
+# The first frame sent by the agent is {"ready": true} or {"ready": false, "error": str}.
+
+import ctypes
+import json
+import os
+import struct
+import subprocess
+import sys
+
+CLONE_NEWNET = 0x40000000
+HEADER = struct.Struct('>I')
+
+
+def enter_namespace(netns: str):
+    libc = ctypes.CDLL(None, use_errno=True)
+    with open(os.path.join('/run/netns', netns)) as f:
+        if libc.setns(f.fileno(), CLONE_NEWNET) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+
+def read_frame(stream) -> dict | None:
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (size,) = HEADER.unpack(header)
+    return json.loads(stream.read(size).decode())
+
+
+def write_frame(stream, payload: dict):
+    data = json.dumps(payload).encode()
+    stream.write(HEADER.pack(len(data)) + data)
+    stream.flush()
+
+
+def execute(request: dict) -> dict:
+    try:
+        res = subprocess.run(request['argv'], input=request.get('input'),
+                             capture_output=True, text=True)
+        return {'returncode': res.returncode, 'stdout': res.stdout, 'stderr': res.stderr}
+    except OSError as e:
+        return {'returncode': 127, 'stdout': '', 'stderr': str(e)}
+
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    try:
+        enter_namespace(sys.argv[1])
+    except OSError as e:
+        write_frame(stdout, {'ready': False, 'error': str(e)})
+        sys.exit(1)
+
+    write_frame(stdout, {'ready': True})
+    while (request := read_frame(stdin)) is not None:
+        write_frame(stdout, execute(request))
+
+
+if __name__ == '__main__':
+    main()
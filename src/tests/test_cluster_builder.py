@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import util.perf as perf
+from core.ClusterBuilder import ClusterBuilder
+from core.InternetAccessManager import InternetAccessManager
+from core.NodeInitializer import NodeInitializer
+from util.iputils import IpBackend, NetIface
+
+
+@pytest.fixture
+def untouchable_host(monkeypatch):
+    def run(commands, **kwargs):
+        raise AssertionError(f'Dry run executed {commands}')
+
+    monkeypatch.setattr(perf.sp, 'run', run)
+    monkeypatch.setattr(NodeInitializer, '_resolve_hostnames', lambda self: [])
+
+
+def _builder() -> ClusterBuilder:
+    builder = ClusterBuilder('test', NodeInitializer(), InternetAccessManager(), IpBackend.SUBPROCESS)
+    builder.add_control('control')
+    builder.add_worker('worker')
+    router = lambda: 'router_id'
+    builder.connect_with_container('control', NetIface('eth1', '10.0.0.1', 24), router,
+                                   NetIface('eth1', '10.0.0.254', 24))
+    builder.connect_with_container('worker', NetIface('eth1', '10.0.1.1', 24), router,
+                                   NetIface('eth2', '10.0.1.254', 24))
+    return builder
+
+
+def test_dry_run_compiles_plan_without_touching_host(untouchable_host, tmp_path):
+    builder = _builder()
+    path = tmp_path / 'plan.json'
+    builder.enable_network_plan_dump(str(path), dry_run=True)
+
+    builder.build()
+
+    operations = json.loads(path.read_text())['operations']
+    # both connections lead to the same placeholder namespace of the router
+    assert {operation['netns'] for operation in operations} == {'ns_control', 'ns_worker', 'ns_container0'}
+    commands = [command for operation in operations for command in operation['commands']]
+    # worker got the second placeholder pod cidr, control reaches it through the tunnel
+    assert 'route add 10.244.1.0/25 via 192.168.0.1' in commands
+    assert not builder.built
+    builder.destroy()
+
+
+def test_builder_refuses_to_build_after_dry_run(untouchable_host, tmp_path):
+    builder = _builder()
+    builder.enable_network_plan_dump(str(tmp_path / 'plan.json'), dry_run=True)
+    builder.build()
+
+    with pytest.raises(AssertionError):
+        builder.build()
+
+
+def test_node_limit_is_checked_at_build_against_final_count(untouchable_host, tmp_path):
+    builder = ClusterBuilder('test', NodeInitializer(), InternetAccessManager(), IpBackend.SUBPROCESS)
+    builder.add_control('control')
+    for idx in range(ClusterBuilder._MAX_NODES):
+        builder.add_worker(f'worker{idx}')
+    builder.enable_network_plan_dump(str(tmp_path / 'plan.json'), dry_run=True)
+
+    with pytest.raises(AssertionError, match='Max nodes count exceeded'):
+        builder.build()
+    # enabling flow-based tunneling after the nodes were added raises the limit
+    builder.enable_flow_based_tunneling()
+    builder._assert_node_count()
+
+
+def test_topology_hash_doesnt_change_once_connections_are_set_up(untouchable_host, tmp_path):
+    builder = _builder()
+    pending_hash = builder._get_topology_hash()
+    builder.enable_network_plan_dump(str(tmp_path / 'plan.json'), dry_run=True)
+
+    builder.build()
+
+    assert not builder.connect_tasks
+    assert builder._get_topology_hash() == pending_hash
+    other = _builder()
+    other.add_worker('worker2')
+    assert other._get_topology_hash() != pending_hash
@@ -0,0 +1,205 @@
+import http.client
+import io
+import itertools as it
+import json
+import socket
+import socketserver
+import struct
+import tarfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import util.dockerapi as dockerapi
+import util.readiness as readiness
+from util.dockerapi import DockerClient
+
+
+class _FakeDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Docker API subset served on a unix socket, every request is logged with the connection it came on'''
+    daemon_threads = True
+
+    def __init__(self, socket_path: str) -> None:
+        super().__init__(socket_path, _Handler)
+        self.requests: list[tuple[int, str, str]] = []
+        self.archives: dict[str, bytes] = {}
+        # connection is closed without a response to its n-th request, e.g. 2 for the first reuse
+        self.drop_request_number: int = None
+        # connection is closed after the response although it's kept alive as far as client knows
+        self.close_idle = False
+        self.lock = threading.Lock()
+        self.connection_numbers = it.count()
+
+    def connections(self) -> set[int]:
+        return {conn for conn, _, _ in self.requests}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: _FakeDaemon
+
+    def setup(self):
+        super().setup()
+        self.connection_number = next(self.server.connection_numbers)
+        self.handled = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def _handle(self):
+        self.handled += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urllib.parse.urlparse(self.path)
+        with self.server.lock:
+            self.server.requests.append((self.connection_number, self.command, url.path))
+        if self.handled == self.server.drop_request_number:
+            self.close_connection = True
+            return
+
+        parts = url.path.split('/')[2:]
+        match (self.command, parts):
+            case ('GET', ['_ping']):
+                self._reply(b'OK')
+            case ('GET', ['containers', container_id, 'json']):
+                self._reply_json({'Id': container_id, 'State': {'Pid': len(container_id)}})
+            case ('POST', ['containers', _, 'exec']):
+                self._reply_json({'Id': 'e1'})
+            case ('POST', ['exec', 'e1', 'start']):
+                frames = [(1, b'out1 '), (2, b'err'), (1, b'out2'), (3, b'ignored')]
+                self._reply(b''.join(struct.pack('>BxxxI', kind, len(data)) + data for kind, data in frames))
+            case ('GET', ['exec', 'e1', 'json']):
+                self._reply_json({'ExitCode': 3})
+            case ('PUT', ['containers', _, 'archive']):
+                self.server.archives[urllib.parse.parse_qs(url.query)['path'][0]] = body
+                self._reply(b'')
+            case _:
+                self._reply(b'{"message": "not found"}', 404)
+
+    def _reply_json(self, data):
+        self._reply(json.dumps(data).encode())
+
+    def _reply(self, data: bytes, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.close_connection = self.server.close_idle
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    server = _FakeDaemon(str(tmp_path / 'docker.sock'))
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(daemon):
+    client = DockerClient(daemon.server_address)
+    yield client
+    client.close()
+
+
+def test_demultiplex_splits_frames_by_stream():
+    frame = struct.Struct('>BxxxI')
+    stream = frame.pack(1, 3) + b'abc' + frame.pack(2, 2) + b'de' + frame.pack(1, 1) + b'f' + frame.pack(2, 4)
+
+    # truncated frame at the end is taken as far as it goes
+    assert dockerapi._demultiplex(stream) == ('abcf', 'de')
+    assert dockerapi._demultiplex(b'') == ('', '')
+
+
+def test_exec_reuses_pooled_connection(daemon, client):
+    res = client.exec('c1', 'ip', 'link')
+
+    assert (res.returncode, res.stdout, res.stderr) == (3, 'out1 out2', 'err')
+    assert [(method, path) for _, method, path in daemon.requests] == [
+        ('POST', '/v1.41/containers/c1/exec'), ('POST', '/v1.41/exec/e1/start'), ('GET', '/v1.41/exec/e1/json')]
+    assert len(daemon.connections()) == 1
+
+
+def test_connection_closed_by_daemon_isnt_reused(daemon, client):
+    daemon.close_idle = True
+    assert client.ping()
+    conn = client._idle[0]
+    assert readiness.wait_until(lambda: dockerapi._is_closed_by_peer(conn), 1)
+
+    daemon.close_idle = False
+    assert client.ping()
+    assert conn.sock is None and len(daemon.connections()) == 2
+
+
+def test_get_is_retried_when_stale_connection_drops_it(daemon, client):
+    assert client.ping()
+    daemon.drop_request_number = 2
+
+    assert client.inspect_container('c1')['Id'] == 'c1'
+    assert [path for _, _, path in daemon.requests] == ['/v1.41/_ping'] + ['/v1.41/containers/c1/json'] * 2
+    assert len(daemon.connections()) == 2
+
+
+def test_post_isnt_resent_after_it_was_written(daemon, client):
+    assert client.ping()
+    daemon.drop_request_number = 2
+
+    with pytest.raises(http.client.RemoteDisconnected):
+        client.exec('c1', 'touch', 'file')
+    # daemon may have created the exec before the connection dropped
+    assert [path for _, _, path in daemon.requests] == ['/v1.41/_ping', '/v1.41/containers/c1/exec']
+
+
+def test_request_that_couldnt_be_written_is_resent_whatever_the_method(daemon, client):
+    class BrokenConnection(dockerapi._UnixHTTPConnection):
+        def request(self, *args, **kwargs):
+            raise BrokenPipeError()
+
+    broken = BrokenConnection(daemon.server_address)
+    broken.sock, peer = socket.socketpair()
+    client._idle.append(broken)
+
+    assert client.exec('c1', 'true', detach=True).returncode == 0
+    assert [method for _, method, _ in daemon.requests] == ['POST', 'POST']
+    peer.close()
+
+
+def test_put_file_uploads_tar_archive(daemon, client, tmp_path):
+    host_file = tmp_path / 'node_init.sh'
+    host_file.write_text('echo hi\n')
+
+    client.put_file('c1', str(host_file), '/opt/init.sh')
+
+    with tarfile.open(fileobj=io.BytesIO(daemon.archives['/opt'])) as tar:
+        assert tar.getnames() == ['init.sh']
+        assert tar.extractfile('init.sh').read() == b'echo hi\n'
+
+
+def test_inspect_containers_keeps_order_and_bounds_connections(daemon, client):
+    ids = [f'c{idx}' for idx in range(20)]
+
+    containers = client.inspect_containers(ids)
+
+    assert [container['Id'] for container in containers] == ids
+    assert len(daemon.connections()) <= dockerapi._MAX_CONCURRENT_INSPECTS
+    # pooled connections are reused by the next batch
+    client.inspect_containers(ids)
+    assert len(daemon.connections()) <= dockerapi._MAX_CONCURRENT_INSPECTS
+
+
+def test_error_status_raises_docker_api_error(client):
+    with pytest.raises(dockerapi.DockerApiError) as e:
+        client.list_containers()
+    assert e.value.status == 404
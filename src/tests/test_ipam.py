@@ -0,0 +1,136 @@
+import random
+
+import pytest
+
+from util.ipam import IntervalTree, Ipam
+from util.iputils import Cidr
+
+
+def _check_invariants(tree: IntervalTree) -> list[tuple[int, int, int]]:
+    '''Asserts AVL balance, heights and subtree max ends, returns keys in order'''
+    keys = []
+
+    def visit(node) -> tuple[int, int]:
+        if node is None:
+            return 0, -1
+        left_height, left_max_end = visit(node.left)
+        keys.append((node.start, node.end, node.seq))
+        right_height, right_max_end = visit(node.right)
+        assert abs(left_height - right_height) <= 1
+        assert node.height == 1 + max(left_height, right_height)
+        assert node.max_end == max(node.end, left_max_end, right_max_end)
+        return node.height, node.max_end
+
+    visit(tree._root)
+    assert keys == sorted(keys) and len(keys) == len(tree)
+    return keys
+
+
+def test_ascending_inserts_and_removals_keep_tree_balanced():
+    tree = IntervalTree()
+    for start in range(64):
+        tree.insert(start, start + 1, start)
+        _check_invariants(tree)
+    # perfectly balanced tree of 64 nodes has height 7
+    assert tree._root.height == 7
+
+    for start in range(0, 64, 2):
+        assert tree.remove(start, start + 1, start)
+        _check_invariants(tree)
+    assert len(tree) == 32
+    assert not tree.remove(0, 1, 0)
+
+
+def test_random_operations_match_brute_force():
+    rnd = random.Random(7)
+    tree, intervals = IntervalTree(), []
+    for _ in range(500):
+        if intervals and rnd.random() < 0.4:
+            start, end, value = intervals.pop(rnd.randrange(len(intervals)))
+            assert tree.remove(start, end, value)
+        else:
+            start = rnd.randrange(1000)
+            interval = (start, start + rnd.randrange(50), rnd.randrange(3))
+            tree.insert(*interval)
+            intervals.append(interval)
+        _check_invariants(tree)
+
+        start = rnd.randrange(1000)
+        end = start + rnd.randrange(30)
+        expected = sorted(i for i in intervals if i[0] <= end and start <= i[1])
+        assert sorted(tree.overlapping(start, end)) == expected
+        first = tree.first_overlapping(start, end)
+        assert first in expected and first[0] == expected[0][0] if expected else first is None
+
+
+def test_overlap_queries_include_touching_intervals():
+    tree = IntervalTree()
+    tree.insert(10, 19, 'a')
+    tree.insert(20, 29, 'b')
+    tree.insert(0, 100, 'c')
+
+    assert sorted(value for _, _, value in tree.overlapping(19, 20)) == ['a', 'b', 'c']
+    assert [value for _, _, value in tree.overlapping(101, 200)] == []
+    assert tree.first_overlapping(15, 25) == (0, 100, 'c')
+    assert tree.first_overlapping(101, 200) is None
+
+
+def test_remove_matches_value_of_duplicate_intervals():
+    tree = IntervalTree()
+    tree.insert(0, 9, 'a')
+    tree.insert(0, 9, 'b')
+
+    assert tree.remove(0, 9, 'b')
+    assert list(tree.overlapping(0, 9)) == [(0, 9, 'a')]
+    assert not tree.remove(0, 9, 'b')
+
+
+def test_find_helpers_report_forbidden_and_used_networks():
+    forbidden = Cidr('10.244.0.0', 16)
+    ipam = Ipam([forbidden])
+    ipam.reserve(Cidr('10.0.0.0', 24), 'r1')
+    ipam.reserve(Cidr('10.0.0.0', 24), 'r2')
+    ipam.reserve(Cidr('10.0.1.0', 24), 'r3')
+
+    assert ipam.find_forbidden_overlap(Cidr('10.244.3.0', 24)) == forbidden
+    assert ipam.find_forbidden_overlap(Cidr('10.0.0.0', 8)) == forbidden
+    assert ipam.find_forbidden_overlap(Cidr('10.245.0.0', 24)) is None
+    assert sorted(owner for _, owner in ipam.find_used_overlaps(Cidr('10.0.0.0', 16))) == ['r1', 'r2', 'r3']
+    assert ipam.find_used_overlaps(Cidr('10.0.2.0', 24)) == []
+
+
+def test_release_frees_only_reservation_of_owner():
+    ipam = Ipam()
+    cidr = Cidr('10.0.0.0', 24)
+    ipam.reserve(cidr, 'r1')
+    ipam.reserve(cidr, 'r2')
+
+    assert ipam.release(cidr, 'r1')
+    assert not ipam.release(cidr, 'r1')
+    assert ipam.find_used_overlaps(cidr) == [(cidr, 'r2')]
+
+
+def test_allocate_skips_used_ranges_and_keeps_alignment():
+    ipam = Ipam()
+    pool = Cidr('192.168.0.0', 24)
+    ipam.reserve(Cidr('192.168.0.1', 32))
+
+    first = ipam.allocate(pool, 31, 'a')
+    second = ipam.allocate(pool, 30, 'b')
+    third = ipam.allocate(pool, 31, 'c', start_at='192.168.0.100')
+
+    assert (first.ipv4, second.ipv4, third.ipv4) == ('192.168.0.2', '192.168.0.4', '192.168.0.100')
+    # released subnet is handed out again
+    assert ipam.release(first, 'a')
+    assert ipam.allocate(pool, 31, 'd').ipv4 == '192.168.0.2'
+
+
+def test_allocate_raises_when_pool_is_exhausted():
+    ipam = Ipam()
+    pool = Cidr('192.168.0.0', 30)
+
+    assert [ipam.allocate(pool, 31).ipv4 for _ in range(2)] == ['192.168.0.0', '192.168.0.2']
+    with pytest.raises(Exception, match='No free /31 subnet left'):
+        ipam.allocate(pool, 31)
+    with pytest.raises(AssertionError):
+        ipam.allocate(pool, 29)
@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+import util.iputils as iputils
+
+
+class _FakeBackend:
+    pass
+
+
+def test_using_backend_restores_subprocess_backend():
+    backend = _FakeBackend()
+
+    with iputils.using_backend(backend):
+        with iputils.using_backend(backend):
+            assert iputils._netlink is backend
+        assert iputils._netlink is backend
+
+    assert iputils._netlink is None
+
+
+def test_using_other_backend_waits_until_blocks_exit():
+    first, second = _FakeBackend(), _FakeBackend()
+    seen = []
+
+    def use_second():
+        with iputils.using_backend(second):
+            seen.append(iputils._netlink)
+
+    with iputils.using_backend(first):
+        thread = threading.Thread(target=use_second)
+        thread.start()
+        thread.join(0.05)
+        # second backend can't replace the first one while it's in use
+        assert thread.is_alive() and iputils._netlink is first
+
+    thread.join(1)
+    assert seen == [second]
+    assert iputils._netlink is None
+
+
+def _cover(cidr: str, *competing: str) -> list[str]:
+    def parse(text: str) -> iputils.Cidr:
+        ipv4, netmask = text.split('/')
+        return iputils.Cidr(ipv4, int(netmask))
+    return [route.masked_ip for route in iputils.get_route_cover(parse(cidr), [parse(route) for route in competing])]
+
+
+def test_route_cover_ignores_disjoint_adjacent_and_less_specific_routes():
+    assert _cover('10.244.1.0/24', '10.244.3.0/24') == ['10.244.1.0/24']
+    assert _cover('10.244.1.0/24', '10.244.0.0/24', '10.244.2.0/24') == ['10.244.1.0/24']
+    assert _cover('10.244.1.0/24', '10.244.0.0/16') == ['10.244.1.0/24']
+
+
+def test_route_cover_splits_around_nested_routes():
+    assert _cover('10.244.1.0/24', '10.244.1.64/26', '10.244.0.0/16') == [
+        '10.244.1.0/26', '10.244.1.64/27', '10.244.1.96/27', '10.244.1.128/25']
+
+
+def test_route_cover_of_route_equal_to_competing_one_is_its_halves():
+    assert _cover('10.244.1.0/24', '10.244.1.0/24') == ['10.244.1.0/25', '10.244.1.128/25']
+    # host bits of the cidr are ignored
+    assert _cover('10.244.1.7/24', '10.244.1.0/24') == ['10.244.1.0/25', '10.244.1.128/25']
+
+
+def test_route_cover_of_host_route_equal_to_competing_one_is_impossible():
+    with pytest.raises(AssertionError):
+        _cover('10.244.1.1/32', '10.244.1.1/32')
@@ -0,0 +1,168 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import util.iputils as iputils
+from util.iputils import BatchSegment, IpBatch, NetworkPlan
+
+
+def _record(netns: iputils.Netns, *commands: str) -> None:
+    iputils.run_in_namespace(netns, *commands)
+
+
+def _commands(segment: BatchSegment) -> list[str]:
+    return [' '.join(args) for args in segment.commands]
+
+
+def _plan_two_namespaces() -> NetworkPlan:
+    with iputils.planned() as plan:
+        _record('a', 'ip', 'link', 'add', 'v0', 'type', 'veth', 'peer', 'name', 'v1')
+        _record('b', 'ip', 'address', 'add', '10.0.0.1/24', 'dev', 'eth0')
+        _record('a', 'ip', 'link', 'set', 'v1', 'netns', 'b')
+        _record('b', 'ip', 'link', 'set', 'v1', 'up')
+        _record('a', 'iptables', '-t', 'nat', '-A', 'OUTPUT', '-d', '10.0.0.2', '-j', 'DNAT',
+                '--to-destination', '10.0.0.3')
+        _record('a', 'ip', 'route', 'add', '10.1.0.0/16', 'via', '10.0.0.1')
+    return plan
+
+
+def test_commands_of_namespace_share_segment_until_kind_changes():
+    batch = IpBatch()
+    batch.enqueue('a', ('ip', 'link', 'add', 'br0', 'type', 'bridge'), True)
+    batch.enqueue('b', ('ip', 'link', 'add', 'br1', 'type', 'bridge'), True)
+    batch.enqueue('a', ('ip', 'link', 'set', 'br0', 'up'), True)
+    batch.enqueue('a', ('iptables', '-A', 'FORWARD', '-j', 'ACCEPT'), False)
+    batch.enqueue('a', ('tc', 'qdisc', 'add', 'dev', 'br0', 'root', 'netem', 'delay', '1ms'), True)
+
+    a1, b1, a2, a3 = batch.segments
+    assert (a1.netns, a1.kind, _commands(a1)) == ('a', BatchSegment.BATCH,
+                                                  ['link add br0 type bridge', 'link set br0 up'])
+    assert (b1.netns, b1.deps) == ('b', [])
+    assert (a2.kind, a2.deps, a2.log_errors) == (BatchSegment.RESTORE, [a1], [False])
+    assert (a3.tool, a3.deps) == ('tc', [a2])
+
+
+def test_read_only_and_unbatched_commands_are_executed_one_by_one():
+    batch = IpBatch()
+
+    assert batch.accepts(('ip', 'link', 'add', 'br0', 'type', 'bridge'))
+    assert batch.accepts(('ip', 'netns', 'delete', 'ns1'))
+    assert not batch.accepts(('ip', 'netns', 'exec', 'ns1', 'true'))
+    assert not batch.accepts(('ip', '-j', 'route', 'show'))
+    assert not batch.accepts(('sysctl', '-w', 'net.ipv4.ip_forward=1'))
+
+
+def test_moved_iface_is_configured_after_the_move():
+    plan = _plan_two_namespaces()
+
+    a1, b1, b2, a2, a3 = plan.segments
+    assert _commands(a1) == ['link add v0 type veth peer name v1', 'link set v1 netns b']
+    assert _commands(b1) == ['address add 10.0.0.1/24 dev eth0']
+    # segment of b opened before the move can't take commands that need the moved iface
+    assert (_commands(b2), b2.deps) == (['link set v1 up'], [a1, b1])
+    assert (a2.kind, a2.deps) == (BatchSegment.RESTORE, [a1])
+    assert (_commands(a3), a3.deps) == (['route add 10.1.0.0/16 via 10.0.0.1'], [a2])
+
+
+def test_execute_runs_segments_after_their_deps(monkeypatch):
+    plan = _plan_two_namespaces()
+    segments = list(plan.segments)
+    finished: list[BatchSegment] = []
+    lock = threading.Lock()
+
+    def run(segment: BatchSegment) -> list[iputils.BatchError]:
+        with lock:
+            assert all(dep in finished for dep in segment.deps)
+        # lets independent segments overlap
+        time.sleep(0.01)
+        with lock:
+            finished.append(segment)
+        return [iputils.BatchError(segment.netns, 'cmd', 'err')] if segment.kind == BatchSegment.RESTORE else []
+
+    monkeypatch.setattr(BatchSegment, 'run', run)
+    errors = plan.execute(max_workers=4)
+
+    assert sorted(map(id, finished)) == sorted(map(id, segments))
+    assert errors == [iputils.BatchError('a', 'cmd', 'err')] == plan.errors
+    # executed plan is emptied so that it can't be applied twice
+    assert plan.segments == []
+
+
+def test_execute_async_keeps_per_namespace_order(monkeypatch):
+    plan = _plan_two_namespaces()
+    segments = list(plan.segments)
+    finished: list[BatchSegment] = []
+
+    async def run_async(segment: BatchSegment) -> list[iputils.BatchError]:
+        assert all(dep in finished for dep in segment.deps)
+        await asyncio.sleep(0.001)
+        finished.append(segment)
+        return []
+
+    monkeypatch.setattr(BatchSegment, 'run_async', run_async)
+    assert asyncio.run(plan.execute_async()) == []
+
+    for netns in ('a', 'b'):
+        assert [s for s in finished if s.netns == netns] == [s for s in segments if s.netns == netns]
+
+
+def test_combine_chains_namespaces_across_plans():
+    first = _plan_two_namespaces()
+    with iputils.planned() as second:
+        _record('b', 'ip', 'route', 'add', 'default', 'via', '10.0.0.254')
+        _record('c', 'ip', 'link', 'add', 'br0', 'type', 'bridge')
+
+    combined = NetworkPlan.combine([first, second])
+
+    assert len(combined.segments) == len(first.segments) + len(second.segments)
+    b_route, c_bridge = combined.segments[-2:]
+    # last segment of b in the first plan
+    assert b_route.deps == [combined.segments[2]]
+    assert c_bridge.deps == []
+    # copies don't share segments nor commands with the source plans
+    assert not set(map(id, combined.segments)) & set(map(id, first.segments + second.segments))
+    combined.segments[0].commands[0].append('mtu')
+    assert first.segments[0].commands[0][-1] == 'v1'
+
+
+def test_copy_keeps_dependency_structure():
+    plan = _plan_two_namespaces()
+
+    copy = plan.copy()
+
+    assert [_commands(s) for s in copy.segments] == [_commands(s) for s in plan.segments]
+    index = {segment: idx for idx, segment in enumerate(copy.segments)}
+    original_index = {segment: idx for idx, segment in enumerate(plan.segments)}
+    assert [[index[dep] for dep in s.deps] for s in copy.segments] == \
+        [[original_index[dep] for dep in s.deps] for s in plan.segments]
+    assert copy.to_dict() == plan.to_dict()
+
+
+def test_discard_filters_commands_and_their_flags():
+    with iputils.planned() as plan:
+        iputils.run_in_namespace('a', 'ip', 'link', 'add', 'tgre1', 'type', 'gre', log_error=False)
+        iputils.run_in_namespace('a', 'ip', 'link', 'add', 'tgre2', 'type', 'gre')
+        iputils.run_in_namespace('b', 'ip', 'link', 'add', 'tgre1', 'type', 'gre')
+
+    plan.discard(lambda netns, args: netns == 'b' or 'tgre2' in args)
+
+    a, b = plan.segments
+    assert (_commands(a), a.log_errors) == (['link add tgre1 type gre'], [False])
+    assert (b.commands, b.log_errors) == ([], [])
+    # empty segments stay in the graph as dependencies but run nothing
+    assert b.run() == []
+
+
+def test_plan_rejects_commands_reading_state():
+    plan = NetworkPlan()
+
+    for commands in [('ip', '-j', 'route', 'show'), ('ip', 'link'), ('tc', 'qdisc', 'ls', 'dev', 'eth0'),
+                     ('iptables', '-t', 'nat', '-S', 'OUTPUT'), ('iptables-save',)]:
+        with pytest.raises(iputils.PlanningError):
+            plan.accepts(commands)
+
+    assert plan.accepts(('ip', '-n', 'a', 'route', 'replace', 'default', 'via', '10.0.0.1'))
+    assert plan.accepts(('iptables', '-t', 'nat', '-A', 'OUTPUT', '-j', 'ACCEPT'))
+    assert plan.accepts(('sysctl', '-w', 'net.ipv4.ip_forward=1'))
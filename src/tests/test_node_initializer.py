@@ -0,0 +1,58 @@
+import os
+import subprocess as sp
+
+from core.NodeInitializer import NodeInitializer
+
+_IPTABLES_RULES = '''-P OUTPUT ACCEPT
+-N KIND-MASQ-AGENT
+-A OUTPUT -d 10.96.0.10/32 -j KUBE-SERVICES
+-A OUTPUT -d 10.10.0.2/32 -j DNAT --to-destination 172.18.0.3
+-A OUTPUT -d 10.10.0.3/32 -p tcp -j DNAT --to-destination 172.18.0.4
+'''
+
+
+def _run_with_fake_iptables(tmp_path, command: str) -> list[str]:
+    '''Runs command with iptables that lists _IPTABLES_RULES and logs any other invocation'''
+    log_path = tmp_path / 'iptables.log'
+    iptables = tmp_path / 'iptables'
+    iptables.write_text('\n'.join([
+        '#!/bin/sh',
+        'if [ "$3" = "-S" ]; then',
+        f"  printf '%s' '{_IPTABLES_RULES}'",
+        'else',
+        f'  echo "$@" >> {log_path}',
+        'fi',
+        ''
+    ]))
+    iptables.chmod(0o755)
+
+    env = {**os.environ, 'PATH': f'{tmp_path}:{os.environ["PATH"]}'}
+    sp.run(['sh', '-c', command], env=env, check=True)
+    return log_path.read_text().splitlines() if log_path.exists() else []
+
+
+def test_strip_commands_delete_dnat_rules_listed_by_iptables(tmp_path):
+    commands = NodeInitializer.build_strip_commands([], [])
+    dnat_command = next(command for command in commands if 'iptables' in command)
+
+    assert _run_with_fake_iptables(tmp_path, dnat_command) == [
+        '-t nat -D OUTPUT -d 10.10.0.2/32 -j DNAT --to-destination 172.18.0.3',
+        '-t nat -D OUTPUT -d 10.10.0.3/32 -p tcp -j DNAT --to-destination 172.18.0.4',
+    ]
+
+
+def test_strip_commands_delete_routes_via_host_and_managed_ifaces():
+    commands = NodeInitializer.build_strip_commands(
+        ['tun1', 'p4_neth1'], ['1.2.3.4'], gateway_ipv4='172.18.0.1', fou_port=5555)
+
+    assert 'ip link del tun1 2>/dev/null' in commands
+    assert 'ip link del p4_neth1 2>/dev/null' in commands
+    assert 'ip fou del port 5555 2>/dev/null' in commands
+    assert 'ip route del 1.2.3.4 2>/dev/null' in commands
+    assert 'ip route replace default via 172.18.0.1 dev eth0' in commands
+
+
+def test_strip_commands_keep_default_route_without_gateway():
+    commands = NodeInitializer.build_strip_commands([], [])
+
+    assert not any('default' in command for command in commands)
@@ -0,0 +1,48 @@
+import subprocess as sp
+import sys
+
+import pytest
+
+import util.nsagent as nsagent
+
+
+def _spawn_instead(monkeypatch, code: str) -> list[sp.Popen]:
+    '''Agent processes run code instead of the privileged agent, spawned processes are returned'''
+    spawned = []
+    popen = sp.Popen
+
+    def fake_popen(args, **kwargs):
+        spawned.append(popen([sys.executable, '-c', code], **kwargs))
+        return spawned[-1]
+
+    monkeypatch.setattr(nsagent.sp, 'Popen', fake_popen)
+    return spawned
+
+
+def test_agent_exiting_before_handshake_is_reaped(monkeypatch):
+    spawned = _spawn_instead(monkeypatch, 'import sys; sys.exit(3)')
+    agent = nsagent.NamespaceAgent('ns1')
+
+    with pytest.raises(nsagent.NamespaceAgentError):
+        agent.start()
+
+    assert spawned[0].returncode == 3
+
+
+def test_agent_sending_invalid_handshake_is_stopped(monkeypatch):
+    spawned = _spawn_instead(
+        monkeypatch, 'import sys; sys.stdout.buffer.write(b"\\0\\0\\0\\2{x"); sys.stdout.flush(); sys.stdin.read()')
+    agent = nsagent.NamespaceAgent('ns1')
+
+    with pytest.raises(ValueError):
+        agent.start()
+
+    # agent exits once its input is closed by stop
+    assert spawned[0].returncode == 0
+
+
+def test_start_agent_falls_back_when_agent_fails(monkeypatch):
+    _spawn_instead(monkeypatch, 'import sys; sys.exit(1)')
+
+    assert not nsagent.start_agent('ns1')
+    assert nsagent.get_agent('ns1') is None
@@ -0,0 +1,152 @@
+import subprocess as sp
+
+import pytest
+
+import util.iputils as iputils
+import util.reconcile as reconcile
+from util.iputils import BatchSegment
+
+# outputs of ip -j -d link show, ip -j address show, ip -j route show and iptables-save in namespace "node"
+_LINKS = '''[
+  {"ifindex": 1, "ifname": "lo", "flags": ["LOOPBACK", "UP", "LOWER_UP"], "mtu": 65536, "address": "00:00:00:00:00:00"},
+  {"ifindex": 5, "ifname": "eth1", "flags": ["BROADCAST", "MULTICAST", "UP", "LOWER_UP"], "mtu": 1500,
+   "address": "02:42:ac:12:00:02", "link_index": 6},
+  {"ifindex": 7, "ifname": "tgre_0", "flags": ["POINTOPOINT", "NOARP", "UP", "LOWER_UP"], "mtu": 1476,
+   "linkinfo": {"info_kind": "gre", "info_data": {"remote": "10.0.1.1", "local": "10.0.0.1"}}},
+  {"ifindex": 8, "ifname": "tgre_1", "flags": ["POINTOPOINT", "NOARP"], "mtu": 1476,
+   "linkinfo": {"info_kind": "gre", "info_data": {"remote": "10.0.2.1", "local": "10.0.0.1"}}}
+]'''
+_ADDRESSES = '''[
+  {"ifindex": 5, "ifname": "eth1", "addr_info": [{"family": "inet", "local": "10.0.0.1", "prefixlen": 24}]},
+  {"ifindex": 7, "ifname": "tgre_0", "addr_info": [{"family": "inet", "local": "192.168.0.0", "prefixlen": 31}]}
+]'''
+# ip prints attributes of lightweight tunnel encapsulation as keys repeated after "encap"
+_ROUTES = '''[
+  {"dst": "default", "gateway": "10.0.0.254", "dev": "eth1", "flags": []},
+  {"dst": "10.244.1.0/25", "gateway": "192.168.0.1", "dev": "tgre_0", "flags": []},
+  {"dst": "10.96.0.10", "gateway": "172.18.0.1", "dev": "eth0", "flags": []},
+  {"dst": "10.244.2.0/25", "encap": "ip", "id": 0, "src": "0.0.0.0", "dst": "10.0.2.1", "ttl": 0, "tos": 0,
+   "dev": "tgre_ext", "metrics": [{"mtu": 1476}], "flags": []}
+]'''
+_IPTABLES = '''# Generated by iptables-save v1.8.7 on Mon Jan  1 00:00:00 2024
+*nat
+:PREROUTING ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A OUTPUT -d 172.18.0.3/32 -j DNAT --to-destination 10.0.1.1
+COMMIT
+*filter
+:FORWARD ACCEPT [0:0]
+-A FORWARD  -i eth1 -j ACCEPT
+COMMIT
+'''
+
+_OUTPUTS = {
+    ('ip', '-j', '-d', 'link', 'show'): _LINKS,
+    ('ip', '-j', 'address', 'show'): _ADDRESSES,
+    ('ip', '-j', 'route', 'show'): _ROUTES,
+    ('iptables-save',): _IPTABLES,
+}
+
+
+@pytest.fixture
+def live_node(monkeypatch):
+    '''Namespace "node" holds the state above, other namespaces are empty'''
+    def run_in_namespace(netns, *commands, log_error=True):
+        stdout = _OUTPUTS[commands] if netns == 'node' else ''
+        return sp.CompletedProcess(list(commands), 0, stdout, '')
+
+    monkeypatch.setattr(iputils, 'run_in_namespace', run_in_namespace)
+
+
+def _record(plan: iputils.NetworkPlan, netns: str, *commands: str):
+    plan.enqueue(netns, commands, True)
+
+
+def _commands(plan: iputils.NetworkPlan, netns: str) -> list[str]:
+    return [' '.join(args) for segment in plan.segments if segment.netns == netns for args in segment.commands]
+
+
+def test_live_state_parses_dumps(live_node):
+    state = reconcile.LiveState('node', with_iptables=True)
+
+    assert set(state.links) == {'lo', 'eth1', 'tgre_0', 'tgre_1'}
+    assert state.addresses == {('eth1', '10.0.0.1/24'), ('tgre_0', '192.168.0.0/31')}
+    assert state.routes == {('default', '10.0.0.254'), ('10.244.1.0/25', '192.168.0.1'),
+                            ('10.96.0.10', '172.18.0.1'), ('10.244.2.0/25', None)}
+    # dst of encapsulation doesn't override dst of the route
+    assert state.encap_routes == {('10.244.2.0/25', '10.0.2.1', 'tgre_ext', '1476')}
+    assert state.iptables_rules == {
+        ('nat', '-A OUTPUT -d 172.18.0.3/32 -j DNAT --to-destination 10.0.1.1'),
+        ('filter', '-A FORWARD -i eth1 -j ACCEPT')}
+
+
+def test_live_state_skips_iptables_unless_requested(live_node):
+    assert reconcile.LiveState('node', with_iptables=False).iptables_rules == set()
+
+
+def test_satisfied_commands_are_filtered_out(live_node):
+    plan = iputils.NetworkPlan()
+    _record(plan, 'node', 'ip', 'link', 'add', 'tgre_0', 'type', 'gre',
+            'remote', '10.0.1.1', 'local', '10.0.0.1')
+    _record(plan, 'node', 'ip', 'link', 'set', 'tgre_0', 'up')
+    _record(plan, 'node', 'ip', 'link', 'set', 'tgre_1', 'up')
+    _record(plan, 'node', 'ip', 'address', 'add', '192.168.0.0/31', 'dev', 'tgre_0')
+    _record(plan, 'node', 'ip', 'route', 'add', '10.244.1.0/25', 'via', '192.168.0.1')
+    _record(plan, 'node', 'ip', 'route', 'add', '10.244.1.128/25', 'via', '192.168.0.1')
+    _record(plan, 'node', 'ip', 'route', 'add', '10.244.2.0/25', 'encap', 'ip', 'dst', '10.0.2.1',
+            'dev', 'tgre_ext', 'mtu', '1476')
+    _record(plan, 'node', 'ip', 'route', 'del', 'default')
+    _record(plan, 'node', 'ip', 'route', 'add', 'default', 'via', '10.0.0.254')
+    _record(plan, 'node', 'iptables', '-t', 'nat', '-A', 'OUTPUT', '-d', '172.18.0.3',
+            '-j', 'DNAT', '--to-destination', '10.0.1.1')
+    _record(plan, 'node', 'iptables', '-t', 'nat', '-A', 'OUTPUT', '-d', '172.18.0.4',
+            '-j', 'DNAT', '--to-destination', '10.0.2.1')
+    _record(plan, 'node', 'iptables', '-t', 'nat', '-D', 'OUTPUT', '-d', '172.18.0.5',
+            '-j', 'DNAT', '--to-destination', '10.0.3.1')
+
+    reconcile.reconcile_plan(plan)
+
+    assert _commands(plan, 'node') == [
+        'link set tgre_1 up',
+        'route add 10.244.1.128/25 via 192.168.0.1',
+        '-t nat -A OUTPUT -d 172.18.0.4 -j DNAT --to-destination 10.0.2.1',
+    ]
+
+
+def test_planned_links_are_pending_for_following_commands(live_node):
+    plan = iputils.NetworkPlan()
+    _record(plan, 'fresh', 'ip', 'link', 'add', 'v0', 'type', 'veth', 'peer', 'name', 'v1')
+    _record(plan, 'fresh', 'ip', 'link', 'set', 'v1', 'netns', 'node')
+    _record(plan, 'fresh', 'tc', 'qdisc', 'add', 'dev', 'v0', 'root', 'netem', 'delay', '1ms')
+
+    reconcile.reconcile_plan(plan, ('tgre_',))
+
+    # v1 doesn't exist yet, but it will, so it has to be moved
+    assert _commands(plan, 'fresh') == ['link add v0 type veth peer name v1', 'link set v1 netns node',
+                                        'qdisc replace dev v0 root netem delay 1ms']
+
+
+def test_unplanned_managed_links_are_deleted(live_node):
+    plan = iputils.NetworkPlan()
+    _record(plan, 'node', 'ip', 'link', 'add', 'tgre_0', 'type', 'gre',
+            'remote', '10.0.1.1', 'local', '10.0.0.1')
+
+    reconcile.reconcile_plan(plan, ('tgre_',))
+
+    stale, = [segment for segment in plan.segments if segment.commands == [['link', 'del', 'tgre_1']]]
+    assert (stale.netns, stale.kind) == ('node', BatchSegment.BATCH)
+    # eth1 isn't managed and lo isn't either
+    assert _commands(plan, 'node') == ['link del tgre_1']
+
+
+def test_links_of_applied_plans_are_not_stale(live_node):
+    applied = iputils.NetworkPlan()
+    _record(applied, 'node', 'ip', 'link', 'add', 'tgre_1', 'type', 'gre',
+            'remote', '10.0.2.1', 'local', '10.0.0.1')
+    plan = iputils.NetworkPlan()
+    _record(plan, 'node', 'ip', 'link', 'add', 'tgre_0', 'type', 'gre',
+            'remote', '10.0.1.1', 'local', '10.0.0.1')
+
+    reconcile.reconcile_plan(plan, ('tgre_',), applied_plans=[applied])
+
+    assert _commands(plan, 'node') == []
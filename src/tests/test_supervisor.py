@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+from util.supervisor import TaskSupervisor, TasksFailedError
+
+
+def _failing(times: int, attempts: list[str], key: str, result: str = None):
+    '''Task that fails its first times attempts'''
+    def task():
+        attempts.append(key)
+        if attempts.count(key) <= times:
+            raise RuntimeError(f'{key} attempt {attempts.count(key)}')
+        return result
+    return task
+
+
+def test_failed_task_is_retried_after_on_retry():
+    attempts, retried = [], []
+    supervisor = TaskSupervisor(4, retries=2, backoff_seconds=0, on_retry=retried.append)
+
+    results = supervisor.run({'a': _failing(2, attempts, 'a', 'ok'), 'b': lambda: 'b'})
+
+    assert results == {'a': 'ok', 'b': 'b'}
+    assert attempts == ['a'] * 3
+    assert retried == ['a', 'a']
+
+
+def test_task_out_of_attempts_raises_its_last_failure():
+    attempts = []
+    supervisor = TaskSupervisor(4, retries=1, backoff_seconds=0)
+
+    with pytest.raises(TasksFailedError) as e:
+        supervisor.run({'a': _failing(5, attempts, 'a')})
+
+    assert attempts == ['a'] * 2
+    assert str(e.value.failures['a']) == 'a attempt 2'
+
+
+def test_outstanding_tasks_are_cancelled_after_first_failure():
+    attempts, started = [], []
+    supervisor = TaskSupervisor(1, retries=0, backoff_seconds=0)
+
+    with pytest.raises(TasksFailedError) as e:
+        supervisor.run({'a': _failing(1, attempts, 'a'), 'b': lambda: started.append('b')})
+
+    # b was queued behind a in the single worker and never started
+    assert started == []
+    assert list(e.value.failures) == ['a']
+
+
+def test_running_task_isnt_retried_after_other_task_failed():
+    attempts = []
+    a_exhausted = threading.Event()
+
+    def failing():
+        attempts.append('a')
+        if attempts.count('a') == 2:
+            a_exhausted.set()
+        raise RuntimeError('a failed')
+
+    def slow_failing():
+        attempts.append('b')
+        a_exhausted.wait(1)
+        # lets supervisor notice the failure of a first
+        time.sleep(0.1)
+        raise RuntimeError('b failed')
+
+    supervisor = TaskSupervisor(2, retries=1, backoff_seconds=0)
+    with pytest.raises(TasksFailedError) as e:
+        supervisor.run({'a': failing, 'b': slow_failing})
+
+    assert attempts.count('b') == 1
+    # failure of the last attempt of b is reported as well
+    assert {key: str(ex) for key, ex in e.value.failures.items()} == {'a': 'a failed', 'b': 'b failed'}
+
+
+def test_failures_of_all_nodes_are_aggregated():
+    barrier = threading.Barrier(3)
+
+    def failing(message: str):
+        def task():
+            barrier.wait(1)
+            raise ValueError(message)
+        return task
+
+    supervisor = TaskSupervisor(3, retries=0)
+    with pytest.raises(TasksFailedError) as e:
+        supervisor.run({'n1': failing('one'), 'n2': failing('two'), 'n3': failing('three')})
+
+    assert {key: str(ex) for key, ex in e.value.failures.items()} == {'n1': 'one', 'n2': 'two', 'n3': 'three'}
+    assert 'Tasks of 3 nodes failed' in str(e.value)
+    assert 'n2: ValueError: two' in str(e.value)
+
+
+def test_timeout_isnt_extended_by_running_tasks():
+    release = threading.Event()
+    supervisor = TaskSupervisor(1, retries=0)
+
+    start = time.monotonic()
+    with pytest.raises(TasksFailedError) as e:
+        supervisor.run({'stuck': lambda: release.wait(5), 'queued': lambda: None}, timeout=0.05)
+    elapsed = time.monotonic() - start
+    release.set()
+
+    assert elapsed < 1
+    assert {key: type(ex) for key, ex in e.value.failures.items()} == {'stuck': TimeoutError, 'queued': TimeoutError}
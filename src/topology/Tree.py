@@ -5,13 +5,17 @@ from typing import Generator, Optional
 from Kathara.model.Lab import Lab as KatharaLab
 from Kathara.model.Machine import Machine as KataharaMachine
 
+import util.aio as aio
+import util.perf as perf
 from core.ClusterBuilder import ClusterBuilder, NetIface
 from core.K8sNode import K8sNode
-from net.util import container_id, run_in_kathara_machine
+from net.util import (container_id, run_in_kathara_machine,
+                      run_in_kathara_machine_async)
 from topology.Builder import TopologyBuilder
 from topology.Node import (LinkConfig, NodeConfig, NodeMeta, NodeType,
                            PeerNameToIpMac)
-from util.containerutils import docker_exec_detached
+from util.containerutils import (docker_exec_detached,
+                                 docker_exec_detached_async)
 from util.iputils import Cidr, TrafficControlInfo, get_subnet
 from util.logger import logger
 from util.macs import mac_generator
@@ -56,6 +60,10 @@ class TreeTopologyBuilder(TopologyBuilder):
         self.node_traffic_control = node_traffic_control
 
     def setup_network(self):
+        with perf.span('setup_network', 'topology'):
+            self._setup_network()
+
+    def _setup_network(self):
         kathara_bridges = self._kathara_bridge_gen()
         link_to_bridge: dict[tuple[str, str], str] = {}
 
@@ -81,7 +89,17 @@ class TreeTopologyBuilder(TopologyBuilder):
     def attach_and_build_cluster(self, cluster: ClusterBuilder) -> dict[str, K8sNode]:
         k8s_nodes = self._connect_cluster_nodes(cluster)
         cluster.build()
-        self._run_after_cluster_built_actions()
+        with perf.span('run_after_cluster_built_actions', 'topology'):
+            self._run_after_cluster_built_actions()
+        return k8s_nodes
+
+    async def attach_and_build_cluster_async(self, cluster: ClusterBuilder) -> dict[str, K8sNode]:
+        '''Builds cluster with build_async, devices are configured concurrently afterwards'''
+        k8s_nodes = self._connect_cluster_nodes(cluster)
+        await cluster.build_async()
+        with perf.span('run_after_cluster_built_actions', 'topology'):
+            await aio.gather(self._run_after_cluster_built_actions_async(node) for node in self._iter_nodes_bfs()
+                             if node.meta.get_type() != NodeType.K8S)
         return k8s_nodes
 
     def kathara_machines(self, *names: list[str]) -> list[KataharaMachine]:
@@ -211,6 +229,16 @@ class TreeTopologyBuilder(TopologyBuilder):
         # in these devices routing should be fully p4-based, don't let OS get in the way
         self._delete_OS_routes_in_inc_switches()
 
+    async def _run_after_cluster_built_actions_async(self, node: TreeNode):
+        # same order as in _run_after_cluster_built_actions, but for a single device
+        if commands := self._build_configure_interfaces_commands(node):
+            await run_in_kathara_machine_async(node.name, commands, self.network.name)
+        if node.meta.get_type() == NodeType.INC_SWITCH:
+            if node.meta.inc_switch_meta().simple_switch_cli_commands is not None:
+                await docker_exec_detached_async(container_id(node.name, self.network.name), './s.sh')
+            await run_in_kathara_machine_async(
+                node.name, [f'ip route del {network_ip}' for network_ip in self._get_OS_routes(node)], self.network.name)
+
     def _execute_simple_switch_CLI_commands(self):
         for node in self._iter_nodes_bfs():
             if node.meta.get_type() == NodeType.INC_SWITCH and node.meta.inc_switch_meta().simple_switch_cli_commands is not None:
@@ -220,14 +248,19 @@ class TreeTopologyBuilder(TopologyBuilder):
     def _delete_OS_routes_in_inc_switches(self):
         for node in self._iter_nodes_bfs():
             if node.meta.get_type() == NodeType.INC_SWITCH:
-                for (masked_ip, _) in node.connection_ip_macs.values():
-                    ip, mask = masked_ip.split('/')
-                    network_ip = get_subnet(
-                        Cidr(ipv4=ip, netmask=int(mask))).masked_ip
+                for network_ip in self._get_OS_routes(node):
                     run_in_kathara_machine(self.network.get_machine(node.name), [
                         f'ip route del {network_ip}',
                     ], self.network.name)
 
+    def _get_OS_routes(self, node: TreeNode) -> list[str]:
+        routes = []
+        for (masked_ip, _) in node.connection_ip_macs.values():
+            ip, mask = masked_ip.split('/')
+            routes.append(get_subnet(
+                Cidr(ipv4=ip, netmask=int(mask))).masked_ip)
+        return routes
+
     def _configure_interfaces(self):
         for node in self._iter_nodes_bfs():
             node_type = node.meta.get_type()
@@ -0,0 +1,55 @@
+import asyncio
+import subprocess as sp
+import time
+import weakref
+from typing import Any, Awaitable, Iterable
+
+import util.perf as perf
+
+# used for namespace and container commands of network plans, kind, kubectl and docker API calls stay blocking
+# commands are cheap to wait for, this bounds processes and open pipes rather than threads
+MAX_CONCURRENT_COMMANDS = 256
+
+_semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = \
+    weakref.WeakKeyDictionary()
+
+
+@perf.runner
+async def run(commands: list[str], netns: str = None, input: str = None,
+              timeout: float = None) -> sp.CompletedProcess[str]:
+    '''Event loop counterpart of perf.run with captured text output, at most MAX_CONCURRENT_COMMANDS run at once'''
+    async with _get_semaphore():
+        start = time.perf_counter()
+        returncode = None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *commands, stdin=sp.PIPE if input is not None else sp.DEVNULL, stdout=sp.PIPE, stderr=sp.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(input.encode() if input is not None else None), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise sp.TimeoutExpired(list(commands), timeout)
+            returncode = proc.returncode
+        finally:
+            perf.record(commands, netns, start,
+                        time.perf_counter() - start, returncode)
+
+    return sp.CompletedProcess(list(commands), returncode, stdout.decode(), stderr.decode())
+
+
+async def gather(aws: Iterable[Awaitable[Any]]) -> list[Any]:
+    '''Awaits all, the first exception is raised after every awaitable has finished'''
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    if failed := [res for res in results if isinstance(res, BaseException)]:
+        raise failed[0]
+    return results
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    # asyncio primitives are bound to the loop they are first used in
+    loop = asyncio.get_running_loop()
+    if (semaphore := _semaphores.get(loop)) is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_COMMANDS)
+    return semaphore
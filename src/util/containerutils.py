@@ -1,10 +1,83 @@
+import json
 import subprocess as sp
-
-
-def get_container_pid(container_id: str) -> str:
-    output = sp.run(['docker', 'inspect', '-f', '{{.State.Pid}}', container_id],
-                    capture_output=True, text=True)
-    return output.stdout.strip()
+import threading
+from typing import NamedTuple
+
+import util.aio as aio
+import util.dockerapi as dockerapi
+import util.perf as perf
+
+_SHORT_ID_LENGTH = 12
+
+
+class ContainerInfo(NamedTuple):
+    id: str
+    name: str
+    pid: str
+    labels: dict[str, str]
+
+    @property
+    def short_id(self) -> str:
+        return self.id[:_SHORT_ID_LENGTH]
+
+    @property
+    def keys(self) -> tuple[str, str, str]:
+        return self.id, self.short_id, self.name
+
+
+class ContainerRegistry:
+    '''
+    Containers used by the build, ids, names and pids are fetched with a single bulk inspect
+    and cached until invalidated. Containers can be looked up by full or short id and by name.
+    '''
+
+    def __init__(self) -> None:
+        self._containers: dict[str, ContainerInfo] = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, container_id: str = None):
+        with self._lock:
+            if container_id is None:
+                self._containers.clear()
+            elif (info := self._containers.get(container_id)) is not None:
+                for key in info.keys:
+                    self._containers.pop(key, None)
+
+    def discover(self, *labels: str) -> list[ContainerInfo]:
+        '''Inspects running containers having all labels, each given as key or key=value'''
+        return self._inspect(list_container_ids(*labels))
+
+    def prefetch(self, container_ids: list[str]):
+        with self._lock:
+            missing = list(dict.fromkeys(x for x in container_ids if x not in self._containers))
+        if missing:
+            self._inspect(missing)
+
+    def get(self, container_id: str) -> ContainerInfo:
+        with self._lock:
+            info = self._containers.get(container_id)
+        if info is None:
+            infos = self._inspect([container_id])
+            assert infos, f'Container {container_id} does not exist'
+            info = infos[0]
+        return info
+
+    def get_pid(self, container_id: str) -> str:
+        return self.get(container_id).pid
+
+    def _inspect(self, container_ids: list[str]) -> list[ContainerInfo]:
+        if not container_ids:
+            return []
+        infos = [ContainerInfo(x['Id'], x['Name'].lstrip('/'), str(x['State']['Pid']), x['Config']['Labels'] or {})
+                 for x in inspect_containers(container_ids)]
+        with self._lock:
+            for info in infos:
+                for key in info.keys:
+                    self._containers[key] = info
+        return infos
+
+
+containers = ContainerRegistry()
 
 
 def create_namespace_name(container_pid: str) -> str:
@@ -12,18 +85,29 @@ def create_namespace_name(container_pid: str) -> str:
 
 
 def attach_netns_to_host(container_pid: str, netns_name: str):
-    res = sp.run(['ip', 'netns', 'attach', netns_name,
-                 container_pid], capture_output=True, text=True)
+    res = perf.run(['ip', 'netns', 'attach', netns_name,
+                   container_pid], capture_output=True, text=True)
     assert res.returncode == 0, f'Failed to attach namespace: {netns_name} to host'
 
 
+@perf.runner
 def docker_exec_it(container_id: str, *commands: list[str]) -> sp.CompletedProcess[str]:
-    return sp.run(['docker', 'exec', '-it', container_id, *commands], text=True,
-                  capture_output=True)
+    if (client := dockerapi.get_client()) is not None:
+        return client.exec(container_id, *commands)
+    return perf.run(['docker', 'exec', '-it', container_id, *commands], text=True,
+                    capture_output=True)
 
 
+@perf.runner
 def docker_exec_detached(container_id: str, *commands: list[str]):
-    return sp.run(['docker', 'exec', '-d', container_id, *commands], text=True, capture_output=True)
+    if (client := dockerapi.get_client()) is not None:
+        return client.exec(container_id, *commands, detach=True)
+    return perf.run(['docker', 'exec', '-d', container_id, *commands], text=True, capture_output=True)
+
+
+@perf.runner
+async def docker_exec_detached_async(container_id: str, *commands: list[str]) -> sp.CompletedProcess[str]:
+    return await aio.run(['docker', 'exec', '-d', container_id, *commands])
 
 
 def is_process_running(container_id: str, proc_name: str) -> bool:
@@ -31,13 +115,29 @@ def is_process_running(container_id: str, proc_name: str) -> bool:
     return docker_exec_it(container_id, 'pidof', proc_name).returncode == 0
 
 
-def docker_ps() -> str:
-    return sp.run(['docker', 'ps'], capture_output=True, text=True).stdout
+def list_container_ids(*labels: str) -> list[str]:
+    '''Ids of running containers having all labels, each given as key or key=value'''
+    if (client := dockerapi.get_client()) is not None:
+        return [container['Id'] for container in client.list_containers({'label': list(labels)})]
+    filters = [arg for label in labels for arg in ('--filter', f'label={label}')]
+    res = perf.run(['docker', 'ps', '-q', '--no-trunc', *filters],
+                   capture_output=True, text=True)
+    return res.stdout.split()
+
+
+def inspect_containers(container_ids: list[str]) -> list[dict]:
+    if (client := dockerapi.get_client()) is not None:
+        return client.inspect_containers(container_ids)
+    res = perf.run(['docker', 'inspect', *container_ids],
+                   capture_output=True, text=True)
+    return json.loads(res.stdout) if res.stdout.strip() else []
 
 
 def copy_to_container(container_id: str, host_path: str, container_path: str):
-    sp.run(['docker', 'cp', host_path,
-           f'{container_id}:{container_path}'], capture_output=True, text=True)
+    if (client := dockerapi.get_client()) is not None:
+        return client.put_file(container_id, host_path, container_path)
+    perf.run(['docker', 'cp', host_path,
+             f'{container_id}:{container_path}'], capture_output=True, text=True)
 
 
 def turn_off_tcp_checksum_offloading(container_id: str, iface_name: str):
@@ -45,6 +145,16 @@ def turn_off_tcp_checksum_offloading(container_id: str, iface_name: str):
                          iface_name, 'rx', 'off', 'tx', 'off')
 
 
+async def turn_off_tcp_checksum_offloading_async(container_id: str, iface_name: str):
+    await docker_exec_detached_async(container_id, 'ethtool', '-K',
+                                     iface_name, 'rx', 'off', 'tx', 'off')
+
+
+def remove_container(container_id: str):
+    containers.invalidate(container_id)
+    perf.run(['docker', 'rm', '-f', container_id], capture_output=True, text=True)
+
+
 def copy_and_run_script_in_container(container_id: str, script_host_path: str, script_container_path: str):
     copy_to_container(container_id, script_host_path, script_container_path)
     docker_exec_it(container_id, script_container_path)
@@ -0,0 +1,219 @@
+import http.client
+import io
+import json
+import os
+import select
+import socket
+import struct
+import subprocess as sp
+import tarfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import util.perf as perf
+from util.logger import logger
+
+DOCKER_SOCKET_PATH = '/var/run/docker.sock'
+_API_VERSION = 'v1.41'
+_STREAM_HEADER = struct.Struct('>BxxxI')
+_STDOUT, _STDERR = 1, 2
+_MAX_CONCURRENT_INSPECTS = 8
+# daemon may close idle keep-alive connection, the request then fails without having reached it
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+# only these are sent again if connection drops after the request was written, daemon may have processed it
+_IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+
+class DockerApiError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f'Docker API returned {status}: {message}')
+        self.status = status
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None) -> None:
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerClient:
+    '''
+    Minimal Docker Engine API client, keeps idle keep-alive connections to the daemon socket
+    so that calls don't pay for CLI startup and connection setup.
+    '''
+
+    def __init__(self, socket_path: str = DOCKER_SOCKET_PATH, timeout: float = None) -> None:
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._idle: list[_UnixHTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def ping(self) -> bool:
+        try:
+            self._request('GET', '/_ping')
+            return True
+        except (OSError, http.client.HTTPException, DockerApiError):
+            return False
+
+    @perf.runner
+    def list_containers(self, filters: dict[str, list[str]] = None) -> list[dict[str, Any]]:
+        query = {'filters': json.dumps(filters)} if filters else {}
+        return self._request_json('GET', '/containers/json', query)
+
+    @perf.runner
+    def inspect_container(self, container_id: str) -> dict[str, Any]:
+        return self._request_json('GET', f'/containers/{container_id}/json')
+
+    @perf.runner
+    def inspect_containers(self, container_ids: list[str]) -> list[dict[str, Any]]:
+        # API has no bulk inspect, requests are issued concurrently over pooled keep-alive connections instead
+        if len(container_ids) <= 1:
+            return [self.inspect_container(container_id) for container_id in container_ids]
+        with ThreadPoolExecutor(max_workers=min(_MAX_CONCURRENT_INSPECTS, len(container_ids))) as executor:
+            return list(executor.map(self.inspect_container, container_ids))
+
+    @perf.runner
+    def exec(self, container_id: str, *commands: str, detach: bool = False) -> sp.CompletedProcess[str]:
+        exec_id = self._request_json('POST', f'/containers/{container_id}/exec', body={
+            'Cmd': list(commands), 'AttachStdout': not detach, 'AttachStderr': not detach, 'Tty': False
+        })['Id']
+        if detach:
+            self._request('POST', f'/exec/{exec_id}/start', body={'Detach': True, 'Tty': False})
+            return sp.CompletedProcess(list(commands), 0, '', '')
+
+        stream = self._request('POST', f'/exec/{exec_id}/start', body={'Detach': False, 'Tty': False})
+        stdout, stderr = _demultiplex(stream)
+        exit_code = self._request_json('GET', f'/exec/{exec_id}/json')['ExitCode']
+        return sp.CompletedProcess(list(commands), exit_code, stdout, stderr)
+
+    @perf.runner
+    def put_file(self, container_id: str, host_path: str, container_path: str):
+        '''Uploads file as a tar archive, same as docker cp of a single file'''
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.add(host_path, arcname=os.path.basename(container_path))
+        self._request('PUT', f'/containers/{container_id}/archive',
+                      {'path': os.path.dirname(container_path) or '/'}, raw_body=archive.getvalue(),
+                      content_type='application/x-tar')
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    @perf.runner
+    def _request_json(self, method: str, path: str, query: dict[str, str] = None, body: Any = None) -> Any:
+        return json.loads(self._request(method, path, query, body))
+
+    @perf.runner
+    def _request(self, method: str, path: str, query: dict[str, str] = None, body: Any = None,
+                 raw_body: bytes = None, content_type: str = 'application/json') -> bytes:
+        url = f'/{_API_VERSION}{path}'
+        if query:
+            url += f'?{urllib.parse.urlencode(query)}'
+        if body is not None:
+            raw_body = json.dumps(body).encode()
+        headers = {'Content-Type': content_type} if raw_body is not None else {}
+
+        start = time.perf_counter()
+        status = None
+        try:
+            status, data = self._send(method, url, raw_body, headers)
+        finally:
+            perf.record(['docker-api', path.split('/')[1], method], None, start,
+                        time.perf_counter() - start, status)
+
+        if status >= 400:
+            raise DockerApiError(status, data.decode(errors='replace').strip())
+        return data
+
+    def _send(self, method: str, url: str, raw_body: bytes | None, headers: dict[str, str],
+              pooled: bool = True) -> tuple[int, bytes]:
+        '''
+        Request failing on a stale pooled connection is sent once more over a fresh one, unless it's
+        not idempotent and connection dropped only after it was written, e.g. exec must not run twice
+        '''
+        conn, reused = self._acquire(pooled)
+        written = False
+        try:
+            conn.request(method, url, body=raw_body, headers=headers)
+            written = True
+            res = conn.getresponse()
+            data = res.read()
+        except _STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused or (written and method not in _IDEMPOTENT_METHODS):
+                raise
+            return self._send(method, url, raw_body, headers, pooled=False)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+
+        if res.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return res.status, data
+
+    def _acquire(self, pooled: bool = True) -> tuple[_UnixHTTPConnection, bool]:
+        '''Returns connection and whether it was taken from the idle pool'''
+        if pooled:
+            with self._lock:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if not _is_closed_by_peer(conn):
+                        return conn, True
+                    conn.close()
+        return _UnixHTTPConnection(self.socket_path, self.timeout), False
+
+    def _release(self, conn: _UnixHTTPConnection):
+        with self._lock:
+            self._idle.append(conn)
+
+
+def _is_closed_by_peer(conn: _UnixHTTPConnection) -> bool:
+    # idle connection has nothing to read unless the daemon closed it
+    return conn.sock is None or bool(select.select([conn.sock], [], [], 0)[0])
+
+
+def _demultiplex(stream: bytes) -> tuple[str, str]:
+    '''Splits attached stream of non-tty exec into stdout and stderr'''
+    outputs = {_STDOUT: io.BytesIO(), _STDERR: io.BytesIO()}
+    offset = 0
+    while offset + _STREAM_HEADER.size <= len(stream):
+        kind, size = _STREAM_HEADER.unpack_from(stream, offset)
+        offset += _STREAM_HEADER.size
+        if kind in outputs:
+            outputs[kind].write(stream[offset:offset + size])
+        offset += size
+    return outputs[_STDOUT].getvalue().decode(errors='replace'), outputs[_STDERR].getvalue().decode(errors='replace')
+
+
+_client: DockerClient | None = None
+_client_resolved = False
+_client_lock = threading.Lock()
+
+
+def get_client() -> DockerClient | None:
+    '''Shared client, None if daemon socket isn't accessible and docker CLI should be used instead'''
+    global _client, _client_resolved
+    with _client_lock:
+        if not _client_resolved:
+            client = DockerClient()
+            if client.ping():
+                _client = client
+            else:
+                logger.info(
+                    f'Docker socket {DOCKER_SOCKET_PATH} is not accessible, falling back to docker CLI')
+            _client_resolved = True
+        return _client
@@ -0,0 +1,188 @@
+from typing import Any, Generator, Iterable
+
+from util.iputils import Cidr, decimal_to_dot_notation
+
+
+class _Node:
+    __slots__ = ('start', 'end', 'seq', 'value', 'max_end', 'height', 'left', 'right')
+
+    def __init__(self, start: int, end: int, seq: int, value: Any) -> None:
+        self.start = start
+        self.end = end
+        self.seq = seq
+        self.value = value
+        self.max_end = end
+        self.height = 1
+        self.left: _Node | None = None
+        self.right: _Node | None = None
+
+
+class IntervalTree:
+    '''
+    AVL tree of closed integer intervals ordered by start, every node keeps the maximal end of its subtree
+    so that overlap queries visit only subtrees that may contain a match: O(log n + k) for k results.
+    '''
+
+    def __init__(self) -> None:
+        self._root: _Node | None = None
+        self._size = 0
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, start: int, end: int, value: Any = None):
+        assert start <= end, f'Invalid interval [{start}, {end}]'
+        self._seq += 1
+        self._root = self._insert(self._root, _Node(start, end, self._seq, value))
+        self._size += 1
+
+    def remove(self, start: int, end: int, value: Any = None) -> bool:
+        for node in self._overlapping_nodes(start, end):
+            if node.start == start and node.end == end and node.value == value:
+                self._root = self._remove(self._root, self._key(node))
+                self._size -= 1
+                return True
+        return False
+
+    def overlapping(self, start: int, end: int) -> Generator[tuple[int, int, Any], None, None]:
+        for node in self._overlapping_nodes(start, end):
+            yield node.start, node.end, node.value
+
+    def first_overlapping(self, start: int, end: int) -> tuple[int, int, Any] | None:
+        '''Returns overlapping interval with the lowest start'''
+        node, found = self._root, None
+        while node is not None:
+            if node.left is not None and node.left.max_end >= start:
+                node = node.left
+            elif node.start <= end and start <= node.end:
+                found = node
+                break
+            elif node.start <= end:
+                node = node.right
+            else:
+                break
+        return None if found is None else (found.start, found.end, found.value)
+
+    def _overlapping_nodes(self, start: int, end: int) -> Generator[_Node, None, None]:
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_end < start:
+                continue
+            stack.append(node.left)
+            if node.start <= end:
+                if start <= node.end:
+                    yield node
+                stack.append(node.right)
+
+    def _insert(self, root: _Node | None, node: _Node) -> _Node:
+        if root is None:
+            return node
+        if self._key(node) < self._key(root):
+            root.left = self._insert(root.left, node)
+        else:
+            root.right = self._insert(root.right, node)
+        return self._rebalance(root)
+
+    def _remove(self, root: _Node | None, key: tuple[int, int, int]) -> _Node | None:
+        if root is None:
+            return None
+        if key < self._key(root):
+            root.left = self._remove(root.left, key)
+        elif key > self._key(root):
+            root.right = self._remove(root.right, key)
+        else:
+            if root.left is None or root.right is None:
+                return root.left or root.right
+            successor = root.right
+            while successor.left is not None:
+                successor = successor.left
+            root.start, root.end, root.seq, root.value = \
+                successor.start, successor.end, successor.seq, successor.value
+            root.right = self._remove(root.right, self._key(successor))
+        return self._rebalance(root)
+
+    @staticmethod
+    def _key(node: _Node) -> tuple[int, int, int]:
+        return node.start, node.end, node.seq
+
+    def _rebalance(self, node: _Node) -> _Node:
+        self._update(node)
+        balance = self._height(node.left) - self._height(node.right)
+        if balance > 1:
+            if self._height(node.left.left) < self._height(node.left.right):
+                node.left = self._rotate_left(node.left)
+            return self._rotate_right(node)
+        if balance < -1:
+            if self._height(node.right.right) < self._height(node.right.left):
+                node.right = self._rotate_right(node.right)
+            return self._rotate_left(node)
+        return node
+
+    def _rotate_left(self, node: _Node) -> _Node:
+        pivot = node.right
+        node.right, pivot.left = pivot.left, node
+        self._update(node)
+        self._update(pivot)
+        return pivot
+
+    def _rotate_right(self, node: _Node) -> _Node:
+        pivot = node.left
+        node.left, pivot.right = pivot.right, node
+        self._update(node)
+        self._update(pivot)
+        return pivot
+
+    def _update(self, node: _Node):
+        node.height = 1 + max(self._height(node.left), self._height(node.right))
+        node.max_end = max(node.end,
+                           node.left.max_end if node.left is not None else node.end,
+                           node.right.max_end if node.right is not None else node.end)
+
+    @staticmethod
+    def _height(node: _Node | None) -> int:
+        return 0 if node is None else node.height
+
+
+class Ipam:
+    '''
+    Tracks address ranges used by the cluster, hands out free subnets from pools
+    and detects overlaps with used and forbidden networks.
+    '''
+
+    def __init__(self, forbidden_networks: Iterable[Cidr] = ()) -> None:
+        self._forbidden = IntervalTree()
+        self._used = IntervalTree()
+        for cidr in forbidden_networks:
+            self._forbidden.insert(cidr.first, cidr.last, cidr)
+
+    def find_forbidden_overlap(self, cidr: Cidr) -> Cidr | None:
+        res = self._forbidden.first_overlapping(cidr.first, cidr.last)
+        return None if res is None else res[2]
+
+    def find_used_overlaps(self, cidr: Cidr) -> list[tuple[Cidr, Any]]:
+        return [value for _, _, value in self._used.overlapping(cidr.first, cidr.last)]
+
+    def reserve(self, cidr: Cidr, owner: Any = None):
+        '''Marks network as used, overlapping reservations are allowed (e.g. nodes connected to the same network)'''
+        self._used.insert(cidr.first, cidr.last, (cidr, owner))
+
+    def release(self, cidr: Cidr, owner: Any = None) -> bool:
+        return self._used.remove(cidr.first, cidr.last, (cidr, owner))
+
+    def allocate(self, pool: Cidr, netmask: int, owner: Any = None, start_at: str = None) -> Cidr:
+        '''Reserves the lowest free subnet of given size within pool, optionally not lower than start_at'''
+        assert netmask >= pool.netmask, f'Can\'t allocate /{netmask} from {pool.masked_ip}'
+        size = 1 << (32 - netmask)
+        candidate = pool.first if start_at is None else Cidr(start_at, netmask).first
+        while candidate + size - 1 <= pool.last:
+            overlap = self._used.first_overlapping(candidate, candidate + size - 1)
+            if overlap is None:
+                cidr = Cidr(decimal_to_dot_notation(candidate), netmask)
+                self.reserve(cidr, owner)
+                return cidr
+            # skip past the conflicting range, keeping the subnet aligned
+            candidate = (overlap[1] // size + 1) * size
+
+        raise Exception(f'No free /{netmask} subnet left in {pool.masked_ip}')
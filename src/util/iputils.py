@@ -1,40 +1,127 @@
+import asyncio
+import json
 import random
 import re
 import socket
 import subprocess as sp
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import NamedTuple
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Callable, Generator, NamedTuple
 
+import util.aio as aio
+import util.nsagent as nsagent
+import util.perf as perf
 from util.logger import logger
 
+if TYPE_CHECKING:
+    from util.netlink import NetlinkBackend
+
 Netns = str | None
 HOST_NS: Netns = None
 
 
-class Cidr(NamedTuple):
-    ipv4: str
-    netmask: int
+class IpBackend(Enum):
+    SUBPROCESS = 'subprocess'
+    NETLINK = 'netlink'
+
+
+class TunnelEncapsulation(Enum):
+    GRE = 'gre'
+    GRE_FOU = 'gre-fou'
+    VXLAN = 'vxlan'
+
+    @property
+    def overhead(self) -> int:
+        # outer IPv4 header + encapsulation headers (+ inner ethernet header for vxlan)
+        return {
+            TunnelEncapsulation.GRE: 20 + 4,
+            TunnelEncapsulation.GRE_FOU: 20 + 8 + 4,
+            TunnelEncapsulation.VXLAN: 20 + 8 + 8 + 14,
+        }[self]
+
+
+class Cidr:
+    '''IPv4 or IPv6 address with netmask, address is parsed once and kept as integer'''
+    __slots__ = ('ipv4', 'netmask', 'address', 'bits')
+
+    def __init__(self, ipv4: str, netmask: int) -> None:
+        self.ipv4 = ipv4
+        self.netmask = netmask
+        if ':' in ipv4:
+            self.bits = 128
+            self.address = int.from_bytes(socket.inet_pton(socket.AF_INET6, ipv4), 'big')
+        else:
+            self.bits = 32
+            self.address = dot_notation_to_decimal(ipv4)
+
+    @staticmethod
+    def from_int(address: int, netmask: int, bits: int = 32) -> 'Cidr':
+        if bits == 32:
+            return Cidr(decimal_to_dot_notation(address), netmask)
+        return Cidr(socket.inet_ntop(socket.AF_INET6, address.to_bytes(16, 'big')), netmask)
+
+    def __repr__(self) -> str:
+        return f'Cidr(ipv4={self.ipv4!r}, netmask={self.netmask!r})'
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Cidr) and self.bits == other.bits \
+            and self.address == other.address and self.netmask == other.netmask
+
+    def __hash__(self) -> int:
+        return hash((self.bits, self.address, self.netmask))
+
+    def __iter__(self):
+        return iter((self.ipv4, self.netmask))
+
+    @property
+    def is_ipv6(self) -> bool:
+        return self.bits == 128
+
+    @property
+    def host_mask(self) -> int:
+        return (1 << (self.bits - self.netmask)) - 1
+
+    @property
+    def mask(self) -> int:
+        return ((1 << self.bits) - 1) ^ self.host_mask
+
+    @property
+    def first(self) -> int:
+        return self.address & self.mask
+
+    @property
+    def last(self) -> int:
+        return self.first | self.host_mask
 
     @property
     def first_octet(self) -> str:
-        return get_nth_octet(self.ipv4, 0)
+        return str((self.address >> 24) & 0xFF)
 
     @property
     def second_octet(self) -> str:
-        return get_nth_octet(self.ipv4, 1)
+        return str((self.address >> 16) & 0xFF)
 
     @property
     def third_octet(self) -> str:
-        return get_nth_octet(self.ipv4, 2)
+        return str((self.address >> 8) & 0xFF)
 
     @property
     def fourth_octet(self) -> str:
-        return get_nth_octet(self.ipv4, 3)
+        return str(self.address & 0xFF)
 
     @property
     def masked_ip(self) -> str:
         return f'{self.ipv4}/{self.netmask}'
 
+    def overlaps(self, other: 'Cidr') -> bool:
+        return self.bits == other.bits and self.first <= other.last and other.first <= self.last
+
+    def contains(self, other: 'Cidr') -> bool:
+        return self.bits == other.bits and self.netmask <= other.netmask and self.first <= other.first <= self.last
+
 
 class TrafficControlInfo(NamedTuple):
     latency_ms: int
@@ -42,7 +129,7 @@ class TrafficControlInfo(NamedTuple):
     burst_kbitps: int
 
 
-@dataclass
+@dataclass(slots=True)
 class NetIface:
     name: str
     ipv4: str
@@ -56,34 +143,575 @@ class NetIface:
         return Cidr(self.ipv4, self.netmask)
 
 
-def _run_sp(*commands: list[str], log_error=True) -> sp.CompletedProcess[str]:
-    res = sp.run(['sudo', *commands], capture_output=True, text=True)
+class PlanningError(Exception):
+    pass
+
+
+class BatchError(NamedTuple):
+    netns: Netns
+    command: str
+    message: str
+
+
+class BatchSegment:
+    BATCH = 'batch'
+    RESTORE = 'restore'
+    EXEC = 'exec'
+    NETLINK = 'netlink'
+
+    def __init__(self, netns: Netns, tool: str, kind: str, deps: list['BatchSegment']) -> None:
+        self.netns = netns
+        self.tool = tool
+        self.kind = kind
+        self.deps = deps
+        self.commands: list[list[str]] = []
+        self.log_errors: list[bool] = []
+        self.calls: list[tuple[str, tuple]] = []
+
+    def add(self, args: list[str], log_error: bool):
+        self.commands.append(args)
+        self.log_errors.append(log_error)
+
+    def add_call(self, method: str, args: tuple):
+        self.commands.append(
+            [method, *(arg.name if isinstance(arg, NetIface) else str(arg) for arg in args)])
+        self.calls.append((method, args))
+
+    def copy(self, deps: list['BatchSegment']) -> 'BatchSegment':
+        segment = BatchSegment(self.netns, self.tool, self.kind, deps)
+        segment.commands = [list(args) for args in self.commands]
+        segment.log_errors = list(self.log_errors)
+        segment.calls = list(self.calls)
+        return segment
+
+    def discard(self, is_obsolete: Callable[[list[str]], bool]):
+        keep = [not is_obsolete(args) for args in self.commands]
+        self.commands = [args for args, kept in zip(self.commands, keep) if kept]
+        # netlink segments track calls instead of error logging flags
+        self.log_errors = [flag for flag, kept in zip(self.log_errors, keep) if kept]
+        self.calls = [call for call, kept in zip(self.calls, keep) if kept]
+
+    def run(self) -> list[BatchError]:
+        if not self.commands:
+            return []
+        if self.kind == self.NETLINK:
+            with _netlink.collect_errors() as netlink_errors:
+                for method, args in self.calls:
+                    getattr(_netlink, method)(self.netns, *args)
+            if self.netns is HOST_NS:
+                host_addresses.invalidate()
+            return [BatchError(error.netns, f'{error.operation} {error.args}', error.message)
+                    for error in netlink_errors]
+        if self.kind == self.RESTORE:
+            return self._run_iptables_restore()
+        if self.kind == self.EXEC:
+            return self._run_one_by_one()
+        return self._run_batch()
+
+    async def run_async(self) -> list[BatchError]:
+        if not self.commands:
+            return []
+        if self.kind == self.NETLINK:
+            # netlink calls are synchronous socket roundtrips
+            return await asyncio.to_thread(self.run)
+        if self.kind == self.RESTORE:
+            res = await _exec_in_namespace_async(self.netns, 'iptables-restore', '--noflush',
+                                                 log_error=False, input=self._iptables_restore_payload())
+            if res.returncode == 0:
+                return []
+            self._log_iptables_restore_failure(res)
+            return await self._run_one_by_one_async()
+        if self.kind == self.EXEC:
+            return await self._run_one_by_one_async()
+        res = await _exec_in_namespace_async(self.netns, self.tool, '-force', '-batch', '-',
+                                             log_error=False, input=self._batch_input())
+        return self._get_batch_errors(res)
+
+    def _run_one_by_one(self) -> list[BatchError]:
+        errors = []
+        for args, log_error in zip(self.commands, self.log_errors):
+            res = _exec_in_namespace(
+                self.netns, self.tool, *args, log_error=log_error)
+            if res.returncode != 0:
+                errors.append(BatchError(
+                    self.netns, ' '.join([self.tool, *args]), res.stderr))
+        return errors
+
+    async def _run_one_by_one_async(self) -> list[BatchError]:
+        errors = []
+        for args, log_error in zip(self.commands, self.log_errors):
+            res = await _exec_in_namespace_async(
+                self.netns, self.tool, *args, log_error=log_error)
+            if res.returncode != 0:
+                errors.append(BatchError(
+                    self.netns, ' '.join([self.tool, *args]), res.stderr))
+        return errors
+
+    def _run_batch(self) -> list[BatchError]:
+        res = _exec_in_namespace(self.netns, self.tool, '-force', '-batch', '-',
+                                 log_error=False, input=self._batch_input())
+        return self._get_batch_errors(res)
+
+    def _batch_input(self) -> str:
+        return ''.join(f'{" ".join(args)}\n' for args in self.commands)
+
+    def _get_batch_errors(self, res: sp.CompletedProcess[str]) -> list[BatchError]:
+        lines = [' '.join(args) for args in self.commands]
+        errors = []
+        message_lines = []
+        for line in res.stderr.splitlines():
+            if match := re.match(r'Command failed -:(\d+)', line):
+                idx = int(match.group(1)) - 1
+                error = BatchError(self.netns, f'{self.tool} {lines[idx]}',
+                                   '\n'.join(message_lines))
+                if self.log_errors[idx]:
+                    logger.error(
+                        f'Batched command {error.command} in namespace {self.netns} failed\nstd_err: {error.message}')
+                errors.append(error)
+                message_lines = []
+            else:
+                message_lines.append(line)
+
+        if res.returncode != 0 and not errors:
+            errors.append(BatchError(self.netns, f'{self.tool} -batch', res.stderr))
+            logger.error(
+                f'Batch of {len(lines)} {self.tool} commands in namespace {self.netns} failed\nstd_err: {res.stderr}')
+        return errors
+
+    def _run_iptables_restore(self) -> list[BatchError]:
+        res = _exec_in_namespace(self.netns, 'iptables-restore', '--noflush',
+                                 log_error=False, input=self._iptables_restore_payload())
+        if res.returncode == 0:
+            return []
+        self._log_iptables_restore_failure(res)
+        return self._run_one_by_one()
+
+    def _iptables_restore_payload(self) -> str:
+        tables: dict[str, list[str]] = {}
+        for args in self.commands:
+            table, rule = split_iptables_table(args)
+            tables.setdefault(table, []).append(' '.join(rule))
+
+        return ''.join(f'*{table}\n' + ''.join(f'{rule}\n' for rule in rules) + 'COMMIT\n'
+                       for table, rules in tables.items())
+
+    def _log_iptables_restore_failure(self, res: sp.CompletedProcess[str]):
+        # restore is atomic, nothing got applied, caller falls back to rule by rule application to find culprits
+        logger.warning(
+            f'iptables-restore of {len(self.commands)} rules in namespace {self.netns} failed, '
+            f'applying them one by one\nstd_err: {res.stderr}')
+
+
+def split_iptables_table(args: list[str]) -> tuple[str, list[str]]:
+    if '-t' not in args:
+        return 'filter', args
+    idx = args.index('-t')
+    return args[idx + 1], args[:idx] + args[idx + 2:]
+
+
+class IpBatch:
+    '''
+    Collects ip/tc commands and executes them with a single `<tool> -n <netns> -batch` call per namespace,
+    iptables rule insertions/deletions are applied with a single `iptables-restore --noflush` call instead.
+
+    Relative order of commands targeting the same namespace is preserved, an interface moved to
+    other namespace is configured there only after the move has been executed.
+    '''
+    _BATCHED_TOOLS = ('ip', 'tc')
+    _MUTATING_VERBS = ('add', 'del', 'delete', 'set', 'change', 'replace')
+    _IPTABLES_RULE_OPS = ('-A', '-I', '-D')
+    # other netns subcommands either produce output or run processes
+    _BATCHED_NETNS_VERBS = ('delete', 'del')
+
+    def __init__(self) -> None:
+        self.segments: list[BatchSegment] = []
+        self.errors: list[BatchError] = []
+        self._reset()
+
+    def accepts(self, commands: tuple[str, ...]) -> bool:
+        return self._kind_of(commands) != BatchSegment.EXEC
+
+    def enqueue(self, netns: Netns, commands: tuple[str, ...], log_error: bool):
+        tool, *args = commands
+        segment = self._segment_for(netns, tool, self._kind_of(commands))
+        segment.add(args, log_error)
+
+        if tool == 'ip' and args[:2] == ['link', 'set'] and 'netns' in args:
+            self._moved_to(args[args.index('netns') + 1], segment)
+
+    def enqueue_call(self, netns: Netns, method: str, args: tuple):
+        segment = self._segment_for(
+            netns, BatchSegment.NETLINK, BatchSegment.NETLINK)
+        segment.add_call(method, args)
+
+        if method == 'move_iface_to_netns':
+            self._moved_to(args[0], segment)
+
+    def flush(self) -> list[BatchError]:
+        segments = self.segments
+        self._reset()
+
+        errors = []
+        for segment in segments:
+            errors.extend(segment.run())
+        self.errors.extend(errors)
+        return errors
+
+    def _reset(self):
+        self.segments = []
+        self._open_segments: dict[Netns, BatchSegment] = {}
+        self._last_segments: dict[Netns, BatchSegment] = {}
+        self._move_deps: dict[Netns, list[BatchSegment]] = {}
+
+    def _kind_of(self, commands: tuple[str, ...]) -> str:
+        if commands and commands[0] == 'iptables' and any(op in commands for op in self._IPTABLES_RULE_OPS):
+            return BatchSegment.RESTORE
+        if len(commands) > 2 and commands[0] in self._BATCHED_TOOLS \
+                and (commands[1] != 'netns' or commands[2] in self._BATCHED_NETNS_VERBS) \
+                and commands[2] in self._MUTATING_VERBS:
+            return BatchSegment.BATCH
+        return BatchSegment.EXEC
+
+    def _moved_to(self, dest_ns: Netns, segment: BatchSegment):
+        # commands for the destination namespace must run after the move
+        self._open_segments.pop(dest_ns, None)
+        self._move_deps.setdefault(dest_ns, []).append(segment)
+
+    def _segment_for(self, netns: Netns, tool: str, kind: str) -> BatchSegment:
+        segment = self._open_segments.get(netns)
+        if segment is not None and segment.tool == tool and segment.kind == kind:
+            return segment
+
+        deps = self._move_deps.pop(netns, [])
+        if (last_segment := self._last_segments.get(netns)) is not None:
+            deps.append(last_segment)
+
+        segment = BatchSegment(netns, tool, kind, list(dict.fromkeys(deps)))
+        self.segments.append(segment)
+        self._open_segments[netns] = segment
+        self._last_segments[netns] = segment
+        return segment
+
+
+class NetworkPlan(IpBatch):
+    '''
+    Dependency graph of operations keyed by namespace. Commands are only recorded, executing the plan
+    runs operations of different namespaces concurrently while keeping per-namespace order.
+    '''
+
+    _READ_VERBS = ('show', 'list', 'lst', 'ls', 'get')
+    _IPTABLES_READ_OPS = ('-S', '--list-rules', '-L', '--list')
+
+    def accepts(self, commands: tuple[str, ...]) -> bool:
+        # recorded commands don't produce output, caller reading state would silently get nothing
+        if self._reads_state(commands):
+            raise PlanningError(f'Command reading state can\'t be planned: {" ".join(commands)}')
+        return True
+
+    def _reads_state(self, commands: tuple[str, ...]) -> bool:
+        tool, *args = commands
+        if tool in self._BATCHED_TOOLS:
+            # -n/-netns take the namespace as value
+            words = [arg for idx, arg in enumerate(args)
+                     if not arg.startswith('-') and (idx == 0 or args[idx - 1] not in ('-n', '-netns'))]
+            return len(words) < 2 or words[1] in self._READ_VERBS
+        if tool == 'iptables':
+            return any(op in args for op in self._IPTABLES_READ_OPS)
+        return tool == 'iptables-save'
+
+    def execute(self, max_workers: int) -> list[BatchError]:
+        segments = self.segments
+        self._reset()
+
+        dependents: dict[BatchSegment, list[BatchSegment]] = {
+            segment: [] for segment in segments}
+        remaining_deps = {segment: len(segment.deps) for segment in segments}
+        for segment in segments:
+            for dep in segment.deps:
+                dependents[dep].append(segment)
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            running = {executor.submit(segment.run): segment
+                       for segment in segments if not segment.deps}
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    segment = running.pop(future)
+                    errors.extend(future.result())
+                    for dependent in dependents[segment]:
+                        remaining_deps[dependent] -= 1
+                        if remaining_deps[dependent] == 0:
+                            running[executor.submit(
+                                dependent.run)] = dependent
+
+        self.errors.extend(errors)
+        return errors
+
+    async def execute_async(self) -> list[BatchError]:
+        '''Same as execute, but segments run as tasks of the current event loop instead of pool threads'''
+        segments = self.segments
+        self._reset()
+
+        tasks: dict[BatchSegment, asyncio.Task[list[BatchError]]] = {}
+
+        async def run_after_deps(segment: BatchSegment) -> list[BatchError]:
+            for dep in segment.deps:
+                await tasks[dep]
+            return await segment.run_async()
+
+        # deps are always recorded before their dependents
+        for segment in segments:
+            tasks[segment] = asyncio.create_task(run_after_deps(segment))
+        errors = [error for segment_errors in await aio.gather(tasks.values()) for error in segment_errors]
+
+        self.errors.extend(errors)
+        return errors
+
+    @staticmethod
+    def combine(plans: list['NetworkPlan']) -> 'NetworkPlan':
+        '''Copy of operations of all plans, operations of each namespace keep the order of plans'''
+        combined = NetworkPlan()
+        last_segments: dict[Netns, BatchSegment] = {}
+        for plan in plans:
+            copies: dict[BatchSegment, BatchSegment] = {}
+            for segment in plan.segments:
+                deps = [copies[dep] for dep in segment.deps]
+                if (last_segment := last_segments.get(segment.netns)) is not None and last_segment not in deps:
+                    deps.append(last_segment)
+                copies[segment] = last_segments[segment.netns] = segment.copy(deps)
+                combined.segments.append(copies[segment])
+        return combined
+
+    def copy(self) -> 'NetworkPlan':
+        return NetworkPlan.combine([self])
+
+    def discard(self, is_obsolete: Callable[[Netns, list[str]], bool]):
+        '''Removes recorded operations, e.g. of nodes that were removed from the cluster'''
+        for segment in self.segments:
+            segment.discard(lambda args: is_obsolete(segment.netns, args))
+
+    def to_dict(self) -> dict[str, Any]:
+        ids = {segment: idx for idx, segment in enumerate(self.segments)}
+        return {
+            'operations': [{
+                'id': ids[segment],
+                'netns': segment.netns,
+                'tool': segment.tool,
+                'kind': segment.kind,
+                'commands': [' '.join(args) for args in segment.commands],
+                'depends_on': [ids[dep] for dep in segment.deps],
+            } for segment in self.segments]
+        }
+
+    def dump(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+_batch_state = threading.local()
+
+
+@contextmanager
+def batched() -> Generator[IpBatch, None, None]:
+    '''ip/tc/iptables commands issued by the current thread within this block are executed in bulk'''
+    outer_batch = getattr(_batch_state, 'batch', None)
+    if outer_batch is not None:
+        yield outer_batch
+        return
+
+    batch = IpBatch()
+    _batch_state.batch = batch
+    try:
+        yield batch
+    finally:
+        _batch_state.batch = None
+        batch.flush()
+
+
+@contextmanager
+def planned() -> Generator[NetworkPlan, None, None]:
+    '''Commands issued by the current thread within this block are recorded in the plan, see NetworkPlan.execute'''
+    assert getattr(_batch_state, 'batch', None) is None, 'Plans can\'t be nested in batches'
+    plan = NetworkPlan()
+    _batch_state.batch = plan
+    try:
+        yield plan
+    finally:
+        _batch_state.batch = None
+
+
+_netlink: 'NetlinkBackend | None' = None
+_backend_users = 0
+_backend_changed = threading.Condition()
+
+
+def create_backend(backend: IpBackend) -> 'NetlinkBackend | None':
+    '''
+    Implementation of link/address/route primitives to be used with using_backend, with NETLINK they are programmed
+    over rtnetlink sockets, commands that netlink backend doesn't cover are still run as subprocesses (None)
+    '''
+    if backend == IpBackend.NETLINK:
+        from util.netlink import NetlinkBackend
+        return NetlinkBackend()
+    return None
+
+
+@contextmanager
+def using_backend(backend: 'NetlinkBackend | None') -> Generator[None, None, None]:
+    '''
+    Primitives called by any thread within this block use backend, subprocesses are used again once all blocks exit.
+    Blocks using the same backend can run concurrently, a block of other backend waits until they exit.
+    '''
+    global _netlink, _backend_users
+    with _backend_changed:
+        _backend_changed.wait_for(lambda: _backend_users == 0 or _netlink is backend)
+        _netlink = backend
+        _backend_users += 1
+    try:
+        yield
+    finally:
+        with _backend_changed:
+            _backend_users -= 1
+            if _backend_users == 0:
+                _netlink = None
+                _backend_changed.notify_all()
+
+
+def _run_netlink(netns: Netns, method: str, *args):
+    batch: IpBatch | None = getattr(_batch_state, 'batch', None)
+    if batch is not None:
+        batch.enqueue_call(netns, method, args)
+    else:
+        getattr(_netlink, method)(netns, *args)
+        if netns is HOST_NS:
+            host_addresses.invalidate()
+
+
+def close_backend():
+    '''Releases netlink sockets, open sockets keep their namespaces alive'''
+    if _netlink is not None:
+        _netlink.close()
+
+
+@perf.runner
+def _run_sp(*commands: list[str], log_error=True, input: str = None) -> sp.CompletedProcess[str]:
+    res = perf.run(['sudo', *commands], capture_output=True,
+                   text=True, input=input)
     if log_error and res.returncode != 0:
-        logger.error(
-            f'Command {commands}; returned error: {res.returncode}\nstd_err: {res.stderr}')
+        _log_failure(commands, res)
     return res
 
 
+def _log_failure(commands: tuple[str, ...], res: sp.CompletedProcess[str]):
+    logger.error(
+        f'Command {commands}; returned error: {res.returncode}\nstd_err: {res.stderr}')
+
+
 def dot_notation_to_decimal(dotted: str) -> int:
-    return sum(int(byte) * (256 ** (3 - i)) for i, byte in enumerate(dotted.split('.')))
+    return int.from_bytes(socket.inet_aton(dotted), 'big')
 
 
 def decimal_to_dot_notation(decimal_repr: int) -> str:
-    parts = []
-    for _ in range(4):
-        parts.append(str(decimal_repr % 256))
-        decimal_repr //= 256
-    return '.'.join(reversed(parts))
+    return socket.inet_ntoa(decimal_repr.to_bytes(4, 'big'))
+
+
+class HostAddressTable:
+    '''
+    IPv4 addresses assigned to host interfaces, loaded lazily with a single `ip -j address` call.
+    Invalidated whenever links or addresses of the host namespace are changed through iputils.
+    '''
+
+    def __init__(self) -> None:
+        self._addresses: list[tuple[int, str]] | None = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._addresses = None
+
+    def addresses(self) -> list[str]:
+        return [address for _, address in self._load()]
+
+    def find_in_network(self, ipv4: str, netmask: int) -> str | None:
+        network = Cidr(ipv4, netmask)
+        for decimal, address in self._load():
+            if network.first <= decimal <= network.last:
+                return address
+        return None
 
+    def _load(self) -> list[tuple[int, str]]:
+        with self._lock:
+            if self._addresses is None:
+                res = _run_sp('ip', '-j', '-4', 'address', 'show')
+                links = json.loads(res.stdout) if res.returncode == 0 and res.stdout.strip() else []
+                self._addresses = [(dot_notation_to_decimal(addr['local']), addr['local'])
+                                   for link in links for addr in link.get('addr_info', [])
+                                   if addr.get('family') == 'inet']
+            return self._addresses
 
-def mask_size_to_decimal(mask: int) -> int:
-    return sum((1 << i) for i in range((32 - mask), 32))
 
+host_addresses = HostAddressTable()
 
+
+def _changes_host_addresses(commands: tuple[str, ...]) -> bool:
+    if commands[:1] != ('ip',):
+        return False
+    if '-batch' in commands:
+        return True
+    return len(commands) > 2 and commands[1] in ('link', 'address', 'addr', 'tunnel') \
+        and commands[2] in IpBatch._MUTATING_VERBS
+
+
+@perf.runner
 def run_in_namespace(netns: Netns, *commands: list[str], log_error=True) -> sp.CompletedProcess[str]:
+    batch: IpBatch | None = getattr(_batch_state, 'batch', None)
+    if batch is not None:
+        if batch.accepts(commands):
+            batch.enqueue(netns, commands, log_error)
+            return sp.CompletedProcess(list(commands), 0, '', '')
+        # commands that can't be deferred may depend on the queued ones
+        batch.flush()
+
+    return _exec_in_namespace(netns, *commands, log_error=log_error)
+
+
+@perf.runner
+def _exec_in_namespace(netns: Netns, *commands: list[str], log_error=True, input: str = None) -> sp.CompletedProcess[str]:
+    if netns is not None and (agent := nsagent.get_agent(netns)) is not None:
+        try:
+            res = agent.run(*commands, input=input)
+        except nsagent.NamespaceAgentError as e:
+            logger.warning(
+                f'Agent of {netns} failed, falling back to ip netns exec', exc_info=e)
+            nsagent.stop_agent(netns)
+        else:
+            if log_error and res.returncode != 0:
+                _log_failure(commands, res)
+            return res
+
     if netns is not None:
-        return _run_sp('ip', 'netns', 'exec', netns, *commands, log_error=log_error)
-    return _run_sp(*commands, log_error=log_error)
+        return _run_sp('ip', 'netns', 'exec', netns, *commands, log_error=log_error, input=input)
+    res = _run_sp(*commands, log_error=log_error, input=input)
+    if _changes_host_addresses(commands):
+        host_addresses.invalidate()
+    return res
+
+
+@perf.runner
+async def _exec_in_namespace_async(netns: Netns, *commands: list[str], log_error=True,
+                                   input: str = None) -> sp.CompletedProcess[str]:
+    if netns is not None and nsagent.get_agent(netns) is not None:
+        # agent already entered the namespace and serves commands one at a time, a pipe roundtrip is cheap
+        return await asyncio.to_thread(_exec_in_namespace, netns, *commands, log_error=log_error, input=input)
+
+    wrapper = ['sudo', 'ip', 'netns', 'exec', netns] if netns is not None else ['sudo']
+    res = await aio.run([*wrapper, *commands], input=input)
+    if log_error and res.returncode != 0:
+        _log_failure(commands, res)
+    if netns is None and _changes_host_addresses(commands):
+        host_addresses.invalidate()
+    return res
 
 
 def random_iface_suffix() -> str:
@@ -91,6 +719,8 @@ def random_iface_suffix() -> str:
 
 
 def create_veth_pair(netns: Netns, iface1: NetIface, iface2: NetIface, set_up: bool = False):
+    if _netlink is not None:
+        return _run_netlink(netns, 'create_veth_pair', iface1, iface2, set_up)
     run_in_namespace(netns, 'ip', 'link', 'add', iface1.name,
                      'type', 'veth', 'peer', 'name', iface2.name)
     if iface1.mtu is not None:
@@ -104,21 +734,29 @@ def create_veth_pair(netns: Netns, iface1: NetIface, iface2: NetIface, set_up: b
 
 def move_iface_to_netns(src_ns: Netns, dest_ns: Netns, iface: NetIface):
     assert src_ns != dest_ns
+    if _netlink is not None:
+        return _run_netlink(src_ns, 'move_iface_to_netns', dest_ns, iface)
     run_in_namespace(src_ns, 'ip', 'link', 'set', iface.name, 'netns', dest_ns)
 
 
 def set_iface_state(netns: Netns, iface_name: str, up: bool):
+    if _netlink is not None:
+        return _run_netlink(netns, 'set_iface_state', iface_name, up)
     run_in_namespace(netns, 'ip', 'link', 'set',
                      iface_name, 'up' if up else 'down')
 
 
 def assign_ipv4(netns: Netns, iface: NetIface):
+    if _netlink is not None:
+        return _run_netlink(netns, 'assign_ipv4', iface)
     run_in_namespace(netns, 'ip', 'address', 'add',
                      f'{iface.ipv4}/{iface.netmask}', 'dev', iface.name)
 
 
 def assign_mac(netns: Netns, iface: NetIface):
     assert iface.mac is not None
+    if _netlink is not None:
+        return _run_netlink(netns, 'assign_mac', iface)
     run_in_namespace(netns, 'ip', 'link', 'set',
                      iface.name, 'address', iface.mac)
 
@@ -134,16 +772,22 @@ def connect_namespaces(netns1: Netns, netns2: Netns, iface1: NetIface, iface2: N
 
 
 def add_default_route(netns: Netns, gateway_ipv4: str):
+    if _netlink is not None:
+        return _run_netlink(netns, 'add_default_route', gateway_ipv4)
     run_in_namespace(netns, 'ip', 'route', 'del', 'default', log_error=False)
     run_in_namespace(netns, 'ip', 'route', 'add',
                      'default', 'via', gateway_ipv4)
 
 
 def add_route(netns: Netns, dest_ipv4: str, next_hop: str):
+    if _netlink is not None:
+        return _run_netlink(netns, 'add_route', dest_ipv4, next_hop)
     run_in_namespace(netns, 'ip', 'route', 'add', dest_ipv4, 'via', next_hop)
 
 
 def del_route(netns: Netns, dest_ipv4: str, next_hop: str):
+    if _netlink is not None:
+        return _run_netlink(netns, 'del_route', dest_ipv4, next_hop)
     run_in_namespace(netns, 'ip', 'route', 'del', dest_ipv4, 'via', next_hop)
 
 
@@ -159,11 +803,14 @@ def get_interface_info(netns: Netns, iface_name: str) -> NetIface:
         f"Failed to get interface info for {iface_name}, got {iface_data}")
 
 
+def find_host_ipv4_in_network_with(ipv4: str, netmask: int) -> str | None:
+    return host_addresses.find_in_network(ipv4, netmask)
+
+
 def get_host_ipv4_in_network_with(ipv4: str, netmask: int) -> str:
-    # TODO
-    assert netmask == 16, 'assuming /16 mask'
-    output = _run_sp('ip', 'address').stdout
-    return re.search(f'inet\s({".".join(ipv4.split(".")[:2])}\.\d+\.\d+)/{netmask}', output).group(1)
+    host_ipv4 = find_host_ipv4_in_network_with(ipv4, netmask)
+    assert host_ipv4 is not None, f'No host address in {ipv4}/{netmask}'
+    return host_ipv4
 
 
 def add_dnat_rule(netns: Netns, src_ipv4: str, prev_dest_ipv4: str, new_dest_ipv4: str):
@@ -171,6 +818,11 @@ def add_dnat_rule(netns: Netns, src_ipv4: str, prev_dest_ipv4: str, new_dest_ipv
                      prev_dest_ipv4, '-j', 'DNAT', '--to-destination', new_dest_ipv4)
 
 
+def del_dnat_rule(netns: Netns, src_ipv4: str, prev_dest_ipv4: str, new_dest_ipv4: str):
+    run_in_namespace(netns, 'iptables', '-t', 'nat', '-D', 'OUTPUT', '-d',
+                     prev_dest_ipv4, '-j', 'DNAT', '--to-destination', new_dest_ipv4)
+
+
 def resolve_hostnames_to_ipv4(hostname: str) -> list[str]:
     addrs = [res[4][0] for res in socket.getaddrinfo(
         hostname, None, family=socket.AF_INET)]
@@ -181,11 +833,15 @@ def resolve_hostnames_to_ipv4(hostname: str) -> list[str]:
 
 
 def assign_bridge_master(netns: Netns, veth: NetIface, bridge: NetIface):
+    if _netlink is not None:
+        return _run_netlink(netns, 'assign_bridge_master', veth, bridge)
     run_in_namespace(netns, 'ip', 'link', 'set',
                      veth.name, 'master', bridge.name)
 
 
 def create_bridge(netns: Netns, bridge: NetIface):
+    if _netlink is not None:
+        return _run_netlink(netns, 'create_bridge', bridge)
     run_in_namespace(netns, 'ip', 'link', 'add', bridge.name, 'type', 'bridge')
     assign_ipv4(netns, bridge)
     set_iface_state(netns, bridge.name, True)
@@ -216,19 +872,77 @@ def set_bridged_traffic_masquerading(netns: Netns, bridge: NetIface, enabled: bo
                      f'{bridge.ipv4}/{bridge.netmask}', '!', '-o', bridge.name, '-j', 'MASQUERADE')
 
 
-def masquerade_internet_facing_traffic(netns: Netns, src: Cidr, forwarding_iface: NetIface):
-    run_in_namespace(netns, 'iptables', '-t', 'nat', '-A', 'POSTROUTING', '-s',
+def masquerade_internet_facing_traffic(netns: Netns, src: Cidr, forwarding_iface: NetIface, enabled: bool = True):
+    mode = '-A' if enabled else '-D'
+    run_in_namespace(netns, 'iptables', '-t', 'nat', mode, 'POSTROUTING', '-s',
                      f'{src.ipv4}/{src.netmask}', '-o', forwarding_iface.name, '-j', 'MASQUERADE')
 
 
 def create_gre_tunnel(netns: Netns, tunnel_iface: NetIface, src_ipv4: str, dst_ipv4: str, set_up: bool = True):
+    if _netlink is not None:
+        return _run_netlink(netns, 'create_gre_tunnel', tunnel_iface, src_ipv4, dst_ipv4, set_up)
     run_in_namespace(netns, 'ip', 'tunnel', 'add',
                      tunnel_iface.name, 'mode', 'gre', 'remote', dst_ipv4, 'local', src_ipv4, 'ttl', '255')
+    set_iface_mtu(netns, tunnel_iface)
+    assign_ipv4(netns, tunnel_iface)
+    if set_up:
+        set_iface_state(netns, tunnel_iface.name, True)
+
+
+def add_fou_receive_port(netns: Netns, port: int):
+    '''Decapsulates GRE packets received over UDP on given port'''
+    run_in_namespace(netns, 'ip', 'fou', 'add', 'port', str(port), 'ipproto', '47')
+
+
+def create_fou_gre_tunnel(netns: Netns, tunnel_iface: NetIface, src_ipv4: str, dst_ipv4: str, port: int, set_up: bool = True):
+    '''GRE encapsulated in UDP, source port is derived from inner flow hash which spreads flows over ECMP paths'''
+    # FOU encapsulation isn't covered by netlink backend
+    run_in_namespace(netns, 'ip', 'link', 'add', tunnel_iface.name, 'type', 'gre',
+                     'remote', dst_ipv4, 'local', src_ipv4, 'ttl', '255',
+                     'encap', 'fou', 'encap-sport', 'auto', 'encap-dport', str(port))
+    set_iface_mtu(netns, tunnel_iface)
+    assign_ipv4(netns, tunnel_iface)
+    if set_up:
+        set_iface_state(netns, tunnel_iface.name, True)
+
+
+def create_vxlan_tunnel(netns: Netns, tunnel_iface: NetIface, src_ipv4: str, dst_ipv4: str, vni: int, port: int,
+                        set_up: bool = True):
+    '''Point-to-point VXLAN, UDP source port is derived from inner flow hash which spreads flows over ECMP paths'''
+    if _netlink is not None:
+        return _run_netlink(netns, 'create_vxlan_tunnel', tunnel_iface, src_ipv4, dst_ipv4, vni, port, set_up)
+    run_in_namespace(netns, 'ip', 'link', 'add', tunnel_iface.name, 'type', 'vxlan', 'id', str(vni),
+                     'remote', dst_ipv4, 'local', src_ipv4, 'dstport', str(port), 'ttl', '255')
+    set_iface_mtu(netns, tunnel_iface)
     assign_ipv4(netns, tunnel_iface)
     if set_up:
         set_iface_state(netns, tunnel_iface.name, True)
 
 
+def create_external_gre_tunnel(netns: Netns, tunnel_iface: NetIface, set_up: bool = True):
+    '''Creates collect-metadata GRE device, remote endpoints are set per route, see add_encap_route'''
+    if _netlink is not None:
+        return _run_netlink(netns, 'create_external_gre_tunnel', tunnel_iface, set_up)
+    run_in_namespace(netns, 'ip', 'link', 'add',
+                     tunnel_iface.name, 'type', 'gre', 'external')
+    set_iface_mtu(netns, tunnel_iface)
+    if set_up:
+        set_iface_state(netns, tunnel_iface.name, True)
+
+
+def add_encap_route(netns: Netns, dest_ipv4: str, tunnel_iface: NetIface, remote_ipv4: str, mtu: int = None):
+    # lightweight tunnel encapsulation isn't covered by netlink backend
+    commands = ['ip', 'route', 'add', dest_ipv4, 'encap', 'ip',
+                'dst', remote_ipv4, 'ttl', '255', 'dev', tunnel_iface.name]
+    if mtu is not None:
+        commands.extend(['mtu', str(mtu)])
+    run_in_namespace(netns, *commands)
+
+
+def del_encap_route(netns: Netns, dest_ipv4: str, tunnel_iface: NetIface):
+    run_in_namespace(netns, 'ip', 'route', 'del', dest_ipv4, 'dev', tunnel_iface.name)
+
+
 def flush_established_connections(netns: Netns):
     run_in_namespace(netns, 'conntrack', '-F')
 
@@ -249,33 +963,54 @@ def apply_egress_traffic_control(netns: Netns, iface: NetIface):
     run_in_namespace(netns, *command.split())
 
 
-def is_in_same_subnet(cidr1: Cidr, cidr2: Cidr) -> bool:
-    mask = mask_size_to_decimal(min(cidr1.netmask, cidr2.netmask))
-    ip1 = dot_notation_to_decimal(cidr1.ipv4)
-    ip2 = dot_notation_to_decimal(cidr2.ipv4)
-    return ((ip1 & mask) ^ (ip2 & mask)) == 0
+def get_subnet(cidr: Cidr) -> Cidr:
+    return Cidr.from_int(cidr.first, cidr.netmask, cidr.bits)
+
 
+def get_route_cover(cidr: Cidr, competing_routes: list[Cidr]) -> list[Cidr]:
+    '''
+    Returns the smallest set of prefixes covering cidr such that each of them is more specific than
+    every competing route overlapping it, so they win the longest prefix match for the whole cidr.
+    '''
+    return _get_route_cover(get_subnet(cidr), [route for route in competing_routes if route.overlaps(cidr)])
 
-def get_subnet(cidr: Cidr) -> Cidr:
-    mask = mask_size_to_decimal(cidr.netmask)
-    ip = dot_notation_to_decimal(cidr.ipv4)
-    subnet_ip = decimal_to_dot_notation(ip & mask)
-    return Cidr(subnet_ip, cidr.netmask)
 
+def _get_route_cover(cidr: Cidr, competing_routes: list[Cidr]) -> list[Cidr]:
+    # competing routes that contain cidr are less specific already, only the ones inside of it (or equal) matter
+    inner = [route for route in competing_routes if cidr.contains(route)]
+    if not inner:
+        return [cidr]
 
-def get_nth_octet(ipv4: str, n: int) -> str:
-    return ipv4.split('.')[n]
+    assert cidr.netmask < cidr.bits, f"Route to {cidr.masked_ip} can't be made more specific"
+    half_size = 1 << (cidr.bits - cidr.netmask - 1)
+    lower = Cidr.from_int(cidr.first, cidr.netmask + 1, cidr.bits)
+    upper = Cidr.from_int(cidr.first + half_size, cidr.netmask + 1, cidr.bits)
+    return _get_route_cover(lower, inner) + _get_route_cover(upper, inner)
 
 
 def delete_iface(netns: Netns, iface: NetIface):
+    if _netlink is not None:
+        return _run_netlink(netns, 'delete_iface', iface)
     run_in_namespace(netns, 'ip', 'link', 'del', iface.name)
 
 
 def delete_namespace(parent_ns: Netns, ns_to_delete: str):
+    nsagent.stop_agent(ns_to_delete)
     run_in_namespace(parent_ns, 'ip', 'netns', 'delete', ns_to_delete)
 
 
+def delete_namespaces(parent_ns: Netns, nss_to_delete: list[str]):
+    '''Deletes namespaces with a single `ip -batch` call'''
+    for ns in nss_to_delete:
+        nsagent.stop_agent(ns)
+    with batched():
+        for ns in nss_to_delete:
+            run_in_namespace(parent_ns, 'ip', 'netns', 'delete', ns)
+
+
 def set_iface_mtu(netns: Netns, iface: NetIface):
+    if _netlink is not None:
+        return _run_netlink(netns, 'set_iface_mtu', iface)
     if iface.mtu is not None:
         run_in_namespace(netns, 'ip', 'link', 'set', 'dev',
                          iface.name, 'mtu', f'{iface.mtu}')
@@ -1,19 +1,43 @@
+import hashlib
 import os
+import re
+import shutil
 import subprocess as sp
+import tempfile
+import time
 from typing import IO
 
+import util.perf as perf
+import util.readiness as readiness
 from util.logger import logger
 
 KUBECONFIG_PATH = os.path.join(os.environ['HOME'], '.kube', 'config')
+KINDA_NODE_IMAGE_REPOSITORY = 'kinda/node'
+_NODE_IMAGE_BUILD_TIMEOUT_SECONDS = 1800
+# kind pins its default node image by digest, the reference is compiled into kind binary
+_DEFAULT_NODE_IMAGE_PATTERN = re.compile(rb'kindest/node:v[0-9][0-9a-z.+-]*@sha256:[0-9a-f]{64}')
+_API_SERVER_PORT = 6443
+KIND_CLUSTER_LABEL = 'io.x-k8s.kind.cluster'
+KIND_ROLE_LABEL = 'io.x-k8s.kind.role'
+# node container name becomes hostname and kubernetes node name, so it has to be a DNS-1123 label
+_MAX_NODE_CONTAINER_NAME_LENGTH = 63
+_NAME_HASH_LENGTH = 8
+# systemd in node container logs this once it's booted, kind waits for it before running kubeadm
+_NODE_BOOTED_PATTERN = re.compile(r'Reached target .*Multi-User System|detected cgroup v1')
+# kind skips the whole preflight phase, only checks that fail in node containers (host swap, kernel config
+# and bridge sysctls not visible in the container) are ignored, so that real problems are still reported
+_IGNORED_PREFLIGHT_ERRORS = ('Swap', 'SystemVerification', 'FileContent--proc-sys-net-bridge-bridge-nf-call-iptables')
 
 
-def prepare_kind_cfg_file(file: IO[bytes], control_nodes_count: int, worker_nodes_count: int):
+def prepare_kind_cfg_file(file: IO[bytes], control_nodes_count: int, worker_nodes_count: int, node_image: str = None):
+    '''Nodes run node_image if given, kind's default image otherwise'''
+    image_lines = [f'  image: {node_image}'] if node_image is not None else []
     lines = ([
         'kind: Cluster',
         'apiVersion: kind.x-k8s.io/v1alpha4',
         'nodes:',
-        *['- role: control-plane' for _ in range(control_nodes_count)],
-        *['- role: worker' for _ in range(worker_nodes_count)],
+        *[line for _ in range(control_nodes_count) for line in ['- role: control-plane', *image_lines]],
+        *[line for _ in range(worker_nodes_count) for line in ['- role: worker', *image_lines]],
         ''
     ])
 
@@ -21,22 +45,200 @@ def prepare_kind_cfg_file(file: IO[bytes], control_nodes_count: int, worker_node
     file.flush()
 
 
+def get_kind_version() -> str:
+    return perf.run(['kind', 'version'], capture_output=True, text=True).stdout.strip()
+
+
+def get_default_node_image() -> str | None:
+    '''Node image that installed kind creates clusters from when none is configured, None if it can't be found'''
+    kind_path = shutil.which('kind')
+    if kind_path is None:
+        return None
+    with open(kind_path, 'rb') as f:
+        match = _DEFAULT_NODE_IMAGE_PATTERN.search(f.read())
+    return match.group().decode() if match is not None else None
+
+
+def get_prebaked_node_image(script_paths: list[str], base_image: str = None) -> str | None:
+    '''
+    Returns image derived from base_image (kind's default node image if not given) with given scripts already run
+    in it, building it once for every combination of script contents, base image and kind version.
+    None if there is no base image or it can't be pulled.
+    '''
+    if base_image is None and (base_image := get_default_node_image()) is None:
+        return None
+    # base image is pulled the same way kind would do it, locally cached images of other tags are never used
+    if perf.run(['docker', 'image', 'inspect', base_image], capture_output=True).returncode != 0 and \
+            perf.run(['docker', 'pull', base_image], capture_output=True).returncode != 0:
+        return None
+
+    base_image_id = perf.run(['docker', 'image', 'inspect', '-f', '{{.Id}}', base_image],
+                             capture_output=True, text=True).stdout.strip()
+    key = hashlib.sha256()
+    for part in [get_kind_version(), base_image, base_image_id]:
+        key.update(part.encode())
+    for path in script_paths:
+        with open(path, 'rb') as f:
+            key.update(f.read())
+    image = f'{KINDA_NODE_IMAGE_REPOSITORY}:{key.hexdigest()[:16]}'
+
+    if perf.run(['docker', 'image', 'inspect', image], capture_output=True).returncode == 0:
+        return image
+
+    logger.info(f'Building node image {image} from {base_image}, it is done only once')
+    with tempfile.TemporaryDirectory() as context_dir:
+        filenames = [os.path.basename(path) for path in script_paths]
+        for path in script_paths:
+            shutil.copy(path, context_dir)
+        with open(os.path.join(context_dir, 'Dockerfile'), 'w') as f:
+            f.write('\n'.join([
+                f'FROM {base_image}',
+                *[f'COPY {filename} /home/{filename}' for filename in filenames],
+                'RUN ' + ' && '.join([*[f'bash /home/{filename}' for filename in filenames],
+                                      'rm -rf /var/lib/apt/lists/*']),
+                ''
+            ]))
+        res = perf.run(['docker', 'build', '-t', image, context_dir],
+                       capture_output=True, text=True, timeout=_NODE_IMAGE_BUILD_TIMEOUT_SECONDS)
+
+    if res.returncode != 0:
+        logger.error(f'Failed to build node image {image}:\n{res.stderr}')
+        return None
+    return image
+
+
 def run_cluster(name: str, kind_cfg_file_path: str, timeout: float):
-    kind_sp = sp.Popen(['sudo', 'kind', 'create', 'cluster', '--name', name, '--config', kind_cfg_file_path],
-                       stdout=sp.PIPE,
-                       text=True)
-    kind_sp.wait(timeout)
+    commands = ['sudo', 'kind', 'create', 'cluster',
+                '--name', name, '--config', kind_cfg_file_path]
+    with perf.measure_command(commands):
+        kind_sp = sp.Popen(commands, stdout=sp.PIPE, text=True)
+        kind_sp.wait(timeout)
     assert kind_sp.returncode == 0, 'Cluster creation failed'
 
 
-def update_kubectl_cfg(cluster_name: str, kubeconfig_path: str):
-    kubeconfig = sp.run(['sudo', 'kind', 'get', 'kubeconfig',
-                        '--name', cluster_name], capture_output=True, text=True).stdout
+def get_worker_container_name(cluster_name: str, node_name: str) -> str:
+    '''
+    Worker container name that is a valid DNS-1123 label, like kind's '<cluster>-worker<n>'. Names that had to be
+    changed or shortened get a hash of the node name appended, so that distinct nodes don't collide.
+    '''
+    name = f'{cluster_name}-worker-{node_name}'.lower()
+    sanitized = re.sub(r'[^a-z0-9-]+', '-', name).strip('-')
+    if sanitized == name and len(name) <= _MAX_NODE_CONTAINER_NAME_LENGTH:
+        return name
+
+    name_hash = hashlib.sha256(node_name.encode()).hexdigest()[:_NAME_HASH_LENGTH]
+    prefix = sanitized[:_MAX_NODE_CONTAINER_NAME_LENGTH - _NAME_HASH_LENGTH - 1].rstrip('-')
+    return f'{prefix}-{name_hash}'
+
+
+def join_worker_node(cluster_name: str, container_name: str, timeout: float) -> str:
+    '''
+    Starts node container the same way as kind does, waits for it to boot and joins it to the cluster
+    with kubeadm, kubelet registers node under container name. Returns container id.
+    '''
+    control_plane = f'{cluster_name}-control-plane'
+    image = perf.run(['docker', 'inspect', '-f', '{{.Config.Image}}', control_plane],
+                     capture_output=True, text=True).stdout.strip()
+
+    res = perf.run(['docker', 'run', '--detach', *_node_container_args(cluster_name, container_name, 'worker'), image],
+                   capture_output=True, text=True)
+    assert res.returncode == 0, f'Failed to start node container {container_name}: {res.stderr}'
+    container_id = res.stdout.strip()[:12]
+    deadline = time.monotonic() + timeout
+    assert readiness.wait_until(lambda: _is_node_booted(container_name), timeout), \
+        f'Node container {container_name} did not boot in {timeout}s'
+
+    join_command = perf.run(['docker', 'exec', control_plane, 'kubeadm', 'token', 'create', '--print-join-command'],
+                            capture_output=True, text=True).stdout.split()
+    assert join_command, f'Failed to create join token for {container_name}'
+    res = perf.run(['docker', 'exec', container_name, *join_command,
+                    f'--ignore-preflight-errors={",".join(_IGNORED_PREFLIGHT_ERRORS)}'],
+                   capture_output=True, text=True, timeout=max(deadline - time.monotonic(), 0))
+    assert res.returncode == 0, f'Failed to join {container_name} to the cluster: {res.stderr}'
+    return container_id
+
+
+def _is_node_booted(container_name: str) -> bool:
+    # systemd logs to console of the container
+    res = perf.run(['docker', 'logs', container_name], capture_output=True, text=True)
+    return _NODE_BOOTED_PATTERN.search(res.stdout + res.stderr) is not None
+
+
+def get_api_server_address(cluster_name: str) -> str:
+    '''Host address that API server port of control plane node is published on'''
+    return perf.run(['docker', 'port', f'{cluster_name}-control-plane', f'{_API_SERVER_PORT}/tcp'],
+                    capture_output=True, text=True).stdout.splitlines()[0].strip()
+
+
+def snapshot_node(container_name: str, image: str, var_archive_path: str):
+    '''Commits node container to image, /var is a volume in kind nodes so it is archived separately'''
+    res = perf.run(['docker', 'commit', container_name, image],
+                   capture_output=True, text=True)
+    assert res.returncode == 0, f'Failed to commit {container_name}: {res.stderr}'
+    with open(var_archive_path, 'wb') as f:
+        res = perf.run(['docker', 'exec', container_name, 'tar', '-C', '/var', '-cf', '-', '.'],
+                       stdout=f, stderr=sp.PIPE)
+    assert res.returncode == 0, f'Failed to archive /var of {container_name}: {res.stderr}'
+
+
+def restore_node(cluster_name: str, container_name: str, role: str, image: str, ipv4: str,
+                 var_archive_path: str, api_server_address: str = None) -> str:
+    '''
+    Recreates node container from snapshot with the same name and address kubernetes certificates were issued for.
+    Returns container id.
+    '''
+    publish_args = ['--publish', f'{api_server_address}:{_API_SERVER_PORT}/tcp'] \
+        if api_server_address is not None else []
+    res = perf.run(['docker', 'create', *_node_container_args(cluster_name, container_name, role),
+                    '--ip', ipv4, *publish_args, image], capture_output=True, text=True)
+    assert res.returncode == 0, f'Failed to create node container {container_name}: {res.stderr}'
+    container_id = res.stdout.strip()[:12]
+
+    with open(var_archive_path, 'rb') as f:
+        res = perf.run(['docker', 'cp', '-', f'{container_name}:/var'],
+                       stdin=f, capture_output=True)
+    assert res.returncode == 0, f'Failed to restore /var of {container_name}: {res.stderr}'
+
+    res = perf.run(['docker', 'start', container_name],
+                   capture_output=True, text=True)
+    assert res.returncode == 0, f'Failed to start node container {container_name}: {res.stderr}'
+    return container_id
+
+
+def _node_container_args(cluster_name: str, container_name: str, role: str) -> list[str]:
+    # same as kind uses for node containers
+    return ['--tty', '--net', 'kind',
+            '--label', f'{KIND_CLUSTER_LABEL}={cluster_name}', '--label', f'{KIND_ROLE_LABEL}={role}',
+            '--hostname', container_name, '--name', container_name,
+            '--restart=on-failure:1', '--init=false', '--cgroupns=private', '--privileged',
+            '--security-opt', 'seccomp=unconfined', '--security-opt', 'apparmor=unconfined',
+            '--tmpfs', '/tmp', '--tmpfs', '/run', '--volume', '/var',
+            '--volume', '/lib/modules:/lib/modules:ro', '-e', 'container=docker']
+
+
+def update_kubectl_cfg(cluster_name: str, kubeconfig_path: str) -> bool:
+    '''Returns False if kubeconfig isn't available yet (control plane is still being initialized)'''
+    res = perf.run(['sudo', 'kind', 'get', 'kubeconfig',
+                    '--name', cluster_name], capture_output=True, text=True)
+    if res.returncode != 0 or not res.stdout.strip():
+        return False
     with open(kubeconfig_path, 'w') as f:
-        f.write(kubeconfig)
+        f.write(res.stdout)
+    return True
+
+
+def get_clusters() -> list[str]:
+    res = perf.run(['sudo', 'kind', 'get', 'clusters'],
+                   capture_output=True, text=True)
+    return res.stdout.split() if res.returncode == 0 else []
+
+
+def get_kind_network_gateway() -> str:
+    return perf.run(['docker', 'network', 'inspect', 'kind', '-f', '{{range .IPAM.Config}}{{.Gateway}} {{end}}'],
+                    capture_output=True, text=True).stdout.split()[0]
 
 
 def delete_cluster(cluster_name: str):
-    res = sp.run(['sudo', 'kind', 'delete', 'clusters',
-                  cluster_name], capture_output=True, text=True)
+    res = perf.run(['sudo', 'kind', 'delete', 'clusters',
+                    cluster_name], capture_output=True, text=True)
     logger.info(res.stdout)
@@ -1,34 +1,88 @@
 import json
-import subprocess as sp
-from typing import Any
+import time
+from typing import Any, Iterator, NamedTuple
 
+import util.perf as perf
 from util.iputils import Cidr
 
 KUBECTL = 'kubectl'
 
 NodesInfo = dict[str, Any]
-NodeInfo = dict[str, Any]
+
+
+class NodeMeta(NamedTuple):
+    name: str
+    internal_ips: tuple[str, ...]
+    hostname: str | None
+    pod_cidrs: tuple[Cidr, ...]
+
+    @staticmethod
+    def from_api_object(item: dict[str, Any]) -> 'NodeMeta':
+        addresses = item['status'].get('addresses', [])
+        hostname = next((x['address'] for x in addresses if x['type'] == 'Hostname'), None)
+        cidrs = [x.split('/') for x in item['spec'].get('podCIDRs', [])]
+        return NodeMeta(item['metadata']['name'],
+                        tuple(x['address'] for x in addresses if x['type'] == 'InternalIP'),
+                        hostname, tuple(Cidr(ipv4, int(netmask)) for ipv4, netmask in cidrs))
+
+
+class NodeCatalog:
+    '''Nodes registered in the cluster, indexed by name, InternalIP, hostname and pod cidr'''
+
+    def __init__(self, nodes: list[NodeMeta]) -> None:
+        self.nodes = nodes
+        self._by_name = {node.name: node for node in nodes}
+        self._by_internal_ip = {ipv4: node for node in nodes for ipv4 in node.internal_ips}
+        self._by_hostname = {node.hostname: node for node in nodes if node.hostname is not None}
+        self._by_pod_cidr = {cidr: node for node in nodes for cidr in node.pod_cidrs}
+
+    @staticmethod
+    def from_nodes_info(nodes_info: NodesInfo) -> 'NodeCatalog':
+        return NodeCatalog([NodeMeta.from_api_object(item) for item in nodes_info['items']])
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __iter__(self) -> Iterator[NodeMeta]:
+        return iter(self.nodes)
+
+    def by_name(self, name: str) -> NodeMeta | None:
+        return self._by_name.get(name)
+
+    def by_internal_ip(self, ipv4: str) -> NodeMeta | None:
+        return self._by_internal_ip.get(ipv4)
+
+    def by_hostname(self, hostname: str) -> NodeMeta | None:
+        return self._by_hostname.get(hostname)
+
+    def by_pod_cidr(self, cidr: Cidr) -> NodeMeta | None:
+        return self._by_pod_cidr.get(cidr)
 
 
 def get_nodes_info() -> NodesInfo:
-    res = json.loads(sp.run(
+    res = json.loads(perf.run(
         [KUBECTL, 'get', 'nodes', '-o', 'json'], capture_output=True, text=True).stdout)
     assert res['apiVersion'] == 'v1', 'Unsupported kubernetes api version for node resource'
     return res
 
 
-def get_info_of_node_with_internal_ip(nodes_info: NodesInfo, ipv4: str):
-    for item in nodes_info['items']:
-        if any(x['address'] == ipv4 for x in item['status']['addresses'] if x['type'] == 'InternalIP'):
-            return item
+def get_node_catalog() -> NodeCatalog:
+    return NodeCatalog.from_nodes_info(get_nodes_info())
 
-    raise Exception(f"Failed to find node with ip: {ipv4}")
 
+def wait_for_pod_cidrs(node_names: list[str], timeout: float, poll_interval_seconds: float = 1):
+    '''Waits until controller manager assigns pod cidrs to nodes that have just joined the cluster'''
+    deadline = time.monotonic() + timeout
+    while True:
+        ready = {node.name for node in get_node_catalog() if node.pod_cidrs}
+        if all(name in ready for name in node_names):
+            return
+        assert time.monotonic() < deadline, \
+            f'Pod cidrs weren\'t assigned to: {[name for name in node_names if name not in ready]}'
+        time.sleep(poll_interval_seconds)
 
-def get_node_name(node_info: NodeInfo) -> str:
-    return node_info['metadata']['name']
 
+def delete_node(node_name: str):
+    perf.run([KUBECTL, 'delete', 'node', node_name],
+             capture_output=True, text=True)
 
-def get_node_pod_cidrs(node_info: NodeInfo) -> list[Cidr]:
-    cidrs = [x.split('/') for x in node_info['spec']['podCIDRs']]
-    return [Cidr(ipv4, int(netmask)) for ipv4, netmask in cidrs]
@@ -0,0 +1,171 @@
+import errno
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Generator, NamedTuple
+
+from pyroute2 import IPRoute, NetNS
+from pyroute2.netlink.exceptions import NetlinkError
+
+from util.iputils import HOST_NS, NetIface, Netns
+from util.logger import logger
+
+
+class NetlinkOperationError(NamedTuple):
+    netns: Netns
+    operation: str
+    args: dict[str, Any]
+    code: int
+    message: str
+
+
+class NetlinkBackend:
+    '''
+    Programs links, addresses and routes over rtnetlink sockets bound to the target namespaces,
+    one socket is opened per namespace and reused by all operations.
+
+    Errors aren't raised (same as in subprocess-based iputils), they are logged and stored in `errors`.
+    '''
+
+    def __init__(self) -> None:
+        self.errors: list[NetlinkOperationError] = []
+        self._collected = threading.local()
+        self._sockets: dict[Netns, IPRoute | NetNS] = {}
+        self._locks: dict[Netns, threading.Lock] = {}
+        self._sockets_lock = threading.Lock()
+
+    def close(self):
+        with self._sockets_lock:
+            for socket in self._sockets.values():
+                socket.close()
+            self._sockets.clear()
+            self._locks.clear()
+
+    @contextmanager
+    def collect_errors(self) -> Generator[list[NetlinkOperationError], None, None]:
+        '''Errors of operations issued by the current thread within this block are also added to yielded list'''
+        errors = []
+        self._collected.errors = errors
+        try:
+            yield errors
+        finally:
+            self._collected.errors = None
+
+    def create_veth_pair(self, netns: Netns, iface1: NetIface, iface2: NetIface, set_up: bool = False):
+        self._call(netns, 'link', 'add', ifname=iface1.name,
+                   kind='veth', peer=iface2.name)
+        for iface in (iface1, iface2):
+            if iface.mtu is not None:
+                self.set_iface_mtu(netns, iface)
+        if set_up:
+            self.set_iface_state(netns, iface1.name, True)
+            self.set_iface_state(netns, iface2.name, True)
+
+    def move_iface_to_netns(self, src_ns: Netns, dest_ns: Netns, iface: NetIface):
+        target = {'net_ns_pid': 1} if dest_ns is HOST_NS else {
+            'net_ns_fd': dest_ns}
+        self._call_on_iface(src_ns, iface.name, 'link', 'set', **target)
+
+    def set_iface_state(self, netns: Netns, iface_name: str, up: bool):
+        self._call_on_iface(netns, iface_name, 'link', 'set',
+                            state='up' if up else 'down')
+
+    def assign_ipv4(self, netns: Netns, iface: NetIface):
+        self._call_on_iface(netns, iface.name, 'addr', 'add',
+                            address=iface.ipv4, prefixlen=iface.netmask)
+
+    def assign_mac(self, netns: Netns, iface: NetIface):
+        assert iface.mac is not None
+        self._call_on_iface(netns, iface.name, 'link',
+                            'set', address=iface.mac)
+
+    def set_iface_mtu(self, netns: Netns, iface: NetIface):
+        if iface.mtu is not None:
+            self._call_on_iface(netns, iface.name, 'link',
+                                'set', mtu=iface.mtu)
+
+    def add_route(self, netns: Netns, dest_ipv4: str, next_hop: str):
+        self._call(netns, 'route', 'add', dst=dest_ipv4, gateway=next_hop)
+
+    def del_route(self, netns: Netns, dest_ipv4: str, next_hop: str):
+        self._call(netns, 'route', 'del', dst=dest_ipv4, gateway=next_hop)
+
+    def add_default_route(self, netns: Netns, gateway_ipv4: str):
+        self._call(netns, 'route', 'del', dst='default', log_error=False)
+        self._call(netns, 'route', 'add', dst='default', gateway=gateway_ipv4)
+
+    def create_bridge(self, netns: Netns, bridge: NetIface):
+        self._call(netns, 'link', 'add', ifname=bridge.name, kind='bridge')
+        self.assign_ipv4(netns, bridge)
+        self.set_iface_state(netns, bridge.name, True)
+
+    def assign_bridge_master(self, netns: Netns, veth: NetIface, bridge: NetIface):
+        bridge_idx = self._lookup(netns, bridge.name)
+        if bridge_idx is not None:
+            self._call_on_iface(netns, veth.name, 'link',
+                                'set', master=bridge_idx)
+
+    def create_gre_tunnel(self, netns: Netns, tunnel_iface: NetIface, src_ipv4: str, dst_ipv4: str, set_up: bool = True):
+        self._call(netns, 'link', 'add', ifname=tunnel_iface.name, kind='gre',
+                   gre_local=src_ipv4, gre_remote=dst_ipv4, gre_ttl=255)
+        self.set_iface_mtu(netns, tunnel_iface)
+        self.assign_ipv4(netns, tunnel_iface)
+        if set_up:
+            self.set_iface_state(netns, tunnel_iface.name, True)
+
+    def create_vxlan_tunnel(self, netns: Netns, tunnel_iface: NetIface, src_ipv4: str, dst_ipv4: str, vni: int,
+                            port: int, set_up: bool = True):
+        self._call(netns, 'link', 'add', ifname=tunnel_iface.name, kind='vxlan', vxlan_id=vni,
+                   vxlan_local=src_ipv4, vxlan_group=dst_ipv4, vxlan_port=port, vxlan_ttl=255)
+        self.set_iface_mtu(netns, tunnel_iface)
+        self.assign_ipv4(netns, tunnel_iface)
+        if set_up:
+            self.set_iface_state(netns, tunnel_iface.name, True)
+
+    def create_external_gre_tunnel(self, netns: Netns, tunnel_iface: NetIface, set_up: bool = True):
+        self._call(netns, 'link', 'add', ifname=tunnel_iface.name, kind='gre',
+                   gre_collect_metadata=True)
+        self.set_iface_mtu(netns, tunnel_iface)
+        if set_up:
+            self.set_iface_state(netns, tunnel_iface.name, True)
+
+    def delete_iface(self, netns: Netns, iface: NetIface):
+        self._call_on_iface(netns, iface.name, 'link', 'del')
+
+    def _socket(self, netns: Netns) -> tuple[IPRoute | NetNS, threading.Lock]:
+        with self._sockets_lock:
+            if netns not in self._sockets:
+                self._sockets[netns] = IPRoute() if netns is HOST_NS else NetNS(netns)
+                self._locks[netns] = threading.Lock()
+            return self._sockets[netns], self._locks[netns]
+
+    def _lookup(self, netns: Netns, iface_name: str) -> int | None:
+        socket, lock = self._socket(netns)
+        with lock:
+            indices = socket.link_lookup(ifname=iface_name)
+        if not indices:
+            self._record_error(NetlinkOperationError(
+                netns, 'link lookup', {'ifname': iface_name}, errno.ENODEV, os.strerror(errno.ENODEV)), log_error=True)
+            return None
+        return indices[0]
+
+    def _call_on_iface(self, netns: Netns, iface_name: str, method: str, command: str, **kwargs):
+        if (idx := self._lookup(netns, iface_name)) is not None:
+            self._call(netns, method, command, index=idx, **kwargs)
+
+    def _call(self, netns: Netns, method: str, command: str, log_error=True, **kwargs):
+        socket, lock = self._socket(netns)
+        try:
+            with lock:
+                getattr(socket, method)(command, **kwargs)
+        except NetlinkError as e:
+            self._record_error(NetlinkOperationError(
+                netns, f'{method} {command}', kwargs, e.code, os.strerror(e.code)), log_error)
+
+    def _record_error(self, error: NetlinkOperationError, log_error: bool):
+        self.errors.append(error)
+        if (collected := getattr(self._collected, 'errors', None)) is not None:
+            collected.append(error)
+        if log_error:
+            logger.error(
+                f'Netlink {error.operation} {error.args} in namespace {error.netns} failed: {error.message} ({error.code})')
@@ -0,0 +1,137 @@
+import json
+import os
+import struct
+import subprocess as sp
+import sys
+import threading
+
+import util.perf as perf
+from util.logger import logger
+
+_THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+_AGENT_PATH = os.path.join(_THIS_DIR, '..', 'scripts', 'ns_agent.py')
+_HEADER = struct.Struct('>I')
+_STOP_TIMEOUT_SECONDS = 5
+
+
+class NamespaceAgentError(Exception):
+    pass
+
+
+class NamespaceAgent:
+    '''
+    Long-lived privileged process that entered network namespace once and executes commands
+    sent to it over a pipe, saves sudo and `ip netns exec` on every command.
+    '''
+
+    def __init__(self, netns: str) -> None:
+        self.netns = netns
+        self._proc: sp.Popen = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._proc = sp.Popen(['sudo', sys.executable, _AGENT_PATH, self.netns],
+                              stdin=sp.PIPE, stdout=sp.PIPE)
+        try:
+            hello = self._read_frame()
+        except Exception:
+            # agent died or sudo failed before handshake, process must not be left behind
+            self.stop()
+            raise
+        if not hello.get('ready'):
+            self.stop()
+            raise NamespaceAgentError(
+                f'Agent for {self.netns} failed to start: {hello.get("error")}')
+
+    @perf.runner
+    def run(self, *commands: list[str], input: str = None) -> sp.CompletedProcess[str]:
+        with self._lock, perf.measure_command(commands, self.netns):
+            self._write_frame({'argv': list(commands), 'input': input})
+            res = self._read_frame()
+        return sp.CompletedProcess(list(commands), res['returncode'], res['stdout'], res['stderr'])
+
+    def close_input(self):
+        '''Makes agent exit without waiting for it'''
+        if self._proc is not None:
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+
+    def stop(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+            self._proc.wait(_STOP_TIMEOUT_SECONDS)
+        except (OSError, sp.TimeoutExpired):
+            self._proc.kill()
+            self._proc.wait()
+        self._proc = None
+
+    def _write_frame(self, payload: dict):
+        data = json.dumps(payload).encode()
+        try:
+            self._proc.stdin.write(_HEADER.pack(len(data)) + data)
+            self._proc.stdin.flush()
+        except OSError as e:
+            raise NamespaceAgentError(
+                f'Agent for {self.netns} is not reachable') from e
+
+    def _read_frame(self) -> dict:
+        header = self._proc.stdout.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise NamespaceAgentError(
+                f'Agent for {self.netns} exited with: {self._proc.poll()}')
+        (size,) = _HEADER.unpack(header)
+        return json.loads(self._proc.stdout.read(size).decode())
+
+
+_agents: dict[str, NamespaceAgent] = {}
+_agents_lock = threading.Lock()
+
+
+def start_agent(netns: str) -> bool:
+    with _agents_lock:
+        if netns in _agents:
+            return True
+
+    agent = NamespaceAgent(netns)
+    try:
+        agent.start()
+    except (OSError, NamespaceAgentError) as e:
+        logger.warning(
+            f'Failed to start agent for {netns}, falling back to ip netns exec', exc_info=e)
+        return False
+
+    with _agents_lock:
+        if netns in _agents:
+            duplicate = agent
+        else:
+            _agents[netns] = agent
+            duplicate = None
+    if duplicate is not None:
+        duplicate.stop()
+    return True
+
+
+def get_agent(netns: str) -> NamespaceAgent | None:
+    return _agents.get(netns)
+
+
+def stop_agent(netns: str):
+    with _agents_lock:
+        agent = _agents.pop(netns, None)
+    if agent is not None:
+        agent.stop()
+
+
+def stop_all_agents():
+    with _agents_lock:
+        agents = list(_agents.values())
+        _agents.clear()
+    # agents exit once their input is closed, let all of them exit before waiting for any
+    for agent in agents:
+        agent.close_input()
+    for agent in agents:
+        agent.stop()
@@ -0,0 +1,243 @@
+import csv
+import json
+import math
+import subprocess as sp
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Generator, NamedTuple
+
+
+class CommandSample(NamedTuple):
+    command_type: str
+    call_site: str
+    netns: str | None
+    seconds: float
+    returncode: int | None
+
+
+class PhaseSample(NamedTuple):
+    name: str
+    seconds: float
+
+
+class SpanSample(NamedTuple):
+    name: str
+    category: str
+    thread_id: int
+    thread_name: str
+    start: float
+    seconds: float
+    args: dict[str, Any]
+
+
+_lock = threading.Lock()
+_commands: list[CommandSample] = []
+_phases: list[PhaseSample] = []
+# spans aren't cleared by reset, trace covers everything done since import, e.g. lab deployment before build
+_spans: list[SpanSample] = []
+_runner_codes = set()
+_started_at = time.perf_counter()
+_trace_started_at = _started_at
+
+
+def runner(func: Callable) -> Callable:
+    '''Marks function that only forwards commands, samples are attributed to its caller instead'''
+    _runner_codes.add(func.__code__)
+    return func
+
+
+def reset():
+    global _started_at
+    with _lock:
+        _commands.clear()
+        _phases.clear()
+        _started_at = time.perf_counter()
+
+
+def run(commands: list[str], netns: str = None, **kwargs) -> sp.CompletedProcess:
+    start = time.perf_counter()
+    res = None
+    try:
+        res = sp.run(commands, **kwargs)
+        return res
+    finally:
+        _record(commands, netns, start, time.perf_counter() - start,
+                None if res is None else res.returncode)
+
+
+def record(commands: list[str], netns: str | None, start: float, seconds: float, returncode: int | None):
+    '''Records command executed without perf.run, start is time.perf_counter() value'''
+    _record(commands, netns, start, seconds, returncode)
+
+
+@contextmanager
+def measure_command(commands: list[str], netns: str = None) -> Generator[None, None, None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(commands, netns, start, time.perf_counter() - start, None)
+
+
+@contextmanager
+def phase(name: str) -> Generator[None, None, None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            _phases.append(PhaseSample(name, seconds))
+        _add_span(name, 'phase', start, seconds, {})
+
+
+@contextmanager
+def span(name: str, category: str = 'task', **args: Any) -> Generator[None, None, None]:
+    '''Marks unit of work shown in exported trace on the lane of the current thread'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_span(name, category, start, time.perf_counter() - start, args)
+
+
+def summary() -> dict[str, Any]:
+    with _lock:
+        commands = list(_commands)
+        phases = list(_phases)
+        total = time.perf_counter() - _started_at
+
+    return {
+        'total_seconds': total,
+        'phases': [sample._asdict() for sample in phases],
+        'commands': _aggregate(commands, lambda x: x.command_type),
+        'call_sites': _aggregate(commands, lambda x: x.call_site),
+        'namespaces': _aggregate(commands, lambda x: x.netns or 'host'),
+    }
+
+
+def write_report(json_path: str, csv_path: str):
+    report = summary()
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['section', 'name', 'count', 'total_seconds',
+                         'p50_seconds', 'p95_seconds', 'max_seconds'])
+        for sample in report['phases']:
+            writer.writerow(['phase', sample['name'], 1, sample['seconds'],
+                             sample['seconds'], sample['seconds'], sample['seconds']])
+        for section in ('commands', 'call_sites', 'namespaces'):
+            for stats in report[section]:
+                writer.writerow([section, stats['name'], stats['count'], stats['total_seconds'],
+                                 stats['p50_seconds'], stats['p95_seconds'], stats['max_seconds']])
+
+
+def write_trace(path: str):
+    '''Writes spans in Chrome trace event format, viewable in chrome://tracing or Perfetto'''
+    with _lock:
+        spans = list(_spans)
+
+    events = []
+    for thread_id, thread_name in dict((x.thread_id, x.thread_name) for x in spans).items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                      'tid': thread_id, 'args': {'name': thread_name}})
+    for sample in spans:
+        events.append({
+            'name': sample.name,
+            'cat': sample.category,
+            'ph': 'X',
+            'ts': (sample.start - _trace_started_at) * 1e6,
+            'dur': sample.seconds * 1e6,
+            'pid': 1,
+            'tid': sample.thread_id,
+            'args': sample.args
+        })
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _add_span(name: str, category: str, start: float, seconds: float, args: dict[str, Any]):
+    thread = threading.current_thread()
+    sample = SpanSample(name, category, thread.ident, thread.name, start, seconds, args)
+    with _lock:
+        _spans.append(sample)
+
+
+def _record(commands: list[str], netns: str | None, start: float, seconds: float, returncode: int | None):
+    args = list(commands)
+    if netns is None:
+        netns = _netns_of(args)
+    sample = CommandSample(_command_type(args), _call_site(),
+                           netns, seconds, returncode)
+    with _lock:
+        _commands.append(sample)
+    _add_span(sample.command_type, 'command', start, seconds,
+              {'call_site': sample.call_site, 'netns': netns or 'host', 'returncode': returncode})
+
+
+def _strip_wrappers(args: list[str]) -> list[str]:
+    if args[:1] == ['sudo']:
+        args = args[1:]
+    if args[:3] == ['ip', 'netns', 'exec']:
+        args = args[4:]
+    return args
+
+
+def _netns_of(args: list[str]) -> str | None:
+    if args[:1] == ['sudo']:
+        args = args[1:]
+    if args[:3] == ['ip', 'netns', 'exec'] and len(args) > 3:
+        return args[3]
+    if args[:1] == ['ip'] and '-n' in args[:-1]:
+        return args[args.index('-n') + 1]
+    return None
+
+
+def _command_type(args: list[str]) -> str:
+    args = _strip_wrappers(args)
+    if not args:
+        return ''
+    tool, rest = args[0], args[1:]
+    if '-batch' in rest:
+        return f'{tool} -batch'
+    subcommand = next((x for x in rest if not x.startswith('-')), None)
+    return tool if subcommand is None else f'{tool} {subcommand}'
+
+
+def _call_site() -> str:
+    frame = sys._getframe(1)
+    while frame is not None and (frame.f_globals.get('__name__') == __name__ or frame.f_code in _runner_codes):
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__')}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _percentile(sorted_values: list[float], p: float) -> float:
+    # nearest-rank method
+    return sorted_values[max(0, math.ceil(p * len(sorted_values)) - 1)]
+
+
+def _aggregate(samples: list[CommandSample], key: Callable[[CommandSample], str]) -> list[dict[str, Any]]:
+    groups: dict[str, list[float]] = {}
+    for sample in samples:
+        groups.setdefault(key(sample), []).append(sample.seconds)
+
+    res = []
+    for name, durations in groups.items():
+        durations.sort()
+        res.append({
+            'name': name,
+            'count': len(durations),
+            'total_seconds': sum(durations),
+            'p50_seconds': _percentile(durations, 0.5),
+            'p95_seconds': _percentile(durations, 0.95),
+            'max_seconds': durations[-1],
+        })
+    return sorted(res, key=lambda x: x['total_seconds'], reverse=True)
@@ -0,0 +1,35 @@
+import socket
+import time
+from typing import Callable
+
+_INITIAL_POLL_INTERVAL_SECONDS = 0.005
+_MAX_POLL_INTERVAL_SECONDS = 0.25
+
+
+def wait_until(condition: Callable[[], bool], timeout: float) -> bool:
+    '''
+    Polls condition with exponential backoff, so that fast devices are noticed within milliseconds
+    and slow ones don't get hammered. Returns False if condition wasn't met before the deadline.
+    '''
+    deadline = time.monotonic() + timeout
+    interval = _INITIAL_POLL_INTERVAL_SECONDS
+    while not condition():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, _MAX_POLL_INTERVAL_SECONDS)
+    return True
+
+
+def is_port_open(ipv4: str, port: int) -> bool:
+    try:
+        with socket.create_connection((ipv4, port), timeout=_MAX_POLL_INTERVAL_SECONDS):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_port(ipv4: str, port: int, timeout: float) -> bool:
+    '''Waits until TCP port accepts connections, e.g. thrift server of a switch'''
+    return wait_until(lambda: is_port_open(ipv4, port), timeout)
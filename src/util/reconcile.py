@@ -0,0 +1,268 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import util.iputils as iputils
+from util.iputils import BatchSegment, NetworkPlan, Netns
+from util.logger import logger
+
+
+_NETLINK_LINK_CREATING_METHODS = ('create_bridge', 'create_gre_tunnel',
+                                  'create_vxlan_tunnel', 'create_external_gre_tunnel')
+_ENCAP_IP_KEYS = ('id', 'src', 'dst', 'ttl', 'tos')
+
+
+class LiveState:
+    '''Links, addresses, routes and iptables rules present in a namespace, read with one dump per object type'''
+
+    def __init__(self, netns: Netns, with_iptables: bool) -> None:
+        self.netns = netns
+        self.links: dict[str, dict[str, Any]] = {
+            link['ifname']: link for link in self._dump('link', '-d')}
+        self.addresses: set[tuple[str, str]] = {
+            (item['ifname'], f"{addr['local']}/{addr['prefixlen']}")
+            for item in self._dump('address') for addr in item.get('addr_info', [])}
+        routes = self._dump('route', object_pairs_hook=_parse_route)
+        self.routes: set[tuple[str, str | None]] = {
+            (_normalize_dst(route['dst']), route.get('gateway')) for route in routes}
+        self.route_devs: set[tuple[str, str | None]] = {
+            (_normalize_dst(route['dst']), route.get('dev')) for route in routes}
+        self.encap_routes: set[tuple[str, str, str, str | None]] = {
+            (_normalize_dst(route['dst']), route['encap'].get('dst'), route.get('dev'), _route_mtu(route))
+            for route in routes if route.get('encap', {}).get('type') == 'ip'}
+        self.iptables_rules = self._dump_iptables() if with_iptables else set()
+        # links that don't exist yet, but will be created by kept operations
+        self.pending_links: set[str] = set()
+
+    def _dump(self, object_type: str, *flags: str, object_pairs_hook=None) -> list[dict[str, Any]]:
+        res = iputils.run_in_namespace(
+            self.netns, 'ip', '-j', *flags, object_type, 'show')
+        if res.returncode != 0 or not res.stdout.strip():
+            return []
+        return json.loads(res.stdout, object_pairs_hook=object_pairs_hook)
+
+    def _dump_iptables(self) -> set[tuple[str, str]]:
+        res = iputils.run_in_namespace(self.netns, 'iptables-save')
+        rules = set()
+        table = None
+        for line in res.stdout.splitlines():
+            if line.startswith('*'):
+                table = line[1:]
+            elif line.startswith('-A '):
+                rules.add((table, ' '.join(line.split())))
+        return rules
+
+
+def reconcile_plan(plan: NetworkPlan, managed_link_prefixes: tuple[str, ...] = (), max_workers: int = 1,
+                   applied_plans: list[NetworkPlan] = ()):
+    '''
+    Removes from the plan operations whose effects are already present in the live state and schedules
+    deletion of links with managed prefixes that exist, but weren't planned. Plan is modified in place.
+    Links of applied_plans, e.g. plans of the cluster before it was scaled out, aren't considered stale.
+    '''
+    namespaces = list(dict.fromkeys(segment.netns for segment in plan.segments))
+    with_iptables = {segment.netns for segment in plan.segments
+                     if segment.kind == BatchSegment.RESTORE}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        states = dict(zip(namespaces, executor.map(
+            lambda ns: LiveState(ns, ns in with_iptables), namespaces)))
+
+    kept, total = 0, 0
+    planned_links: dict[Netns, set[str]] = {ns: set() for ns in namespaces}
+    for segment in plan.segments:
+        total += len(segment.commands)
+        state = states[segment.netns]
+        if segment.kind == BatchSegment.NETLINK:
+            planned_links[segment.netns].update(_created_netlink_links(segment))
+            _filter_calls(segment, lambda method, args: _is_netlink_call_satisfied(state, method, args))
+        elif segment.kind == BatchSegment.BATCH:
+            planned_links[segment.netns].update(_created_links(segment))
+            _filter(segment, lambda args, next_args: _is_ip_cmd_satisfied(state, args, next_args)
+                    if segment.tool == 'ip' else False)
+            if segment.tool == 'tc':
+                segment.commands = [_as_replace(args) for args in segment.commands]
+        elif segment.kind == BatchSegment.RESTORE:
+            _filter(segment, lambda args, _: _is_iptables_cmd_satisfied(state, args))
+        kept += len(segment.commands)
+
+    for applied_plan in applied_plans:
+        for segment in applied_plan.segments:
+            if segment.netns in planned_links:
+                planned_links[segment.netns].update(_created_links(segment) if segment.kind == BatchSegment.BATCH
+                                                    else _created_netlink_links(segment))
+
+    stale = 0
+    for netns, state in states.items():
+        for name in state.links:
+            if name.startswith(managed_link_prefixes) and name not in planned_links[netns]:
+                plan.enqueue(netns, ('ip', 'link', 'del', name), True)
+                stale += 1
+
+    logger.info(
+        f'Reconciled network plan: {kept}/{total} operations to apply, {stale} stale links to remove')
+
+
+def _filter(segment: BatchSegment, is_satisfied):
+    commands, log_errors = [], []
+    for idx, (args, log_error) in enumerate(zip(segment.commands, segment.log_errors)):
+        next_args = segment.commands[idx + 1] if idx + 1 < len(segment.commands) else None
+        if not is_satisfied(args, next_args):
+            commands.append(args)
+            log_errors.append(log_error)
+    segment.commands = commands
+    segment.log_errors = log_errors
+
+
+def _filter_calls(segment: BatchSegment, is_satisfied):
+    # commands of netlink segments are readable forms of its calls
+    kept = [(args, call) for args, call in zip(segment.commands, segment.calls) if not is_satisfied(*call)]
+    segment.commands = [args for args, _ in kept]
+    segment.calls = [call for _, call in kept]
+
+
+def _created_netlink_links(segment: BatchSegment) -> list[str]:
+    links = []
+    for method, args in segment.calls:
+        if method == 'create_veth_pair':
+            links.extend([args[0].name, args[1].name])
+        elif method in _NETLINK_LINK_CREATING_METHODS:
+            links.append(args[0].name)
+    return links
+
+
+def _created_links(segment: BatchSegment) -> list[str]:
+    return [args[2] for args in segment.commands
+            if len(args) > 2 and args[0] in ('link', 'tunnel') and args[1] == 'add']
+
+
+def _parse_route(pairs: list[tuple[str, Any]]) -> dict[str, Any]:
+    # attributes of lightweight tunnel encapsulation follow "encap" key and reuse route keys, e.g. dst
+    route = {}
+    encap = None
+    for key, value in pairs:
+        if key == 'encap':
+            encap = route['encap'] = {'type': value}
+        elif encap is not None and key in _ENCAP_IP_KEYS:
+            encap[key] = value
+        else:
+            route[key] = value
+    return route
+
+
+def _route_mtu(route: dict[str, Any]) -> str | None:
+    mtu = next((metric['mtu'] for metric in route.get('metrics', []) if 'mtu' in metric), None)
+    return None if mtu is None else str(mtu)
+
+
+def _normalize_dst(dst: str) -> str:
+    return dst[:-3] if dst.endswith('/32') else dst
+
+
+def _is_ip_cmd_satisfied(state: LiveState, args: list[str], next_args: list[str] | None) -> bool:
+    obj, verb, rest = args[0], args[1], args[2:]
+    links = state.links
+
+    if obj in ('link', 'tunnel') and verb == 'add':
+        if rest[0] in links:
+            return True
+        state.pending_links.add(rest[0])
+        if 'peer' in rest:
+            state.pending_links.add(rest[-1])
+        return False
+    if obj == 'link' and verb == 'del':
+        return rest[0] not in links
+    if obj == 'link' and verb == 'set':
+        if rest[0] == 'dev':
+            rest = rest[1:]
+        name, attr = rest[0], rest[1:]
+        if attr[:1] == ['netns']:
+            # interface was already moved
+            return name not in links and name not in state.pending_links
+        if name not in links:
+            return False
+        link = links[name]
+        if attr == ['up']:
+            return 'UP' in link.get('flags', [])
+        if attr == ['down']:
+            return 'UP' not in link.get('flags', [])
+        if attr[:1] == ['mtu']:
+            return str(link.get('mtu')) == attr[1]
+        if attr[:1] == ['address']:
+            return link.get('address', '').lower() == attr[1].lower()
+        if attr[:1] == ['master']:
+            return link.get('master') == attr[1]
+        return False
+    if obj == 'address' and verb == 'add':
+        return (rest[2], rest[0]) in state.addresses
+    if obj == 'route' and verb == 'add' and len(rest) == 3 and rest[1] == 'via':
+        return (_normalize_dst(rest[0]), rest[2]) in state.routes
+    if obj == 'route' and verb == 'add' and rest[1:3] == ['encap', 'ip']:
+        opts = dict(zip(rest[3::2], rest[4::2]))
+        return (_normalize_dst(rest[0]), opts.get('dst'), opts.get('dev'), opts.get('mtu')) in state.encap_routes
+    if obj == 'route' and verb == 'del':
+        if rest == ['default'] and next_args is not None and next_args[:3] == ['route', 'add', 'default']:
+            # default route is replaced with the following command, skip both if it's already in place
+            return _is_ip_cmd_satisfied(state, next_args, None)
+        if len(rest) == 3 and rest[1] == 'via':
+            return (_normalize_dst(rest[0]), rest[2]) not in state.routes
+        if len(rest) == 3 and rest[1] == 'dev':
+            return (_normalize_dst(rest[0]), rest[2]) not in state.route_devs
+    return False
+
+
+def _is_netlink_call_satisfied(state: LiveState, method: str, args: tuple) -> bool:
+    links = state.links
+    if method == 'create_veth_pair':
+        iface1, iface2 = args[0], args[1]
+        if iface1.name in links:
+            return True
+        state.pending_links.update([iface1.name, iface2.name])
+        return False
+    if method in _NETLINK_LINK_CREATING_METHODS:
+        iface = args[0]
+        if iface.name not in links:
+            state.pending_links.add(iface.name)
+            return False
+        # address and state are applied by the same call
+        return iface.ipv4 is None or (iface.name, f'{iface.ipv4}/{iface.netmask}') in state.addresses
+    if method == 'move_iface_to_netns':
+        name = args[1].name
+        return name not in links and name not in state.pending_links
+    if method == 'set_iface_state':
+        name, up = args
+        return name in links and ('UP' in links[name].get('flags', [])) == up
+    if method == 'assign_ipv4':
+        iface = args[0]
+        return (iface.name, f'{iface.ipv4}/{iface.netmask}') in state.addresses
+    if method == 'set_iface_mtu':
+        iface = args[0]
+        return iface.name in links and links[iface.name].get('mtu') == iface.mtu
+    if method == 'add_route':
+        return (_normalize_dst(args[0]), args[1]) in state.routes
+    if method == 'add_default_route':
+        return ('default', args[0]) in state.routes
+    return False
+
+
+def _is_iptables_cmd_satisfied(state: LiveState, args: list[str]) -> bool:
+    table, rule = iputils.split_iptables_table(args)
+    op, chain, spec = rule[0], rule[1], rule[2:]
+    present = (table, ' '.join(['-A', chain, *_normalize_iptables_spec(spec)])) in state.iptables_rules
+    return not present if op == '-D' else present
+
+
+def _normalize_iptables_spec(spec: list[str]) -> list[str]:
+    # iptables-save prints host addresses with explicit /32 mask
+    res = []
+    for idx, token in enumerate(spec):
+        if idx > 0 and spec[idx - 1] in ('-d', '-s') and '/' not in token:
+            token = f'{token}/32'
+        res.append(token)
+    return res
+
+
+def _as_replace(args: list[str]) -> list[str]:
+    if args[:2] == ['qdisc', 'add']:
+        return ['qdisc', 'replace', *args[2:]]
+    return args
@@ -0,0 +1,83 @@
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable
+
+from util.logger import logger
+
+
+class TasksFailedError(Exception):
+    def __init__(self, failures: dict[str, BaseException]) -> None:
+        causes = '\n'.join(f'  {key}: {type(ex).__name__}: {ex}' for key, ex in failures.items())
+        super().__init__(f'Tasks of {len(failures)} nodes failed:\n{causes}')
+        self.failures = failures
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class TaskSupervisor:
+    '''
+    Runs tasks keyed by node name in a thread pool. Failed task is retried alone with exponential backoff,
+    once it runs out of attempts outstanding tasks are cancelled and failure causes of every node are raised.
+    Tasks still running at the timeout are reported as timed out and left to finish in background, threads
+    can't be interrupted, but they aren't retried anymore.
+    '''
+
+    def __init__(self, max_workers: int, retries: int = 2, backoff_seconds: float = 1,
+                 on_retry: Callable[[str], None] = None) -> None:
+        '''on_retry is called with key of the failed task before it is rerun, e.g. to undo its partial work'''
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.on_retry = on_retry
+
+    def run(self, tasks: dict[str, Callable[[], Any]], timeout: float = None) -> dict[str, Any]:
+        if not tasks:
+            return {}
+        cancelled = threading.Event()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(tasks)))
+        try:
+            futures = {key: executor.submit(self._run_with_retries, key, task, cancelled)
+                       for key, task in tasks.items()}
+            done, not_done = wait(futures.values(), timeout=timeout, return_when=FIRST_EXCEPTION)
+            timed_out = not_done if all(future.exception() is None for future in done) else set()
+            if not_done:
+                # running tasks may finish their current attempt until the deadline, queued ones never start
+                cancelled.set()
+                for future in not_done:
+                    future.cancel()
+                wait(not_done, timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        failures = {key: self._get_failure(future, future in timed_out) for key, future in futures.items()}
+        if failures := {key: ex for key, ex in failures.items() if ex is not None}:
+            raise TasksFailedError(failures)
+        return {key: future.result() for key, future in futures.items()}
+
+    def _run_with_retries(self, key: str, task: Callable[[], Any], cancelled: threading.Event) -> Any:
+        for attempt in range(self.retries + 1):
+            if cancelled.is_set():
+                raise _Cancelled()
+            try:
+                return task()
+            except Exception as e:
+                if attempt == self.retries or cancelled.is_set():
+                    raise
+                delay = self.backoff_seconds * 2 ** attempt
+                logger.warning(f'Task of {key} failed, retrying in {delay}s', exc_info=e)
+                if cancelled.wait(delay):
+                    raise
+                if self.on_retry is not None:
+                    self.on_retry(key)
+
+    def _get_failure(self, future: Future[Any], timed_out: bool) -> BaseException | None:
+        if not future.done():
+            return TimeoutError('task did not finish in time')
+        ex = None if future.cancelled() else future.exception()
+        if timed_out and (ex is None or isinstance(ex, _Cancelled)):
+            return TimeoutError('task did not finish in time')
+        return None if isinstance(ex, _Cancelled) else ex